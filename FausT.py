@@ -1,68 +1,144 @@
+from __future__ import annotations # types.Content 등의 어노테이션이 정의 시점에 google.genai를 불러오지 않도록 함
+import time
+_script_started_at = time.perf_counter() # 시작 시간 측정 기준 (import 포함)
+
 import streamlit as st
-import firebase_admin
-from firebase_admin import credentials, firestore
 import os
 import uuid
 import json
 from random import randint
 import io
-import base64
-import fitz # PyMuPDF for PDF processing
-from PIL import Image # 이미지 크기 조절을 위해 Pillow 라이브러리 추가
+import hashlib
+import sqlite3
+import abc
+import shutil
+import tempfile
+import weakref
+from collections import OrderedDict
+from collections.abc import MutableMapping
+import datetime
+import atexit
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from pdf_pipeline import iter_rendered_pdf_pages, render_pdf_page_preview, create_render_pool, PdfRenderStats, INGESTION_MODE_RASTER, INGESTION_MODE_TEXT_FIRST # PDF 페이지 병렬 렌더링 파이프라인
+from pdf_pipeline import estimate_text_tokens, estimate_image_tokens # 컨텍스트 토큰 추정
+from lazy_imports import LazyProxy, lazy_module # 무거운 모듈/서비스는 처음 사용할 때 로드
+from tracing import Tracer, JsonlSpanExporter, Span, waterfall_rows # 요청 경로의 단계별 소요 시간 추적
+try: # st.rerun()/st.stop()이 던지는 예외 (추적에서 오류로 기록하지 않음)
+    from streamlit.runtime.scriptrunner_utils.exceptions import RerunException, StopException
+except ImportError: # 이전 버전의 Streamlit
+    from streamlit.runtime.scriptrunner.script_runner import RerunException, StopException
+from token_usage import UsageMeter, UsageLedger, activate_meter, current_meter, record_usage, merge_records, total_usage, format_usage # 토큰 사용량/비용 집계
+from supervision_policy import AdaptiveSupervisionPolicy, SupervisionDecision, classify_prompt # 기록된 점수로 Supervisor 수를 정하는 정책
+
+# --- Lazy Module Imports ---
+# 이름은 기존과 같지만 실제 import는 첫 속성 접근 시점에 일어납니다 (콜드 스타트 시 첫 화면을 먼저 그리기 위함).
+Image = lazy_module("PIL.Image") # 이미지 크기 조절을 위해 Pillow 라이브러리 추가
+image_thumbnails = lazy_module("image_thumbnails") # draft()/reduce()를 사용하는 이미지 축소 엔진
+firebase_admin = lazy_module("firebase_admin")
+credentials = lazy_module("firebase_admin.credentials")
+firestore = lazy_module("firebase_admin.firestore")
 
 # --- Google Generative AI API Imports ---
-from google import genai
-from google.genai import types
-
-# --- Cloudinary Imports and Configuration ---
-import cloudinary
-import cloudinary.uploader
-import cloudinary.api # Cloudinary API 호출 (destroy)을 위해 추가
-import cloudinary.utils # cloudinary_url 함수를 사용하기 위해 추가
-import cloudinary.exceptions # Cloudinary 예외 처리를 위해 추가
+genai = lazy_module("google.genai")
+types = lazy_module("google.genai.types")
+
+# --- Startup Timing ---
+STARTUP_LAZY_LOAD_REPORT_MIN_SECONDS = 0.001 # 이미 import된 모듈을 다시 가져오는 것처럼 이보다 짧은 로딩은 보고하지 않음
+
+class StartupTimer:
+    """스크립트 실행을 단계별로 나누어 걸린 시간을 기록합니다. 지연 로딩된 모듈/서비스의 로딩 시간도 함께 보고합니다."""
+
+    def __init__(self, started_at: float):
+        self.started_at = started_at
+        self.last_mark = started_at
+        self.phases = [] # (단계 이름, 초)
+        self.lazy_loads = {} # 이번 실행 중 로드된 지연 로딩 대상 이름 -> 초
+
+    def mark(self, phase: str):
+        """직전 mark 이후 지금까지를 phase 단계로 기록합니다."""
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last_mark))
+        self.last_mark = now
+
+    def finish(self, proxies: dict[str, LazyProxy]):
+        """이번 실행에서 로드된 지연 로딩 대상의 로딩 시간을 모읍니다 (로딩 시간은 그 로드를 일으킨 단계에 이미 포함되어 있음)."""
+        for name, proxy in proxies.items():
+            if proxy.load_seconds is not None and proxy.load_seconds >= STARTUP_LAZY_LOAD_REPORT_MIN_SECONDS:
+                self.lazy_loads[name] = proxy.load_seconds
+
+    @property
+    def total_seconds(self) -> float:
+        return self.last_mark - self.started_at
+
+    def summary(self) -> str:
+        text = f"{self.total_seconds * 1000:.0f}ms (" + ", ".join(f"{phase} {seconds * 1000:.0f}ms" for phase, seconds in self.phases) + ")"
+        if self.lazy_loads:
+            text += " / 로드: " + ", ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in self.lazy_loads.items())
+        return text
+
+startup_timer = StartupTimer(_script_started_at)
+startup_timer.mark("import")
 
 # --- Configuration and Initialization ---
 
-# Firebase Admin SDK 초기화
-if not firebase_admin._apps:
-    cred_json_str = st.secrets.get("FIREBASE_CREDENTIAL_PATH") # secrets.toml에서 직접 로드
-    if cred_json_str:
-        try:
-            cred = credentials.Certificate(json.loads(cred_json_str))
-            firebase_admin.initialize_app(cred)
-            print("Firebase Admin SDK initialized.")
-        except json.JSONDecodeError as e:
-            st.error(f"Firebase Credential Path 시크릿의 JSON 형식이 잘못되었습니다: {e}")
-            st.stop()
-        except Exception as e:
-            st.error(f"Firebase Admin SDK 초기화 오류: {e}")
-            st.stop()
-    else:
-        st.error("FIREBASE_CREDENTIAL_PATH 시크릿이 설정되지 않았습니다. Firebase를 사용할 수 없습니다.")
-        st.stop()
-
-db = firestore.client()
-
 # Streamlit 페이지 설정
 st.set_page_config(page_title="FausT", layout="wide", page_icon="assets/faust_icon.png")
 
+# Firebase Admin SDK 초기화 (Firestore를 처음 사용할 때 한 번만 수행)
+@st.cache_resource
+def get_firestore_client():
+    """Firebase Admin SDK를 초기화하고 Firestore 클라이언트를 반환합니다. 로그인 사용자의 데이터를 처음 읽거나 쓸 때 호출됩니다."""
+    if not firebase_admin._apps:
+        cred_json_str = st.secrets.get("FIREBASE_CREDENTIAL_PATH") # secrets.toml에서 직접 로드
+        if cred_json_str:
+            try:
+                cred = credentials.Certificate(json.loads(cred_json_str))
+                firebase_admin.initialize_app(cred)
+                print("Firebase Admin SDK initialized.")
+            except json.JSONDecodeError as e:
+                st.error(f"Firebase Credential Path 시크릿의 JSON 형식이 잘못되었습니다: {e}")
+                st.stop()
+            except Exception as e:
+                st.error(f"Firebase Admin SDK 초기화 오류: {e}")
+                st.stop()
+        else:
+            st.error("FIREBASE_CREDENTIAL_PATH 시크릿이 설정되지 않았습니다. Firebase를 사용할 수 없습니다.")
+            st.stop()
+    return firestore.client()
+
+db = LazyProxy("firestore client", get_firestore_client)
+
 # --- Cloudinary Configuration (secrets.toml에서 로드) ---
 is_cloudinary_configured = False # Cloudinary 설정 여부를 나타내는 플래그
 try:
     CLOUDINARY_CLOUD_NAME = st.secrets["CLOUDINARY_CLOUD_NAME"]
     CLOUDINARY_API_KEY = st.secrets["CLOUDINARY_API_KEY"]
     CLOUDINARY_API_SECRET = st.secrets["CLOUDINARY_API_SECRET"]
+    is_cloudinary_configured = True # 시크릿이 모두 있으면 True (SDK는 첫 업로드/삭제 시 로드)
+except KeyError as e:
+    st.warning(f"Cloudinary 시크릿({e})이 `.streamlit/secrets.toml`에 설정되지 않았습니다. 로그인 사용자를 위한 이미지 영구 저장 기능(및 삭제)이 작동하지 않습니다.")
 
+def load_cloudinary():
+    """
+    Cloudinary SDK를 import하고 설정한 뒤 모듈을 반환합니다.
+    업로드/삭제 작업 스레드에서 처음 호출될 수 있으므로 st.* 를 사용하지 않습니다 (import된 모듈은 프로세스 전체에서 재사용됨).
+    """
+    import cloudinary
+    import cloudinary.uploader
+    import cloudinary.api # Cloudinary API 호출 (delete_resources)을 위해 추가
+    import cloudinary.utils # cloudinary_url 함수를 사용하기 위해 추가
+    import cloudinary.exceptions # Cloudinary 예외 처리를 위해 추가
     cloudinary.config(
         cloud_name=CLOUDINARY_CLOUD_NAME,
         api_key=CLOUDINARY_API_KEY,
         api_secret=CLOUDINARY_API_SECRET
     )
-    is_cloudinary_configured = True # 설정 성공 시 True로 변경
-except KeyError as e:
-    st.warning(f"Cloudinary 시크릿({e})이 `.streamlit/secrets.toml`에 설정되지 않았습니다. 로그인 사용자를 위한 이미지 영구 저장 기능(및 삭제)이 작동하지 않습니다.")
-except Exception as e:
-    st.error(f"Cloudinary 설정 중 오류 발생: {e}. 로그인 사용자를 위한 이미지 영구 저장 기능(및 삭제)이 작동하지 않습니다.")
+    return cloudinary
+
+cloudinary = LazyProxy("cloudinary", load_cloudinary)
 
 
 # --- Global Gemini Client Instance ---
@@ -71,7 +147,18 @@ def get_gemini_client_instance():
     """Gemini API 클라이언트 인스턴스를 반환합니다."""
     return genai.Client()
 
-gemini_client = get_gemini_client_instance()
+gemini_client = LazyProxy("gemini client", get_gemini_client_instance) # 첫 API 호출 시 생성
+
+# 시작 시간 보고에 포함할 지연 로딩 대상
+LAZY_LOAD_TARGETS = {
+    "google.genai": genai,
+    "Gemini 클라이언트": gemini_client,
+    "firebase_admin": firebase_admin,
+    "Firestore": db,
+    "Cloudinary": cloudinary,
+    "PIL": Image,
+}
+startup_timer.mark("설정")
 
 # --- Session State Initialization ---
 if "user_id" not in st.session_state:
@@ -80,13 +167,25 @@ if "is_logged_in" not in st.session_state:
     st.session_state.is_logged_in = False
 if "logged_in_user_email" not in st.session_state:
     st.session_state.logged_in_user_email = None
+if "persist_history" not in st.session_state:
+    st.session_state.persist_history = False # 대화 이력을 저장소에 저장하는지 (로그인 사용자, 또는 로컬 저장을 켠 익명 사용자)
 
 if "chat_history" not in st.session_state:
     st.session_state.chat_history = []
-if "chat_session" not in st.session_state:
-    st.session_state.chat_session = None
+if "chat_session_manager" not in st.session_state:
+    st.session_state.chat_session_manager = None
+if "pending_cloudinary_uploads" not in st.session_state:
+    st.session_state.pending_cloudinary_uploads = [] # Cloudinary 업로드가 끝나지 않은 메시지들
+if "pending_title_generation" not in st.session_state:
+    st.session_state.pending_title_generation = None # 백그라운드 제목 생성 (PendingTitleGeneration)
+if "last_stream_render_stats" not in st.session_state:
+    st.session_state.last_stream_render_stats = None
+if "chat_display_limit" not in st.session_state:
+    st.session_state.chat_display_limit = None # 표시할 최근 메시지 수 (Chat Display Area에서 초기화)
+if "chat_display_title" not in st.session_state:
+    st.session_state.chat_display_title = None
 if "saved_sessions" not in st.session_state:
-    st.session_state.saved_sessions = {}
+    st.session_state.saved_sessions = None # 사용자 확인 후 new_saved_sessions()로 생성
 if "current_title" not in st.session_state:
     st.session_state.current_title = "새로운 대화"
 if "system_instructions" not in st.session_state:
@@ -121,17 +220,162 @@ if "supervisor_count" not in st.session_state:
     st.session_state.supervisor_count = 3
 if "use_supervision" not in st.session_state:
     st.session_state.use_supervision = False
+if "speculative_generation" not in st.session_state:
+    st.session_state.speculative_generation = False
+if "adaptive_supervision" not in st.session_state:
+    st.session_state.adaptive_supervision = False
 if "selected_model" not in st.session_state:
     st.session_state.selected_model = "gemini-2.5-flash"
-
+if "supervisor_model" not in st.session_state:
+    st.session_state.supervisor_model = None # Supervisor 채점 모델 (None이면 SUPERVISOR_MODEL)
+if "pdf_ingestion_mode" not in st.session_state:
+    st.session_state.pdf_ingestion_mode = "text_first"
+if "image_preprocess_mode" not in st.session_state:
+    st.session_state.image_preprocess_mode = "compact"
+if "last_startup_timer" not in st.session_state:
+    st.session_state.last_startup_timer = None # 직전 실행의 StartupTimer (설정 패널에 표시)
+if "turn_span" not in st.session_state:
+    st.session_state.turn_span = None # 진행 중인 턴의 최상위 span (입력 처리 ~ 응답 생성까지 여러 번의 실행에 걸침)
+if "recent_turn_trace_ids" not in st.session_state:
+    st.session_state.recent_turn_trace_ids = [] # 최근 턴들의 trace_id (최신순, 추적 패널용)
+if "show_trace_panel" not in st.session_state:
+    st.session_state.show_trace_panel = False
+if "turn_usage" not in st.session_state:
+    st.session_state.turn_usage = None # 진행 중인 턴의 UsageMeter (턴 span과 같은 수명)
+if "last_turn_usage" not in st.session_state:
+    st.session_state.last_turn_usage = None # 직전 턴의 사용량 records (설정 패널에 표시)
+if "regenerated_usage" not in st.session_state:
+    st.session_state.regenerated_usage = [] # 다시 생성으로 지운 답변의 사용량 (새 답변에 합산하여 대화 사용량에서 빠지지 않도록 함)
+if "usage_ledger" not in st.session_state:
+    st.session_state.usage_ledger = UsageLedger() # 사용자의 누적 사용량 (저장소에서 불러와 교체)
+if "usage_budget_exceeded" not in st.session_state:
+    st.session_state.usage_budget_exceeded = False
+
+startup_timer.mark("세션 상태")
 
 # --- Constants ---
 MAX_PDF_PAGES_TO_PROCESS = 100
+PDF_RENDER_DPI = 300 # raster 모드의 DPI, text_first 모드에서는 적응형 DPI의 상한
+PDF_RENDER_MEMORY_BUDGET_BYTES = 64 * 1024 * 1024 # 렌더링 파이프라인이 소비되기 전까지 보관할 수 있는 최대 페이지 바이트
+PDF_PARTS_MEMORY_BUDGET_BYTES = 20 * 1024 * 1024 # 한 PDF에서 보관해 Gemini로 보내는 페이지 Part의 최대 합계 (인라인 요청 크기 한도와 같음)
+PDF_RENDER_MAX_WORKERS = max(1, min(4, os.cpu_count() or 1)) # 모든 세션이 공유하는 PDF 렌더링 프로세스 수
+PDF_PREVIEW_DPI = 100 # 첫 페이지가 텍스트로 전달될 때 대화 기록/표시용으로 렌더링하는 미리보기 DPI
+UPLOAD_CACHE_MAX_BYTES = 256 * 1024 * 1024 # 모든 세션이 공유하는 업로드 처리 결과 캐시의 최대 크기
+BLOB_STORE_MAX_BYTES = 128 * 1024 * 1024 # 대화 이력 이미지 바이트를 메모리에 보관하는 최대 크기 (모든 세션 공유, LRU)
+BLOB_STORE_DISK_MAX_BYTES = 2 * 1024 * 1024 * 1024 # 같은 이미지를 임시 디렉터리에 보관하는 최대 크기 (넘으면 오래된 것부터 삭제)
+CLOUDINARY_UPLOAD_MAX_WORKERS = 4 # 모든 세션이 공유하는 백그라운드 Cloudinary 업로드 스레드 수
+CLOUDINARY_UPLOAD_WAIT_TIMEOUT_SECONDS = 10.0 # 로그아웃 전에 진행 중인 업로드를 기다리는 최대 시간
+CLOUDINARY_DELETE_BATCH_SIZE = 100 # delete_resources 한 번에 보낼 수 있는 최대 public_id 수
+CLOUDINARY_DELETE_MAX_ATTEMPTS = 5
+CLOUDINARY_DELETE_RETRY_BASE_SECONDS = 2.0
+CLOUDINARY_DELETE_RETRY_MAX_SECONDS = 300.0
+CLOUDINARY_DELETE_FLUSH_TIMEOUT_SECONDS = 10.0 # 프로세스 종료 시 삭제 완료를 기다리는 최대 시간
+PDF_INGESTION_MODES = {
+    INGESTION_MODE_TEXT_FIRST: "텍스트 우선 (이미지 위주 페이지만 이미지로 전달)",
+    INGESTION_MODE_RASTER: "모든 페이지를 이미지로 전달",
+}
+# 업로드 이미지 전처리 (한 번만 수행하고, 이후 모든 턴에는 전처리된 이미지를 보냄)
+IMAGE_PREPROCESS_MODES = {
+    "compact": "압축 (긴 변 1536px, 메타데이터 제거)",
+    "high": "고해상도 (긴 변 3072px, 메타데이터 제거)",
+    "original": "원본 그대로 전달",
+}
+IMAGE_PREPROCESS_MAX_SIDES = {"compact": 1536, "high": 3072, "original": None} # Gemini는 768px 타일 단위로 이미지를 처리
+IMAGE_PREPROCESS_QUALITY = 85 # JPEG/WebP 재인코딩 품질
 AVAILABLE_MODELS = ["gemini-2.5-pro", "gemini-2.5-flash", "gemini-2.0-flash"]
 
 # 비로그인 사용자용 로컬 이미지 디스플레이 너비 (픽셀)
 LOCAL_DISPLAY_WIDTH = 500
 
+# Supervisor 병렬 평가 설정
+SUPERVISOR_CALL_TIMEOUT_SECONDS = 60 # Supervisor 호출 1회당 최대 대기 시간 (초, 풀에서 실행을 시작한 때부터)
+SUPERVISOR_MAX_COUNT = 5 # 설정에서 고를 수 있는 최대 Supervisor 수
+SUPERVISION_MAX_RETRIES = 5 # 설정에서 고를 수 있는 최대 재시도 횟수 (병렬 후보 생성에서는 후보 수)
+CANDIDATE_MAX_WORKERS = 8 # 모든 세션이 공유하는 병렬 후보 답변 생성용 스레드 풀 크기
+# 모든 세션이 공유하는 Supervisor 스레드 풀 크기. 후보 작업은 이 풀에 평가를 넣고 끝날 때까지 스레드를 잡고 기다리므로,
+# 실행 중인 모든 후보의 평가가 한꺼번에 들어가도 순차 Supervision(요청 스레드의 패널)이 쓸 스레드가 남도록 잡음
+SUPERVISOR_MAX_WORKERS = (CANDIDATE_MAX_WORKERS + 2) * SUPERVISOR_MAX_COUNT
+
+# Supervisor 채점 설정 (채팅 모델과 별개의 저렴한 모델로, {"score": 정수} 형식의 구조화된 출력만 받음)
+SUPERVISOR_MODEL = st.secrets.get("SUPERVISOR_MODEL", "gemini-2.0-flash") # 기본 채점 모델 (설정에서 세션별로 변경 가능)
+SUPERVISOR_MAX_OUTPUT_TOKENS = 16 # {"score": 87} 정도의 출력에 맞춘 한도
+SUPERVISOR_THINKING_BUDGETS = {"gemini-2.5-pro": 128, "gemini-2.5-flash": 0} # 사고 토큰도 출력 한도에 포함되므로 최소로 제한 (2.5 Pro는 끌 수 없음)
+SUPERVISOR_PARSE_RETRIES = 1 # 형식에 맞지 않는 출력이면 출력 한도를 두 배로 늘려 다시 요청하는 횟수
+SUPERVISOR_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {"score": {"type": "INTEGER", "minimum": 0, "maximum": 100}},
+    "required": ["score"],
+}
+
+# 적응형 Supervision 설정 ((모델, 시스템 명령어, 프롬프트 분류)별 최근 점수로 Supervisor 수를 정함)
+ADAPTIVE_SUPERVISION_WINDOW = 30 # 조합별로 보관하는 최근 점수 수
+ADAPTIVE_SUPERVISION_MIN_SAMPLES = 5 # 이보다 적게 기록된 조합은 전체 패널로 평가
+ADAPTIVE_SUPERVISION_REDUCE_PASS_RATE = 0.75 # 통과율 하한이 이 이상이면 Supervisor 수를 줄임
+ADAPTIVE_SUPERVISION_SKIP_PASS_RATE = 0.9 # 통과율 하한이 이 이상이면 평가 생략
+ADAPTIVE_SUPERVISION_REDUCED_SUPERVISORS = 1
+ADAPTIVE_SUPERVISION_AUDIT_RATE = 0.1 # 생략 대상인 턴 중 전체 패널로 감사하는 비율
+ADAPTIVE_SUPERVISION_AUDIT_FAILURE_FULL_TURNS = 5 # 감사에서 기준을 넘지 못한 조합을 전체 패널로 평가하는 턴 수
+
+# 컨텍스트 윈도우 관리 설정 (모델 최대 컨텍스트보다 작게 잡은, 이력에 쓰는 입력 토큰 예산)
+MODEL_CONTEXT_TOKEN_BUDGETS = {
+    "gemini-2.5-pro": 128_000,
+    "gemini-2.5-flash": 128_000,
+    "gemini-2.0-flash": 64_000,
+}
+DEFAULT_CONTEXT_TOKEN_BUDGET = 64_000
+CONTEXT_TAIL_BUDGET_RATIO = 0.6 # 요약할 때 원문으로 남길 최근 이력의 예산 비율 (여유를 두어 매 턴 요약하지 않도록 함)
+CONTEXT_KEEP_IMAGE_MESSAGES = 4 # 예산 초과 시 이미지를 유지할 최근 메시지 수 (그 이전 이미지부터 생략)
+CONTEXT_SUMMARY_MODEL = "gemini-2.0-flash" # 이전 대화 요약에 사용하는 저렴한 모델
+CONTEXT_SUMMARY_MAX_CHARS = 2000
+CONTEXT_SUMMARY_MAX_WORKERS = 2 # 요약은 요청 경로 밖에서 생성하고 다음 턴부터 사용
+SUPERVISOR_HISTORY_TOKEN_BUDGET = 8_000 # Supervisor 평가 프롬프트에 넣는 이전 대화의 토큰 예산
+
+# 대화 제목 생성 설정 (첫 답변 후 임시 제목을 바로 붙이고, 모델이 만든 제목은 백그라운드에서 받아 교체)
+TITLE_MODEL = "gemini-2.0-flash" # 제목 생성에 사용하는 저렴한 모델
+TITLE_MAX_CHARS = 30
+TITLE_PROMPT_MAX_CHARS = 2000 # 제목 생성 프롬프트에 넣는 사용자 메시지의 최대 길이
+TITLE_MAX_OUTPUT_TOKENS = 64
+TITLE_POLL_INTERVAL_SECONDS = 1.0 # 제목 생성 완료를 확인하는 간격
+TITLE_MAX_WORKERS = 4 # 모든 세션이 공유하는 제목 생성용 스레드 풀 크기
+
+# 단계별 지연 시간 추적 설정
+TRACE_EXPORT_PATH = st.secrets.get("TRACE_EXPORT_PATH", "") # 설정하면 끝난 span을 이 JSONL 파일에 추가 (OTLP/JSON 필드 이름)
+TRACE_MAX_TRACES = 200 # 메모리에 보관하는 최근 trace 수 (모든 세션 공유)
+TRACE_PANEL_TURNS = 5 # 추적 패널에서 고를 수 있는 최근 턴 수
+
+# 토큰 사용량/비용 집계 설정
+# 모델별 100만 토큰당 (입력, 캐시된 입력, 출력) 단가 (USD, 20만 토큰 이하 프롬프트 기준 공개 가격). 단가가 없는 모델은 비용 0으로 집계
+MODEL_PRICING_USD_PER_MILLION_TOKENS = {
+    "gemini-2.5-pro": (1.25, 0.31, 10.00),
+    "gemini-2.5-flash": (0.30, 0.075, 2.50),
+    "gemini-2.0-flash": (0.10, 0.025, 0.40),
+}
+USAGE_CATEGORY_LABELS = {"chat": "답변", "supervisor": "Supervisor", "title": "제목", "summary": "요약"}
+# 사용자별 월간 예산 (0이면 제한 없음). 넘으면 Supervision을 자동으로 끕니다.
+USAGE_MONTHLY_TOKEN_BUDGET = st.secrets.get("USAGE_MONTHLY_TOKEN_BUDGET", 0)
+USAGE_MONTHLY_COST_BUDGET_USD = st.secrets.get("USAGE_MONTHLY_COST_BUDGET_USD", 0.0)
+USAGE_USER_BUDGETS = st.secrets.get("USAGE_USER_BUDGETS", {}) # user_id -> {"tokens": ..., "cost_usd": ...} (기본 예산 대신 사용)
+# 익명 사용자의 user_id는 세션 ID라서 새로고침/새 탭마다 바뀌므로, 사용자별 예산은 새 세션을 열면 다시 0부터 시작합니다.
+# 그래서 이 프로세스의 모든 익명 세션이 함께 쓰는 월간 예산을 따로 둡니다 (0이면 제한 없음, 프로세스를 다시 시작하면 초기화).
+USAGE_ANONYMOUS_MONTHLY_TOKEN_BUDGET = st.secrets.get("USAGE_ANONYMOUS_MONTHLY_TOKEN_BUDGET", 0)
+USAGE_ANONYMOUS_MONTHLY_COST_BUDGET_USD = st.secrets.get("USAGE_ANONYMOUS_MONTHLY_COST_BUDGET_USD", 0.0)
+
+# Gemini 명시적 컨텍스트 캐시 설정 (시스템 프롬프트, Supervisor 프롬프트, 오래된 대화 이력을 캐시)
+CONTEXT_CACHE_BACKEND = st.secrets.get("GEMINI_CONTEXT_CACHE_BACKEND", "off") # "off", "gemini"(캐시 보관 비용이 드는 유료 기능), "local"(테스트용 가짜 서비스)
+CONTEXT_CACHE_MAX_WORKERS = 2 # 캐시 생성/연장/삭제를 요청 경로 밖에서 처리하는 스레드 수
+CONTEXT_CACHE_TTL_SECONDS = 900
+CONTEXT_CACHE_REFRESH_SECONDS = 300 # 남은 TTL이 이보다 짧아진 캐시를 사용할 때 TTL을 연장
+CONTEXT_CACHE_EXPIRY_MARGIN_SECONDS = 60 # 만료가 이만큼 남지 않은 캐시는 사용하지 않음 (요청 도중 만료 방지)
+CONTEXT_CACHE_MAX_ENTRIES = 64 # 초과하면 가장 오래 사용하지 않은 캐시부터 삭제
+CONTEXT_CACHE_FAILURE_BACKOFF_SECONDS = 600 # 캐시 생성에 실패한 프리픽스는 이 시간 동안 다시 시도하지 않음
+CONTEXT_CACHE_MIN_TOKENS = { # 모델별 캐시 가능한 최소 토큰 수 (이보다 작으면 캐시하지 않고 그대로 전송)
+    "gemini-2.5-pro": 4096,
+    "gemini-2.5-flash": 1024,
+    "gemini-2.0-flash": 4096,
+}
+CONTEXT_CACHE_RECENT_MESSAGES = 6 # 캐시하지 않고 매번 보내는 최근 메시지 수
+CONTEXT_CACHE_PREFIX_STEP = 8 # 캐시할 이력 프리픽스의 경계를 이 단위로만 옮겨 여러 턴 동안 같은 캐시를 재사용
+
 SUPER_INTRODUCTION_HEAD = """
 Make sure to think step-by-step when answering
 
@@ -215,9 +459,102 @@ SYSTEM_INSTRUCTION_SUPERVISOR = """
 
 출력 형식:
 
-오직 하나의 정수 값 (0-100)만 출력하세요. 다른 텍스트나 설명은 일절 포함하지 마십시오.
+{"score": 정수} 형식의 JSON 객체 하나만 출력하세요. score는 0부터 100 사이의 정수입니다. 다른 텍스트나 설명은 일절 포함하지 마십시오.
 """
 
+# --- Tracing ---
+@st.cache_resource
+def get_tracer() -> Tracer:
+    """
+    모든 세션이 공유하는 Tracer를 반환합니다. TRACE_EXPORT_PATH가 설정되어 있으면 JSONL로도 내보냅니다.
+    st.rerun()/st.stop()은 span 안에서 호출되어도 오류가 아니므로 control_flow_exceptions로 넘깁니다.
+    """
+    exporter = None
+    if TRACE_EXPORT_PATH:
+        try:
+            exporter = JsonlSpanExporter(TRACE_EXPORT_PATH)
+            atexit.register(exporter.close)
+        except OSError as e:
+            print(f"추적 파일을 열 수 없어 메모리에만 기록합니다: {e}")
+    return Tracer(exporter, max_traces=TRACE_MAX_TRACES, control_flow_exceptions=(RerunException, StopException))
+
+tracer = get_tracer()
+tracer.activate(None) # 스크립트 스레드는 실행 사이에 재사용되므로, 이전 실행의 현재 span을 지움
+activate_meter(None) # 현재 UsageMeter도 같은 이유로 지움 (턴 meter는 턴을 처리하는 실행에서 다시 지정)
+
+def start_turn_span(**attributes) -> Span:
+    """새 턴의 최상위 span을 시작합니다. 끝나지 않은 이전 턴 span(오류로 중단된 경우 등)은 먼저 닫습니다."""
+    end_turn_span()
+    turn_span = tracer.start_span("turn", root=True, title=st.session_state.current_title,
+                                  model=st.session_state.selected_model, supervision=st.session_state.use_supervision,
+                                  **attributes)
+    st.session_state.turn_span = turn_span
+    st.session_state.turn_usage = UsageMeter(MODEL_PRICING_USD_PER_MILLION_TOKENS)
+    return turn_span
+
+def end_turn_span():
+    """진행 중인 턴 span을 끝내고 추적 패널의 최근 턴 목록에 추가합니다."""
+    turn_span = st.session_state.turn_span
+    if turn_span is None:
+        return
+    turn_span.end()
+    st.session_state.turn_span = None
+    st.session_state.turn_usage = None
+    st.session_state.recent_turn_trace_ids = [turn_span.trace_id, *st.session_state.recent_turn_trace_ids][:TRACE_PANEL_TURNS]
+
+# --- Token Usage Accounting ---
+def commit_turn_usage(model_message: ChatMessage):
+    """
+    턴 meter의 사용량을 답변 메시지(대화별 사용량, 대화 데이터와 함께 저장)와 사용자 누적 사용량에 반영합니다.
+    다시 생성으로 지운 답변의 사용량은 새 답변 메시지에 합산합니다 (사용자 누적에는 이미 반영됨).
+    """
+    meter = st.session_state.turn_usage
+    records = meter.records() if meter is not None else []
+    model_message.usage = merge_records(st.session_state.regenerated_usage, records) or None
+    st.session_state.regenerated_usage = []
+    add_user_usage(records)
+    st.session_state.last_turn_usage = records
+    totals = total_usage(records)
+    tracer.current_span().set_attributes(tokens=totals["total_tokens"], cost_usd=round(totals["cost_usd"], 6))
+
+@st.cache_resource
+def get_anonymous_usage_ledger() -> UsageLedger:
+    """모든 익명 세션이 함께 쓰는 사용량 (USAGE_ANONYMOUS_MONTHLY_* 예산에 사용, 저장하지 않음)."""
+    return UsageLedger()
+
+def add_user_usage(records: list):
+    """사용량을 사용자 누적 사용량에 더합니다. 익명 사용자는 모든 익명 세션이 함께 쓰는 사용량에도 더합니다."""
+    st.session_state.usage_ledger.add(records)
+    if not st.session_state.is_logged_in:
+        get_anonymous_usage_ledger().add(records)
+
+def is_over_budget(records: list, token_budget: int, cost_budget: float) -> bool:
+    totals = total_usage(records)
+    return bool(token_budget and totals["total_tokens"] >= token_budget) or bool(cost_budget and totals["cost_usd"] >= cost_budget)
+
+def get_usage_budget(user_id: str) -> tuple[int, float]:
+    """사용자의 월간 (토큰, 비용) 예산. USAGE_USER_BUDGETS에 없으면 기본 예산. 0이면 제한 없음."""
+    user_budget = USAGE_USER_BUDGETS.get(user_id, {})
+    return user_budget.get("tokens", USAGE_MONTHLY_TOKEN_BUDGET), user_budget.get("cost_usd", USAGE_MONTHLY_COST_BUDGET_USD)
+
+def enforce_usage_budget():
+    """
+    이번 달 사용량이 예산을 넘었으면 Supervision을 끕니다 (Supervision은 턴당 호출 수를 최대 수십 배로 늘림).
+    설정 위젯보다 먼저 호출해야 토글 상태도 함께 바뀝니다.
+    """
+    token_budget, cost_budget = get_usage_budget(st.session_state.user_id)
+    usage_records = st.session_state.usage_ledger.current
+    exceeded = is_over_budget(usage_records, token_budget, cost_budget)
+    if not exceeded and not st.session_state.is_logged_in: # 세션마다 바뀌는 익명 user_id 대신 익명 세션 전체의 사용량으로 판단
+        usage_records = get_anonymous_usage_ledger().current
+        exceeded = is_over_budget(usage_records, USAGE_ANONYMOUS_MONTHLY_TOKEN_BUDGET, USAGE_ANONYMOUS_MONTHLY_COST_BUDGET_USD)
+    st.session_state.usage_budget_exceeded = exceeded
+    if exceeded and st.session_state.use_supervision:
+        totals = total_usage(usage_records)
+        st.session_state.use_supervision = False
+        st.session_state.supervision_toggle = False
+        st.warning(f"이번 달 사용량이 예산을 넘어 Supervision을 자동으로 껐습니다. (사용: {totals['total_tokens']:,} 토큰, ${totals['cost_usd']:.2f})")
+
 # --- Helper Functions ---
 
 # 이미지 크기 조절 함수
@@ -227,28 +564,422 @@ def resize_image_for_display(image_bytes: bytes, display_width: int) -> bytes:
     (명령어 실행 환경: 가상환경 내에서 Streamlit 앱이 실행될 때)
     """
     try:
-        img = Image.open(io.BytesIO(image_bytes))
-        width, height = img.size
+        # 큰 JPEG는 DCT 단계에서 줄여 디코딩하고, EXIF 회전을 반영 (줄일 필요가 없으면 원본 바이트 그대로)
+        return image_thumbnails.make_display_thumbnail(image_bytes, display_width)
+    except Exception as e:
+        st.warning(f"이미지 리사이즈 중 오류 발생: {e}. 원본 크기로 표시됩니다.")
+        return image_bytes # 오류 발생 시 원본 반환
 
-        if width > display_width: # 지정된 너비보다 크면 조절
-            ratio = display_width / width
-            new_width = display_width
-            new_height = int(height * ratio)
-            img = img.resize((new_width, new_height), Image.LANCZOS) # 고품질 리사이즈 알고리즘
+@tracer.traced("image.preprocess")
+def preprocess_image_for_gemini(image_bytes: bytes, mime_type: str, mode: str) -> tuple[bytes, str, str]:
+    """
+    업로드된 이미지를 Gemini로 보내기 전에 한 번 전처리합니다.
+    EXIF 회전을 픽셀에 반영한 뒤 긴 변을 IMAGE_PREPROCESS_MAX_SIDES[mode] 이하로 줄이고, 메타데이터 없이 다시 인코딩합니다
+    (투명도가 없으면 JPEG, 있으면 WebP). 반환값: (이미지 바이트, MIME 타입, 표시용 요약 문자열).
+    이미 충분히 작은 이미지가 재인코딩으로 더 커지거나, 처리할 수 없는 이미지(애니메이션 등)는 원본을 그대로 반환합니다.
+    """
+    max_side = IMAGE_PREPROCESS_MAX_SIDES.get(mode)
+    if max_side is None:
+        return image_bytes, mime_type, ""
+    try:
+        img = Image.open(io.BytesIO(image_bytes))
+        if getattr(img, "is_animated", False):
+            return image_bytes, mime_type, ""
+        original_size = img.size
+        img, _ = image_thumbnails.load_scaled_image(image_bytes, max_side, max_side) # EXIF 회전 반영 + draft()/reduce() 축소
+        has_alpha = img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
 
         byte_arr = io.BytesIO()
-        img.save(byte_arr, format=img.format if img.format else 'PNG') # 원본 포맷 유지, 없으면 PNG
-        return byte_arr.getvalue()
+        if has_alpha:
+            img.convert("RGBA").save(byte_arr, format="WEBP", quality=IMAGE_PREPROCESS_QUALITY)
+            output_mime_type = "image/webp"
+        else: # exif/icc_profile 등을 넘기지 않으므로 메타데이터는 저장되지 않음
+            img.convert("RGB").save(byte_arr, format="JPEG", quality=IMAGE_PREPROCESS_QUALITY, optimize=True)
+            output_mime_type = "image/jpeg"
+        output_bytes = byte_arr.getvalue()
     except Exception as e:
-        st.warning(f"이미지 리사이즈 중 오류 발생: {e}. 원본 크기로 표시됩니다.")
-        return image_bytes # 오류 발생 시 원본 반환
+        print(f"이미지 전처리 중 오류 발생, 원본을 사용합니다: {e}")
+        return image_bytes, mime_type, ""
+
+    if len(output_bytes) >= len(image_bytes) and max(original_size) <= max_side:
+        return image_bytes, mime_type, ""
+    summary = (f"{original_size[0]}×{original_size[1]} → {img.width}×{img.height}, "
+               f"{len(image_bytes) / 1024:.0f}KB → {len(output_bytes) / 1024:.0f}KB ({output_mime_type.split('/')[1].upper()})")
+    return output_bytes, output_mime_type, summary
+
+# --- Chat Message Records ---
+class BlobStore:
+    """
+    이미지 바이트를 SHA-256 해시(digest)로 중복 제거하여 보관하는 저장소 (모든 세션이 공유).
+    메시지는 digest만 가지고, 바이트는 메모리에 max_bytes까지만 LRU로 보관합니다.
+    put 시 spill_dir에도 파일로 써 두므로 메모리에서 밀려난 바이트는 파일에서 다시 읽어 오고,
+    파일도 max_disk_bytes를 넘으면 오래 사용하지 않은 것부터 지웁니다 (그 뒤에는 get이 None을 반환).
+    """
+
+    def __init__(self, max_bytes: int, max_disk_bytes: int = 0, spill_dir: str | None = None):
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.spill_dir = spill_dir
+        self.current_bytes = 0
+        self.disk_bytes = 0
+        self.disk_read_count = 0
+        self._memory = OrderedDict() # digest -> bytes
+        self._disk = OrderedDict() # digest -> 파일 크기
+        self._lock = threading.Lock()
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.spill_dir, digest)
+
+    def put(self, data: bytes | None) -> str | None:
+        """바이트를 보관하고 digest를 반환합니다."""
+        if not data:
+            return None
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            on_disk = digest in self._disk
+        if self.spill_dir is not None and not on_disk and len(data) <= self.max_disk_bytes:
+            try:
+                with open(self._path(digest), "wb") as spill_file: # 같은 digest는 같은 내용이므로 동시에 써도 안전
+                    spill_file.write(data)
+            except OSError as e:
+                print(f"이미지 Blob을 디스크에 쓰지 못해 메모리에만 보관합니다: {e}")
+            else:
+                with self._lock:
+                    if digest not in self._disk:
+                        self._disk[digest] = len(data)
+                        self.disk_bytes += len(data)
+                    removed_digests = self._evict_disk()
+                self._remove_files(removed_digests)
+        self._remember(digest, data)
+        return digest
+
+    def get(self, digest: str | None) -> bytes | None:
+        """digest의 바이트를 반환합니다. 메모리와 디스크에서 모두 밀려났으면 None."""
+        if digest is None:
+            return None
+        with self._lock:
+            data = self._memory.get(digest)
+            if data is not None:
+                self._memory.move_to_end(digest)
+                return data
+            if digest not in self._disk:
+                return None
+            self._disk.move_to_end(digest)
+        try:
+            with open(self._path(digest), "rb") as spill_file:
+                data = spill_file.read()
+        except OSError:
+            return None # 그 사이 디스크 예산을 넘어 삭제됨
+        self._remember(digest, data, from_disk=True)
+        return data
+
+    def _remember(self, digest: str, data: bytes, from_disk: bool = False):
+        with self._lock:
+            if from_disk:
+                self.disk_read_count += 1
+            if digest in self._memory:
+                self._memory.move_to_end(digest)
+                return
+            if len(data) > self.max_bytes:
+                return
+            self._memory[digest] = data
+            self.current_bytes += len(data)
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self.current_bytes -= len(evicted)
+
+    def _evict_disk(self) -> list:
+        """디스크 예산을 넘은 항목을 색인에서 빼고 그 digest를 반환합니다 (lock을 잡은 상태에서 호출, 파일 삭제는 lock 밖에서)."""
+        removed_digests = []
+        while self.disk_bytes > self.max_disk_bytes and self._disk:
+            digest, size = self._disk.popitem(last=False)
+            self.disk_bytes -= size
+            removed_digests.append(digest)
+        return removed_digests
+
+    def _remove_files(self, digests):
+        for digest in digests:
+            try:
+                os.remove(self._path(digest))
+            except OSError:
+                pass
+
+    def close(self):
+        """임시 디렉터리를 지웁니다 (프로세스 종료 시)."""
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    def stats(self) -> tuple[int, int, int, int]:
+        """(메모리 항목 수, 메모리 바이트, 디스크 항목 수, 디스크 바이트)"""
+        with self._lock:
+            return len(self._memory), self.current_bytes, len(self._disk), self.disk_bytes
+
+@st.cache_resource
+def get_blob_store() -> BlobStore:
+    """모든 세션이 공유하는 BlobStore를 반환합니다. 디스크 보관용 임시 디렉터리는 프로세스 종료 시 지웁니다."""
+    blob_store = BlobStore(BLOB_STORE_MAX_BYTES, BLOB_STORE_DISK_MAX_BYTES, tempfile.mkdtemp(prefix="faust-blobs-"))
+    atexit.register(blob_store.close)
+    return blob_store
+
+blob_store = get_blob_store() # 작업 스레드(요약, 토큰 추정 등)에서도 사용하므로 모듈 수준에서 가져옴
+
+class ChatMessage:
+    """
+    chat_history의 메시지 하나. 이미지 바이트는 BlobStore에 두고 digest만 가지므로,
+    같은 이미지를 여러 대화/세션이 가지고 있어도 한 번만 보관되고 메시지가 메모리 한도를 늘리지 않습니다.
+    """
+    __slots__ = ("role", "text", "image_digest", "image_mime_type", "cloudinary_url", "cloudinary_public_id", "display_digest", "render_spec", "token_estimate", "pending_upload", "usage")
+
+    def __init__(self, role: str, text: str, image_digest: str | None = None, image_mime_type: str | None = None,
+                 cloudinary_url: str | None = None, cloudinary_public_id: str | None = None, display_digest: str | None = None):
+        self.role = role
+        self.text = text
+        self.image_digest = image_digest # Gemini API용 원본 바이트의 BlobStore digest
+        self.image_mime_type = image_mime_type
+        self.cloudinary_url = cloudinary_url # 로그인 사용자 전용
+        self.cloudinary_public_id = cloudinary_public_id # 로그인 사용자 전용 (URL 생성 및 삭제에 사용)
+        self.display_digest = display_digest # 비로그인 사용자 UI 표시용 리사이즈된 바이트의 BlobStore digest
+        self.render_spec = None # get_message_render_spec()이 계산해 두는 표시 정보
+        self.token_estimate = None # estimate_message_tokens()가 계산해 두는 (텍스트 토큰, 이미지 토큰)
+        self.pending_upload = None # 진행 중인 Cloudinary 업로드 Future (완료되면 cloudinary_url/public_id를 채움)
+        self.usage = None # 이 답변을 만드는 데 쓴 토큰 사용량 records (model 메시지만, commit_turn_usage()가 채움)
+
+    @property
+    def image_bytes(self) -> bytes | None:
+        """원본 이미지 바이트 (BlobStore에서 밀려났으면 None)."""
+        return blob_store.get(self.image_digest)
+
+    @property
+    def display_bytes(self) -> bytes | None:
+        return blob_store.get(self.display_digest)
+
+    def to_storage_dict(self) -> dict:
+        """저장소에 기록할 dict로 변환합니다. 이미지 바이트는 저장하지 않습니다."""
+        entry = {"role": self.role, "text": self.text}
+        # 로그인 사용자의 경우, 이미지 바이트는 저장하지 않고 Cloudinary URL과 public_id만 저장
+        if self.cloudinary_url is not None:
+            entry["cloudinary_url"] = self.cloudinary_url
+        if self.cloudinary_public_id is not None:
+            entry["cloudinary_public_id"] = self.cloudinary_public_id
+        if self.usage:
+            entry["usage"] = self.usage
+        return entry
+
+    @staticmethod
+    def from_storage_dict(entry: dict):
+        """저장소의 dict로부터 메시지를 만듭니다 (이미지 바이트는 저장되지 않았으므로 없음)."""
+        message = ChatMessage(entry["role"], entry["text"],
+                              cloudinary_url=entry.get("cloudinary_url"), cloudinary_public_id=entry.get("cloudinary_public_id"))
+        message.usage = entry.get("usage")
+        return message
+
+def new_chat_message(role: str, text: str, image_bytes: bytes | None = None, image_mime_type: str | None = None,
+                     cloudinary_url: str | None = None, cloudinary_public_id: str | None = None,
+                     display_bytes: bytes | None = None) -> ChatMessage:
+    """바이트를 BlobStore에 넣고 그 digest를 가진 메시지를 만듭니다."""
+    return ChatMessage(role, text, blob_store.put(image_bytes), image_mime_type,
+                       cloudinary_url, cloudinary_public_id, blob_store.put(display_bytes))
+
+# --- Content-addressed Upload Cache ---
+@dataclass
+class ProcessedUpload:
+    """
+    업로드 파일 하나를 처리한 결과. 같은 내용의 파일이 다시 업로드되면 재사용됩니다.
+    cloudinary_uploads는 사용자별로 보관하여, 한 사용자가 대화를 삭제해도 다른 사용자의 이미지가 지워지지 않도록 합니다.
+    """
+    gemini_parts: list # 이번 턴에 Gemini로 보낼 Part 리스트 (이미지 또는 PDF 페이지들)
+    history_image_bytes: bytes | None # chat_history에 저장할 이미지 바이트 (PDF는 첫 페이지)
+    history_mime_type: str | None
+    display_bytes: bytes | None = None # resize_image_for_display 결과
+    cloudinary_uploads: dict | None = None # user_id -> 업로드 Future (결과는 (secure_url, public_id) 또는 실패 시 None)
+    summary: str = "" # PDF 처리 요약 등 표시용 문자열
+    total_pages: int = 0 # PDF 전체 페이지 수 (처리 한도 초과 경고용)
+    omitted_pages: int = 0 # 메모리 예산(PDF_PARTS_MEMORY_BUDGET_BYTES)을 넘어 전달하지 않은 PDF 페이지 수
+
+    def size_bytes(self) -> int:
+        """캐시 예산 계산용 대략적인 크기 (바이트). gemini_parts와 history_image_bytes가 같은 버퍼를 공유하면 한 번만 셉니다."""
+        buffers = [self.history_image_bytes, self.display_bytes]
+        buffers.extend(part.inline_data.data for part in self.gemini_parts if part.inline_data is not None)
+        unique_buffers = {id(buffer): buffer for buffer in buffers if buffer}
+        size = sum(len(buffer) for buffer in unique_buffers.values())
+        size += sum(len(part.text) for part in self.gemini_parts if part.inline_data is None and part.text)
+        return size
+
+class UploadCache:
+    """
+    파일 내용의 해시로 키를 잡는 LRU 캐시. 전체 크기가 max_bytes를 넘으면 가장 오래 사용되지 않은 항목부터 제거합니다.
+    st.cache_resource로 모든 세션이 공유하므로 모든 접근은 lock으로 보호합니다.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hit_count = 0
+        self.miss_count = 0
+        self._entries = OrderedDict() # key -> (ProcessedUpload, size_bytes)
+        self._lock = threading.Lock()
+
+    def get(self, key) -> ProcessedUpload | None:
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is None:
+                self.miss_count += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hit_count += 1
+            return cached[0]
+
+    def put(self, key, processed_upload: ProcessedUpload):
+        """항목을 저장(또는 크기를 갱신)하고 예산을 넘으면 LRU 항목을 제거합니다."""
+        size_bytes = processed_upload.size_bytes()
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            if size_bytes > self.max_bytes: # 예산보다 큰 항목은 캐시하지 않음
+                return
+            self._entries[key] = (processed_upload, size_bytes)
+            self.current_bytes += size_bytes
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+
+    def forget_cloudinary_public_ids(self, public_ids, upload_futures=()):
+        """
+        Cloudinary에서 삭제된 public_id(또는 완료 후 삭제될 진행 중인 업로드)를 캐시에서 제거하여 다시 사용되지 않도록 합니다.
+        """
+        public_ids = set(public_ids)
+        upload_futures = set(upload_futures)
+        with self._lock:
+            for processed_upload, _ in self._entries.values():
+                if processed_upload.cloudinary_uploads:
+                    for user_id, upload_future in list(processed_upload.cloudinary_uploads.items()):
+                        if upload_future in upload_futures or (
+                                upload_future.done() and upload_future.result() and upload_future.result()[1] in public_ids):
+                            del processed_upload.cloudinary_uploads[user_id]
+
+    def get_display_bytes(self, processed_upload: ProcessedUpload) -> bytes:
+        """
+        표시용 리사이즈 이미지를 반환합니다 (캐시에 없을 때만 리사이즈).
+        리사이즈는 lock 밖에서 하고, 다른 세션이 먼저 채웠다면 그 결과를 사용합니다.
+        """
+        with self._lock:
+            display_bytes = processed_upload.display_bytes
+        if display_bytes is not None:
+            return display_bytes
+        display_bytes = resize_image_for_display(processed_upload.history_image_bytes, LOCAL_DISPLAY_WIDTH)
+        with self._lock:
+            if processed_upload.display_bytes is None:
+                processed_upload.display_bytes = display_bytes
+            return processed_upload.display_bytes
+
+    def get_cloudinary_upload(self, processed_upload: ProcessedUpload, user_id: str) -> Future:
+        """
+        이 사용자가 같은 파일을 이미 업로드했거나 업로드 중이면 그 Future를 재사용하고,
+        아니면 백그라운드 업로드를 시작합니다 (이전 업로드가 실패한 경우 다시 시도).
+        같은 항목을 여러 세션이 동시에 사용하므로 확인과 등록을 lock 안에서 함께 처리하여 중복 업로드를 막습니다.
+        """
+        with self._lock:
+            if processed_upload.cloudinary_uploads is None:
+                processed_upload.cloudinary_uploads = {}
+            upload_future = processed_upload.cloudinary_uploads.get(user_id)
+            if upload_future is None or (upload_future.done() and upload_future.result() is None):
+                upload_future = get_cloudinary_upload_executor().submit(tracer.bind(upload_to_cloudinary), processed_upload.history_image_bytes)
+                processed_upload.cloudinary_uploads[user_id] = upload_future
+            return upload_future
+
+@st.cache_resource
+def get_upload_cache() -> UploadCache:
+    """모든 세션이 공유하는 업로드 처리 결과 캐시를 반환합니다."""
+    return UploadCache(UPLOAD_CACHE_MAX_BYTES)
+
+def start_cloudinary_upload(upload_cache: UploadCache, processed_upload: ProcessedUpload,
+                            user_id: str) -> tuple[str | None, str | None, Future | None]:
+    """
+    (URL, public_id, 진행 중인 Future)를 반환합니다. 이미 업로드된 파일이면 URL/public_id를 바로 반환하고,
+    아니면 업로드를 백그라운드로 넘기고 Future를 반환합니다 (대화는 업로드를 기다리지 않고 진행).
+    """
+    upload_future = upload_cache.get_cloudinary_upload(processed_upload, user_id)
+    if upload_future.done() and upload_future.result():
+        cloudinary_url, public_id = upload_future.result()
+        return cloudinary_url, public_id, None
+    return None, None, upload_future
+
+@st.cache_resource
+def get_pdf_render_pool() -> ProcessPoolExecutor | None:
+    """모든 세션이 공유하는 PDF 렌더링 프로세스 풀을 반환합니다 (작업 프로세스는 업로드 사이에 재사용)."""
+    return create_render_pool(PDF_RENDER_MAX_WORKERS)
+
+@tracer.traced("pdf.process")
+def process_pdf_upload(file_data: bytes, ingestion_mode: str) -> ProcessedUpload:
+    """PDF를 페이지 Part 리스트로 변환합니다. 첫 페이지 이미지는 chat_history 기록/표시용으로 함께 반환합니다."""
+    try:
+        return _process_pdf_upload(file_data, ingestion_mode, get_pdf_render_pool())
+    except BrokenProcessPool as e: # 작업 프로세스가 비정상 종료되면 풀을 새로 만들도록 버리고, 이번에는 현재 프로세스에서 렌더링
+        print(f"PDF 렌더링 프로세스 풀이 중단되어 현재 프로세스에서 다시 렌더링합니다: {e}")
+        get_pdf_render_pool.clear()
+        return _process_pdf_upload(file_data, ingestion_mode, None)
+
+def _process_pdf_upload(file_data: bytes, ingestion_mode: str, render_pool: ProcessPoolExecutor | None) -> ProcessedUpload:
+    pdf_render_stats = PdfRenderStats()
+    gemini_parts = []
+    first_page_image_bytes_raw = None # PDF 첫 페이지 이미지 바이트 (chat_history용)
+
+    # 공유 프로세스 풀에서 병렬 렌더링된 페이지를 순서대로 하나씩 받아옴 (메모리 예산 내에서만 앞서 렌더링)
+    # text_first 모드에서는 텍스트 레이어가 있는 페이지는 텍스트로, 이미지 위주 페이지만 적응형 DPI로 래스터화됨
+    # 받은 페이지는 모두 보관하므로, 보관한 Part의 합계가 PDF_PARTS_MEMORY_BUDGET_BYTES를 넘기 전에 멈춤
+    for rendered_page in iter_rendered_pdf_pages(
+        file_data,
+        MAX_PDF_PAGES_TO_PROCESS,
+        dpi=PDF_RENDER_DPI,
+        max_workers=PDF_RENDER_MAX_WORKERS,
+        memory_budget_bytes=PDF_RENDER_MEMORY_BUDGET_BYTES,
+        mode=ingestion_mode,
+        stats=pdf_render_stats,
+        executor=render_pool,
+        output_budget_bytes=PDF_PARTS_MEMORY_BUDGET_BYTES
+    ):
+        if rendered_page.png_bytes is None: # 텍스트 레이어로 전달하는 페이지
+            gemini_parts.append(types.Part(
+                text=f"[PDF {rendered_page.page_num + 1}페이지]\n{rendered_page.text}"
+            ))
+        else:
+            # base64 문자열 사본을 따로 보관하지 않도록 바이트를 그대로 전달 (SDK가 전송 시 인코딩)
+            gemini_parts.append(types.Part(
+                inline_data=types.Blob(
+                    mime_type="image/png", # PDF 페이지는 PNG로 변환됨
+                    data=rendered_page.png_bytes
+                )
+            ))
+
+        if rendered_page.page_num == 0: # 첫 페이지만 chat_history에 저장할 이미지로 지정
+            # 첫 페이지가 텍스트로 전달된 경우 표시/기록용 저해상도 미리보기를 따로 렌더링
+            first_page_image_bytes_raw = rendered_page.png_bytes or render_pdf_page_preview(file_data, 0, PDF_PREVIEW_DPI)
+
+    tracer.current_span().set_attributes(mode=ingestion_mode, total_pages=pdf_render_stats.total_pages,
+                                         parts=len(gemini_parts), summary=pdf_render_stats.summary())
+    return ProcessedUpload(
+        gemini_parts=gemini_parts,
+        history_image_bytes=first_page_image_bytes_raw,
+        history_mime_type="image/png" if first_page_image_bytes_raw else None,
+        summary=pdf_render_stats.summary(),
+        total_pages=pdf_render_stats.total_pages,
+        omitted_pages=pdf_render_stats.budget_truncated_pages
+    )
 
 # --- Cloudinary Upload Helper Function ---
+@st.cache_resource
+def get_cloudinary_upload_executor() -> ThreadPoolExecutor:
+    """모든 세션이 공유하는 Cloudinary 업로드용 스레드 풀을 반환합니다."""
+    return ThreadPoolExecutor(max_workers=CLOUDINARY_UPLOAD_MAX_WORKERS, thread_name_prefix="faust-cloudinary-upload")
+
+@tracer.traced("cloudinary.upload")
 def upload_to_cloudinary(image_bytes: bytes) -> tuple[str, str] | None:
     """
     바이트 형태의 이미지를 Cloudinary에 업로드하고 (URL, Public ID) 튜플을 반환합니다.
-    (명령어 실행 환경: 가상환경 내에서 Streamlit 앱이 실행될 때)
+    업로드 스레드 풀에서 실행되므로 st.*를 호출하지 않고, 실패하면 None을 반환합니다
+    (사용자에게는 apply_finished_cloudinary_uploads()가 요청 스레드에서 알립니다).
     """
+    tracer.current_span().set_attribute("bytes", len(image_bytes))
     try:
         # Cloudinary에 업로드 시 public_id를 지정하여 추후 삭제를 용이하게 함
         public_id = f"faust_image_{uuid.uuid4()}" # 고유한 public_id 생성
@@ -260,74 +991,612 @@ def upload_to_cloudinary(image_bytes: bytes) -> tuple[str, str] | None:
         if result and "secure_url" in result and "public_id" in result:
             return result["secure_url"], result["public_id"]
         else:
-            st.error(f"Cloudinary 업로드 실패: 응답 형식이 올바르지 않습니다. {result}")
+            print(f"Cloudinary 업로드 실패: 응답 형식이 올바르지 않습니다. {result}")
             return None
     except cloudinary.exceptions.Error as e:
-        st.error(f"Cloudinary API 호출 중 오류 발생: {e}")
+        print(f"Cloudinary API 호출 중 오류 발생: {e}")
         return None
     except Exception as e:
-        st.error(f"Cloudinary 업로드 중 예상치 못한 오류 발생: {e}")
+        print(f"Cloudinary 업로드 중 예상치 못한 오류 발생: {e}")
         return None
 
+def apply_finished_cloudinary_uploads(wait_timeout: float = 0.0) -> bool:
+    """
+    완료된 백그라운드 업로드의 URL/public_id를 메시지에 채웁니다 (요청 스레드에서 호출).
+    wait_timeout이 주어지면 진행 중인 업로드를 그 시간만큼 기다립니다. 하나라도 반영되면 True를 반환합니다.
+    """
+    pending_messages = st.session_state.pending_cloudinary_uploads
+    if not pending_messages:
+        return False
+    if wait_timeout > 0:
+        wait([message.pending_upload for message in pending_messages], timeout=wait_timeout)
+    still_pending = []
+    applied = False
+    for message in pending_messages:
+        if not message.pending_upload.done():
+            still_pending.append(message)
+            continue
+        upload_result = message.pending_upload.result()
+        message.pending_upload = None
+        if upload_result:
+            message.cloudinary_url, message.cloudinary_public_id = upload_result
+            message.display_digest = None # 이제 Cloudinary URL로 표시하므로 리사이즈 이미지는 쓰지 않음
+            message.render_spec = None
+            applied = True
+        else:
+            st.warning("로그인 상태이지만 Cloudinary 업로드에 실패했습니다. 이미지는 현재 세션에만 임시 저장됩니다.")
+    st.session_state.pending_cloudinary_uploads = still_pending
+    return applied
+
+def persist_cloudinary_upload_when_finished(message: ChatMessage, user_id: str):
+    """
+    업로드가 끝나면 (다음 실행을 기다리지 않고) 메시지에 URL/public_id를 채우고 그 메시지가 있는 대화의 저장을 예약합니다.
+    사용자가 업로드 완료 전에 페이지를 떠나도 public_id가 저장소에 남아, 대화를 삭제할 때 이미지도 함께 삭제됩니다.
+    업로드 스레드에서 콜백으로 실행되므로 요청 스레드에서 얻은 객체만 사용합니다.
+    """
+    upload_future = message.pending_upload
+    saved_sessions = st.session_state.saved_sessions
+    system_instructions = st.session_state.system_instructions
+    store = get_conversation_store(user_id)
+    persistence_queue = get_persistence_queue()
+
+    def on_upload_finished(finished_future: Future):
+        upload_result = finished_future.result()
+        if not upload_result:
+            return # 실패 안내는 apply_finished_cloudinary_uploads()가 요청 스레드에서 표시
+        message.cloudinary_url, message.cloudinary_public_id = upload_result
+        for title, history in saved_sessions.loaded_items():
+            if title != "새로운 대화" and any(history_message is message for history_message in history):
+                persistence_queue.submit_conversation(user_id, store, title, system_instructions.get(title, default_system_instruction),
+                                                      [history_message.to_storage_dict() for history_message in history])
+                # 아직 저장되지 않은 대화(제목 생성 전 등)는 이후 요청 스레드의 저장에 채운 public_id가 포함됨
+    upload_future.add_done_callback(on_upload_finished)
+
 # --- Cloudinary Delete Helper Function ---
-def delete_from_cloudinary(public_id: str):
+@dataclass
+class CloudinaryDeleteLedgerEntry:
+    """삭제 대기 중이거나 재시도 중인 public_id 하나의 상태."""
+    attempts: int = 0
+    next_attempt_at: float = 0.0 # time.monotonic() 기준
+    last_error: str = ""
+
+class CloudinaryDeleteQueue:
     """
-    Cloudinary에서 지정된 public_id를 가진 이미지를 삭제합니다.
-    (명령어 실행 환경: 가상환경 내에서 Streamlit 앱이 실행될 때)
+    Cloudinary 이미지 삭제를 요청 경로에서 분리하는 백그라운드 큐.
+    public_id를 재시도 장부(ledger)에 모아 CLOUDINARY_DELETE_BATCH_SIZE개씩 delete_resources 한 번으로 삭제하고,
+    실패한 id는 장부에 남겨 지수 백오프로 재시도합니다. 최대 시도 횟수를 넘긴 id는 abandoned로 옮겨 설정 패널에서 다시 시도할 수 있습니다.
+    database가 주어지면 장부를 cloudinary_deletes 테이블에도 기록하여, 프로세스가 재시작되어도 남은 삭제를 이어서 시도합니다.
     """
-    if not is_cloudinary_configured:
-        print("Cloudinary가 설정되지 않아 이미지 삭제를 건너뜁니다.")
-        return
 
-    try:
-        # public_ids는 리스트 형태로 전달해야 함
-        result = cloudinary.api.delete_resources([public_id], resource_type="image")
+    def __init__(self, delete_resources=None, database: "LocalDatabase | None" = None):
+        # delete_resources(public_ids) -> Cloudinary 응답 dict (테스트에서 가짜 함수를 넣을 수 있음)
+        self._delete_resources = delete_resources or (lambda public_ids: cloudinary.api.delete_resources(public_ids, resource_type="image"))
+        self._database = database
+        self.ledger = {} # public_id -> CloudinaryDeleteLedgerEntry
+        self.abandoned = {} # public_id -> 마지막 오류 메시지
+        self._in_flight = set()
+        self._condition = threading.Condition()
+        self.deleted_count = 0
+        self.request_count = 0
+        self.retry_count = 0
+        self._load_ledger()
+        self._thread = threading.Thread(target=self._run, name="faust-cloudinary-delete", daemon=True)
+        self._thread.start()
+
+    def _load_ledger(self):
+        """이전 실행에서 끝내지 못한 삭제를 장부로 불러옵니다."""
+        if self._database is None:
+            return
+        for public_id, attempts, last_error, abandoned in self._database.connect().execute(
+                "SELECT public_id, attempts, last_error, abandoned FROM cloudinary_deletes"):
+            if abandoned:
+                self.abandoned[public_id] = last_error or ""
+            else:
+                self.ledger[public_id] = CloudinaryDeleteLedgerEntry(attempts=attempts, last_error=last_error or "")
+        if self.ledger or self.abandoned:
+            print(f"이전 실행에서 남은 Cloudinary 삭제 {len(self.ledger)}개를 다시 시도합니다 (포기한 삭제 {len(self.abandoned)}개).")
+
+    def _record(self, sql: str, rows: list):
+        """장부 변경을 로컬 저장소에 기록합니다. 기록에 실패해도 메모리의 장부로 삭제는 계속합니다."""
+        if self._database is None or not rows:
+            return
+        try:
+            with self._database.connect() as connection:
+                connection.executemany(sql, rows)
+        except sqlite3.Error as e:
+            print(f"Cloudinary 삭제 장부 기록 실패 ({len(rows)}개): {e}")
+
+    def enqueue(self, public_ids):
+        public_ids = list(public_ids)
+        self._record("INSERT INTO cloudinary_deletes (public_id) VALUES (?) "
+                     "ON CONFLICT (public_id) DO UPDATE SET abandoned = 0", [(public_id,) for public_id in public_ids])
+        with self._condition:
+            for public_id in public_ids:
+                self.abandoned.pop(public_id, None)
+                if public_id not in self.ledger:
+                    self.ledger[public_id] = CloudinaryDeleteLedgerEntry()
+            self._condition.notify_all()
+
+    def retry_abandoned(self):
+        """최대 시도 횟수를 넘겨 포기한 삭제를 다시 시도합니다."""
+        with self._condition:
+            abandoned_ids = list(self.abandoned)
+        self.enqueue(abandoned_ids)
+
+    def depth(self) -> int:
+        with self._condition:
+            return len(self.ledger)
+
+    def flush(self, timeout: float = CLOUDINARY_DELETE_FLUSH_TIMEOUT_SECONDS) -> bool:
+        """대기 중인 삭제를 즉시 시도하고, 재시도 대기가 아닌 id가 모두 처리될 때까지 기다립니다."""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            for entry in self.ledger.values():
+                entry.next_attempt_at = 0.0
+            self._condition.notify_all()
+            while any(entry.attempts == 0 for entry in self.ledger.values()) or self._in_flight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return True
+
+    def _next_batch(self) -> list:
+        """삭제할 때가 된 id를 최대 CLOUDINARY_DELETE_BATCH_SIZE개 꺼냅니다. 없으면 대기합니다 (lock을 잡은 상태에서 호출)."""
+        while True:
+            now = time.monotonic()
+            waiting = [(entry.next_attempt_at, public_id) for public_id, entry in self.ledger.items() if public_id not in self._in_flight]
+            due_ids = [public_id for next_attempt_at, public_id in waiting if next_attempt_at <= now]
+            if due_ids:
+                batch = due_ids[:CLOUDINARY_DELETE_BATCH_SIZE]
+                self._in_flight.update(batch)
+                return batch
+            self._condition.wait(min(waiting)[0] - now if waiting else None)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                batch = self._next_batch()
+
+            error = None
+            deleted = {}
+            try:
+                result = self._delete_resources(batch) or {}
+                deleted = result.get("deleted") or {}
+                error = result.get("error")
+            except Exception as e:
+                error = e
+
+            finished_ids = []
+            failed_rows = [] # (attempts, last_error, abandoned, public_id)
+            with self._condition:
+                self.request_count += 1
+                for public_id in batch:
+                    self._in_flight.discard(public_id)
+                    entry = self.ledger.get(public_id)
+                    if entry is None:
+                        continue
+                    status = deleted.get(public_id)
+                    if status in ("deleted", "not_found"): # 이미 없는 이미지도 삭제된 것으로 처리
+                        del self.ledger[public_id]
+                        self.deleted_count += 1
+                        finished_ids.append((public_id,))
+                        continue
+                    entry.attempts += 1
+                    entry.last_error = str(error or status or "응답에 결과가 없습니다")
+                    abandoned = entry.attempts >= CLOUDINARY_DELETE_MAX_ATTEMPTS
+                    failed_rows.append((entry.attempts, entry.last_error, int(abandoned), public_id))
+                    if abandoned:
+                        del self.ledger[public_id]
+                        self.abandoned[public_id] = entry.last_error
+                        print(f"Cloudinary 이미지 '{public_id}' 삭제를 {entry.attempts}회 실패하여 포기합니다: {entry.last_error}")
+                    else:
+                        entry.next_attempt_at = time.monotonic() + min(
+                            CLOUDINARY_DELETE_RETRY_BASE_SECONDS * 2 ** (entry.attempts - 1), CLOUDINARY_DELETE_RETRY_MAX_SECONDS)
+                        self.retry_count += 1
+                print(f"Cloudinary 이미지 {len(batch)}개 삭제 요청 완료 (남은 대기 {len(self.ledger)}개).")
+                self._condition.notify_all()
+            self._record("DELETE FROM cloudinary_deletes WHERE public_id = ?", finished_ids)
+            self._record("UPDATE cloudinary_deletes SET attempts = ?, last_error = ?, abandoned = ? WHERE public_id = ?", failed_rows)
+
+    def shutdown(self):
+        """프로세스 종료 시 남은 삭제를 시도하고, 끝내지 못한 id는 로그에 남깁니다 (장부에 기록되어 있으면 다음 실행에서 재시도)."""
+        self.flush()
+        with self._condition:
+            remaining_ids = sorted(self.ledger) # 재시도 대기 중인 id 포함
+        if not remaining_ids:
+            return
+        destination = "로컬 저장소 장부에 남아 다음 실행에서 재시도" if self._database is not None else "장부가 저장되지 않아 삭제되지 않음"
+        print(f"종료 전 Cloudinary 이미지 {len(remaining_ids)}개를 삭제하지 못했습니다 ({destination}): {', '.join(remaining_ids)}")
 
-        # delete_resources의 반환값 구조를 고려하여 성공 여부 확인
-        if result and public_id in result.get("deleted", []): # 수정된 부분: result.get("result") == "ok" 대신 public_id in result.get("deleted", []) 확인
-            print(f"Cloudinary에서 이미지 '{public_id}' 삭제 성공.")
-        else:
-            print(f"Cloudinary에서 이미지 '{public_id}' 삭제 실패: {result.get('error', result)}") # 실패 시 더 자세한 에러 메시지 출력
-    except cloudinary.exceptions.Error as e:
-        print(f"Cloudinary 이미지 삭제 중 API 오류 발생: {e}")
-    except Exception as e:
-        print(f"Cloudinary 이미지 삭제 중 예상치 못한 오류 발생: {e}")
+@st.cache_resource
+def get_cloudinary_delete_queue() -> CloudinaryDeleteQueue:
+    """모든 세션이 공유하는 Cloudinary 삭제 큐를 반환합니다. 장부는 로컬 저장소에 기록하고, 프로세스 종료 시 남은 삭제를 시도합니다."""
+    delete_queue = CloudinaryDeleteQueue(database=get_local_database())
+    atexit.register(delete_queue.shutdown)
+    return delete_queue
+
+def delete_from_cloudinary_when_uploaded(upload_future: Future, upload_cache: UploadCache):
+    """
+    진행 중인 업로드가 끝나면 그 이미지를 삭제합니다 (업로드가 끝나기 전에 대화가 삭제된 경우).
+    업로드 스레드에서 콜백으로 실행되므로 요청 스레드에서 얻은 객체만 사용합니다.
+    """
+    delete_queue = get_cloudinary_delete_queue()
+    upload_cache.forget_cloudinary_public_ids((), upload_futures=[upload_future])
+
+    def delete_uploaded(finished_future: Future):
+        upload_result = finished_future.result()
+        if upload_result:
+            delete_queue.enqueue([upload_result[1]])
+    upload_future.add_done_callback(delete_uploaded)
 
+@tracer.traced("history.convert")
 def convert_to_gemini_format_for_contents(chat_history_list):
     """
-    Streamlit chat history (list of (role, text, optional_image_bytes_raw, optional_image_mime_type, optional_cloudinary_url, optional_cloudinary_public_id, optional_image_bytes_display_resized) tuples)를
-    Gemini API의 `Content` 객체 리스트로 변환합니다.
+    Streamlit chat history (ChatMessage 리스트)를 Gemini API의 `Content` 객체 리스트로 변환합니다.
     """
     gemini_contents = []
-    for item in chat_history_list:
-        role = item[0]
-        text = item[1]
-        image_bytes_raw = item[2] if len(item) > 2 else None # optional_image_bytes_raw
-        image_mime_type = item[3] if len(item) > 3 else None # optional_image_mime_type
-
-        parts = [types.Part(text=text)]
+    for message in chat_history_list:
+        parts = [types.Part(text=message.text)]
 
         # 이미지 데이터가 포함되어 있다면 Part에 추가 (Gemini에는 항상 원본 바이트 전달)
-        if image_bytes_raw and image_mime_type:
-            parts.insert(0, types.Part( # 이미지 파트를 먼저 넣는 것이 권장될 수 있음
-                inline_data=types.Blob(
-                    mime_type=image_mime_type,
-                    data=base64.b64encode(image_bytes_raw).decode('utf-8')
-                )
-            ))
-        gemini_contents.append(types.Content(parts=parts, role=role))
+        if message.image_digest is not None and message.image_mime_type:
+            image_bytes = message.image_bytes
+            if image_bytes is None: # BlobStore의 메모리/디스크 예산을 넘어 오래된 이미지가 삭제된 경우
+                parts.insert(0, types.Part(text="[이전에 첨부된 이미지는 더 이상 보관되어 있지 않습니다]"))
+            else:
+                parts.insert(0, types.Part( # 이미지 파트를 먼저 넣는 것이 권장될 수 있음
+                    inline_data=types.Blob(
+                        mime_type=message.image_mime_type,
+                        data=image_bytes # base64 사본을 만들지 않고 BlobStore의 바이트를 그대로 전달 (SDK가 전송 시 인코딩)
+                    )
+                ))
+        gemini_contents.append(types.Content(parts=parts, role=message.role))
+    tracer.current_span().set_attribute("messages", len(gemini_contents))
     return gemini_contents
 
-def create_new_chat_session(model_name: str, current_history: list, system_instruction: str):
+# --- Gemini Context Cache ---
+class LocalCachedContentService:
+    """
+    gemini_client.caches와 같은 인터페이스(create/get/update/delete/list)를 가진 메모리 내 가짜 캐시 서비스입니다.
+    CONTEXT_CACHE_BACKEND = "local"일 때나 테스트에서 Gemini API 없이 캐시 동작을 확인하는 데 사용합니다.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.entries = {} # name -> (CachedContent, CreateCachedContentConfig)
+        self.create_count = 0
+        self._lock = threading.Lock()
+
+    def _expire_time(self, ttl: str) -> datetime.datetime:
+        return datetime.datetime.fromtimestamp(self.clock() + float(ttl.rstrip("s")), tz=datetime.timezone.utc)
+
+    def create(self, model: str, config: types.CreateCachedContentConfig) -> types.CachedContent:
+        token_count = estimate_text_tokens(str(config.system_instruction or "")) \
+            + sum(estimate_content_tokens(content) for content in config.contents or [])
+        if token_count < CONTEXT_CACHE_MIN_TOKENS.get(model, 0):
+            raise ValueError(f"캐시하기에 토큰 수가 부족합니다: {token_count}")
+        with self._lock:
+            self.create_count += 1
+            cached_content = types.CachedContent(
+                name=f"cachedContents/local-{self.create_count}",
+                display_name=config.display_name,
+                model=model,
+                expire_time=self._expire_time(config.ttl),
+                usage_metadata=types.CachedContentUsageMetadata(total_token_count=token_count)
+            )
+            self.entries[cached_content.name] = (cached_content, config)
+        return cached_content
+
+    def get(self, name: str) -> types.CachedContent:
+        with self._lock:
+            cached_content, _ = self.entries[name]
+        if cached_content.expire_time.timestamp() <= self.clock():
+            self.delete(name)
+            raise KeyError(name)
+        return cached_content
+
+    def update(self, name: str, config: types.UpdateCachedContentConfig) -> types.CachedContent:
+        cached_content = self.get(name)
+        cached_content.expire_time = self._expire_time(config.ttl)
+        return cached_content
+
+    def delete(self, name: str):
+        with self._lock:
+            self.entries.pop(name, None)
+
+    def list(self) -> list:
+        with self._lock:
+            return [cached_content for cached_content, _ in self.entries.values()]
+
+def estimate_content_tokens(content: types.Content) -> int:
+    """Gemini Content 하나의 토큰 수를 추정합니다 (이미지는 헤더만 읽어 크기로 계산)."""
+    token_count = 0
+    for part in content.parts or []:
+        if part.text:
+            token_count += estimate_text_tokens(part.text)
+        elif part.inline_data is not None and part.inline_data.data:
+            try:
+                width, height = Image.open(io.BytesIO(part.inline_data.data)).size
+                token_count += estimate_image_tokens(width, height)
+            except Exception:
+                token_count += estimate_image_tokens(768, 768)
+    return token_count
+
+@dataclass
+class ContextCacheEntry:
+    name: str
+    token_count: int
+    expire_at: float
+
+class ContextCacheRegistry:
+    """
+    안정적인 프롬프트 프리픽스(시스템 명령어 + 선택적으로 오래된 대화 이력)마다 Gemini 캐시 핸들을 만들어 재사용합니다.
+    - 키는 모델 + 프리픽스 내용의 해시이므로, 같은 시스템 프롬프트/Supervisor 페르소나는 모든 세션이 같은 캐시를 씁니다.
+    - 사용할 때 남은 TTL이 짧으면 연장하고, 만료 직전의 캐시는 버리고 새로 만듭니다.
+    - 모델별 최소 토큰 수보다 작은 프리픽스는 캐시하지 않으며, 생성에 실패한 프리픽스는 한동안 다시 시도하지 않습니다.
+    - 같은 프리픽스를 다른 스레드가 만드는 중이면 기다리지 않고 None을 반환합니다 (그 요청은 캐시 없이 전송).
+    - executor가 있으면 캐시 생성/TTL 연장/삭제 같은 원격 호출을 요청 경로 밖에서 처리합니다.
+      처음 본 프리픽스는 캐시 생성을 맡기고 None을 반환하므로, 그 요청은 캐시 없이 보내고 다음 요청부터 캐시를 씁니다.
+    여러 스레드(Supervisor 평가 등)에서 동시에 호출됩니다.
+    """
+
+    def __init__(self, service, clock=time.time, executor: ThreadPoolExecutor | None = None):
+        self.service = service # gemini_client.caches 또는 LocalCachedContentService
+        self.clock = clock
+        self.executor = executor
+        self.entries = OrderedDict() # key -> ContextCacheEntry (LRU 순서)
+        self.failed_until = {} # key -> 다시 시도할 수 있는 시각
+        self.creating = set()
+        self.content_digests = {} # id(Content) -> (weakref, digest, token_count)
+        self._lock = threading.Lock()
+        self.created_count = 0
+        self.reused_count = 0
+        self.refreshed_count = 0
+        self.failed_count = 0
+        self.skipped_count = 0 # 최소 토큰 수에 못 미쳐 캐시하지 않은 요청 수
+        self.cached_token_count = 0 # 캐시에서 제공된 (다시 보내지 않은) 입력 토큰 누계
+
+    def describe_content(self, content: types.Content) -> tuple:
+        """Content의 (해시, 추정 토큰 수)를 반환합니다. 같은 객체는 한 번만 계산합니다."""
+        with self._lock:
+            memo = self.content_digests.get(id(content))
+            if memo is not None and memo[0]() is content:
+                return memo[1], memo[2]
+        digest = hashlib.sha256(content.model_dump_json(exclude_none=True).encode("utf-8")).hexdigest()
+        token_count = estimate_content_tokens(content)
+        with self._lock:
+            if len(self.content_digests) > 4096: # 이미 사라진 객체의 항목 정리
+                self.content_digests = {k: v for k, v in self.content_digests.items() if v[0]() is not None}
+            self.content_digests[id(content)] = (weakref.ref(content), digest, token_count)
+        return digest, token_count
+
+    @tracer.traced("context_cache.get_or_create")
+    def get_or_create(self, kind: str, model_name: str, system_instruction: str, contents: list | None = None) -> str | None:
+        """system_instruction(+contents) 프리픽스의 캐시 이름을 반환합니다. 캐시할 수 없으면 None을 반환합니다."""
+        tracer.current_span().set_attributes(kind=kind, model=model_name)
+        prefix_hasher = hashlib.sha256(system_instruction.encode("utf-8"))
+        token_count = estimate_text_tokens(system_instruction)
+        for content in contents or []:
+            content_digest, content_tokens = self.describe_content(content)
+            prefix_hasher.update(content_digest.encode("ascii"))
+            token_count += content_tokens
+        if token_count < CONTEXT_CACHE_MIN_TOKENS.get(model_name, 0):
+            with self._lock:
+                self.skipped_count += 1
+            return None
+        key = (model_name, prefix_hasher.hexdigest())
+        now = self.clock()
+
+        stale_name = None
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.expire_at - now < CONTEXT_CACHE_EXPIRY_MARGIN_SECONDS:
+                del self.entries[key] # 곧 만료되는 캐시는 버리고 새로 생성
+                stale_name, entry = entry.name, None
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.reused_count += 1
+                self.cached_token_count += entry.token_count
+                refresh = entry.expire_at - now < CONTEXT_CACHE_REFRESH_SECONDS
+                if refresh:
+                    entry.expire_at = now + CONTEXT_CACHE_TTL_SECONDS
+            elif key in self.creating or self.failed_until.get(key, 0) > now:
+                return None
+            else:
+                self.creating.add(key)
+
+        if stale_name is not None:
+            self._run_in_background(self._delete_remote, stale_name)
+        if entry is not None:
+            if refresh: # 목록의 만료 시각은 이미 늘렸고, 연장 요청이 실패하면 그 캐시를 버림
+                if self.executor is None:
+                    return entry.name if self._refresh(entry.name) else None
+                self._run_in_background(self._refresh, entry.name)
+            return entry.name
+
+        if self.executor is not None:
+            self._run_in_background(self._create, kind, model_name, system_instruction,
+                                    list(contents) if contents else None, key, token_count)
+            return None
+        return self._create(kind, model_name, system_instruction, contents, key, token_count)
+
+    def _run_in_background(self, func, *args):
+        if self.executor is None:
+            func(*args)
+        else:
+            self.executor.submit(tracer.bind(func), *args)
+
+    def _refresh(self, name: str) -> bool:
+        try:
+            self.service.update(name=name, config=types.UpdateCachedContentConfig(ttl=f"{CONTEXT_CACHE_TTL_SECONDS}s"))
+            with self._lock:
+                self.refreshed_count += 1
+            return True
+        except Exception as e:
+            print(f"컨텍스트 캐시 TTL 연장 실패 ({name}): {e}")
+            self.discard(name)
+            return False
+
+    @tracer.traced("context_cache.create")
+    def _create(self, kind: str, model_name: str, system_instruction: str, contents: list | None, key: tuple,
+                token_count: int) -> str | None:
+        try:
+            cached_content = self.service.create(
+                model=model_name,
+                config=types.CreateCachedContentConfig(
+                    display_name=f"faust-{kind}",
+                    system_instruction=system_instruction,
+                    contents=list(contents) if contents else None,
+                    ttl=f"{CONTEXT_CACHE_TTL_SECONDS}s",
+                )
+            )
+        except Exception as e:
+            print(f"컨텍스트 캐시 생성 실패 ({kind}, {model_name}): {e}")
+            now = self.clock()
+            with self._lock:
+                self.creating.discard(key)
+                self.failed_until[key] = now + CONTEXT_CACHE_FAILURE_BACKOFF_SECONDS
+                self.failed_count += 1
+            return None
+
+        evicted_names = []
+        now = self.clock()
+        with self._lock:
+            self.creating.discard(key)
+            self.entries[key] = ContextCacheEntry(cached_content.name, token_count, now + CONTEXT_CACHE_TTL_SECONDS)
+            self.created_count += 1
+            while len(self.entries) > CONTEXT_CACHE_MAX_ENTRIES:
+                _, evicted = self.entries.popitem(last=False)
+                evicted_names.append(evicted.name)
+        for name in evicted_names:
+            self._run_in_background(self._delete_remote, name)
+        return cached_content.name
+
+    def discard(self, name: str):
+        """요청이 실패한 캐시(서버에서 이미 만료된 경우 등)를 목록에서 지웁니다."""
+        with self._lock:
+            for key, entry in list(self.entries.items()):
+                if entry.name == name:
+                    del self.entries[key]
+        self._run_in_background(self._delete_remote, name)
+
+    def _delete_remote(self, name: str):
+        try:
+            self.service.delete(name=name)
+        except Exception as e:
+            print(f"컨텍스트 캐시 삭제 실패 ({name}): {e}")
+
+    def close(self):
+        """프로세스 종료 시 남은 캐시를 삭제합니다 (TTL 동안 보관 비용이 나가지 않도록)."""
+        if self.executor is not None: # 진행 중인 생성이 끝난 뒤 함께 삭제
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        with self._lock:
+            names = [entry.name for entry in self.entries.values()]
+            self.entries.clear()
+        for name in names:
+            self._delete_remote(name)
+
+    def stats(self) -> str:
+        return (f"캐시 {len(self.entries)}개, 생성 {self.created_count}회, 재사용 {self.reused_count}회, "
+                f"TTL 연장 {self.refreshed_count}회, 실패 {self.failed_count}회, 최소 토큰 미달 {self.skipped_count}회, "
+                f"캐시로 대체된 입력 토큰 {self.cached_token_count:,}")
+
+@st.cache_resource
+def get_context_cache_registry() -> ContextCacheRegistry | None:
+    """모든 세션이 공유하는 컨텍스트 캐시 레지스트리를 반환합니다 (CONTEXT_CACHE_BACKEND = "off"이면 None)."""
+    if CONTEXT_CACHE_BACKEND == "off":
+        return None
+    if CONTEXT_CACHE_BACKEND == "local":
+        service = LocalCachedContentService()
+    else: # 레지스트리를 만드는 것만으로 Gemini 클라이언트가 생성되지 않도록 함
+        service = LazyProxy("gemini caches", lambda: gemini_client.caches)
+    registry = ContextCacheRegistry(service, executor=ThreadPoolExecutor(
+        max_workers=CONTEXT_CACHE_MAX_WORKERS, thread_name_prefix="faust-context-cache"))
+    atexit.register(registry.close)
+    return registry
+
+context_cache = get_context_cache_registry()
+
+def generate_content_with_cached_prefix(kind: str, model_name: str, system_instruction: str, contents, **config_kwargs):
+    """
+    system_instruction을 컨텍스트 캐시로 보내는 generate_content 호출입니다.
+    캐시를 사용한 요청이 실패하면 해당 캐시를 버리고 시스템 명령어를 직접 담아 한 번 더 요청합니다.
+    """
+    cached_content_name = context_cache.get_or_create(kind, model_name, system_instruction) if context_cache else None
+    if cached_content_name is not None:
+        try:
+            return gemini_client.models.generate_content(
+                model=model_name,
+                contents=contents,
+                config=types.GenerateContentConfig(cached_content=cached_content_name, **config_kwargs)
+            )
+        except Exception as e:
+            print(f"컨텍스트 캐시({cached_content_name})를 사용한 요청 실패, 캐시 없이 재시도: {e}")
+            context_cache.discard(cached_content_name)
+    return gemini_client.models.generate_content(
+        model=model_name,
+        contents=contents,
+        config=types.GenerateContentConfig(system_instruction=system_instruction, **config_kwargs)
+    )
+
+@dataclass
+class CachedChatSessionInfo:
+    """컨텍스트 캐시를 쓰는 ChatSession을 캐시 없이 다시 만들 때 필요한 정보."""
+    cached_content_name: str
+    model_name: str
+    system_instruction: str # SUPER_INTRODUCTION을 붙이기 전의 시스템 명령어
+    history: list # 캐시로 보낸 프리픽스를 포함한 전체 Content 이력
+    failed: bool = False # 이 캐시를 사용한 요청이 실패함 (이 ChatSession은 다시 사용하지 않음)
+
+@st.cache_resource
+def get_cached_chat_sessions() -> weakref.WeakKeyDictionary:
+    """컨텍스트 캐시를 쓰는 ChatSession -> CachedChatSessionInfo (ChatSession은 여러 번의 스크립트 실행에 걸쳐 재사용됨)."""
+    return weakref.WeakKeyDictionary()
+
+cached_chat_sessions = get_cached_chat_sessions() # 스레드 풀 작업에서도 사용하므로 모듈 수준에서 가져옴
+
+@tracer.traced("gemini.create_chat_session")
+def create_new_chat_session(model_name: str, current_history: list, system_instruction: str, converted_history: list | None = None,
+                            use_context_cache: bool = True):
     """
     제공된 모델, 대화 이력, 시스템 명령어를 기반으로 새로운 genai.ChatSession을 생성합니다.
     시스템 명령어는 ChatSession의 config.system_instruction 매개변수로 주입됩니다.
+    converted_history가 주어지면 이미 변환된 Content 리스트를 그대로 사용합니다 (재변환 생략).
+    컨텍스트 캐시를 쓸 수 있으면 시스템 명령어와 최근 CONTEXT_CACHE_RECENT_MESSAGES개 이전의 이력을 캐시로 보내고,
+    ChatSession에는 나머지 이력만 넣습니다. 이 ChatSession에는 send_message_stream_with_cache_fallback()으로 보내야
+    서버에서 캐시가 만료·삭제된 경우에도 캐시 없이 다시 요청할 수 있습니다.
     """
     # FausT의 제 1원칙을 system_instruction에 포함
     full_system_instruction = SUPER_INTRODUCTION_HEAD + system_instruction + SUPER_INTRODUCTION_TAIL
 
     # history를 Gemini Content 포맷으로 변환 (이제 이미지 데이터도 포함될 수 있음)
-    initial_history_gemini_format = convert_to_gemini_format_for_contents(current_history)
+    if converted_history is not None:
+        initial_history_gemini_format = list(converted_history)
+    else:
+        initial_history_gemini_format = convert_to_gemini_format_for_contents(current_history)
+
+    if context_cache is not None and use_context_cache:
+        # 경계를 CONTEXT_CACHE_PREFIX_STEP 단위로만 옮겨 여러 턴 동안 같은 이력 캐시를 재사용 (짝수라 user/model 짝 유지)
+        prefix_length = max(0, len(initial_history_gemini_format) - CONTEXT_CACHE_RECENT_MESSAGES) \
+            // CONTEXT_CACHE_PREFIX_STEP * CONTEXT_CACHE_PREFIX_STEP
+        cached_content_name = None
+        if prefix_length:
+            cached_content_name = context_cache.get_or_create(
+                "history", model_name, full_system_instruction, initial_history_gemini_format[:prefix_length])
+        if cached_content_name is None: # 이력이 짧거나 캐시할 수 없으면 시스템 명령어만 캐시
+            prefix_length = 0
+            cached_content_name = context_cache.get_or_create("system", model_name, full_system_instruction)
+        if cached_content_name is not None:
+            chat_session = gemini_client.chats.create(
+                model=model_name,
+                history=initial_history_gemini_format[prefix_length:],
+                config=types.GenerateContentConfig(cached_content=cached_content_name)
+            )
+            cached_chat_sessions[chat_session] = CachedChatSessionInfo(
+                cached_content_name, model_name, system_instruction, initial_history_gemini_format)
+            return chat_session
 
     # config 객체에 system_instruction을 담아서 전달
     chat_config = types.GenerateContentConfig(
@@ -340,20 +1609,512 @@ def create_new_chat_session(model_name: str, current_history: list, system_instr
         config=chat_config # config 매개변수로 전달
     )
 
-def evaluate_response(user_input, chat_history, system_instruction, ai_response):
+def send_message_stream_with_cache_fallback(chat_session, message):
+    """
+    chat_session.send_message_stream(message)의 청크를 내보냅니다.
+    컨텍스트 캐시를 쓰는 ChatSession의 요청이 첫 청크 전에 실패하면 (서버에서 캐시가 만료·삭제된 경우 등)
+    그 캐시를 버리고 같은 이력으로 만든 캐시 없는 ChatSession으로 한 번 더 요청합니다.
+    """
+    cache_info = cached_chat_sessions.get(chat_session)
+    response_stream = chat_session.send_message_stream(message)
+    if cache_info is None:
+        yield from response_stream
+        return
+    try:
+        first_chunk = next(response_stream)
+    except StopIteration:
+        return
+    except Exception as e:
+        print(f"컨텍스트 캐시({cache_info.cached_content_name})를 사용한 요청 실패, 캐시 없이 재시도: {e}")
+        cache_info.failed = True
+        context_cache.discard(cache_info.cached_content_name)
+        uncached_session = create_new_chat_session(cache_info.model_name, None, cache_info.system_instruction,
+                                                   converted_history=cache_info.history, use_context_cache=False)
+        yield from uncached_session.send_message_stream(message)
+        return
+    yield first_chunk
+    yield from response_stream
+
+# --- Context Window Management ---
+def estimate_message_tokens(message: ChatMessage) -> int:
+    """메시지의 토큰 수를 추정하여 메시지에 보관합니다 (이미지 크기는 헤더만 읽어 계산)."""
+    if message.token_estimate is None:
+        image_tokens = 0
+        if message.image_digest is not None and message.image_mime_type:
+            try:
+                width, height = Image.open(io.BytesIO(message.image_bytes)).size
+                image_tokens = estimate_image_tokens(width, height)
+            except Exception:
+                image_tokens = estimate_image_tokens(768, 768)
+        message.token_estimate = (estimate_text_tokens(message.text or ""), image_tokens)
+    return sum(message.token_estimate)
+
+@dataclass
+class ConversationSummary:
+    """대화 앞부분(covered_count개 메시지)의 요약. last_covered_message로 앞부분이 바뀌지 않았는지 확인합니다."""
+    covered_count: int
+    last_covered_message: ChatMessage
+    text: str
+
+@dataclass
+class PendingConversationSummary:
+    """백그라운드에서 생성 중인 요약. 끝나면 ConversationSummary(covered_count, last_covered_message, 결과)가 됩니다."""
+    future: Future
+    usage_meter: UsageMeter # 요약 호출의 사용량 (턴이 끝난 뒤에 끝날 수 있으므로 따로 세었다가 반영하는 턴에 더함)
+    covered_count: int
+    last_covered_message: ChatMessage
+
+@dataclass
+class ContextWindowReport:
+    budget_tokens: int = 0
+    full_tokens: int = 0 # 전체 이력의 추정 토큰 (보정 후)
+    sent_tokens: int = 0 # 실제로 보낸 이력의 추정 토큰
+    dropped_image_count: int = 0
+    summarized_message_count: int = 0
+    summary_call_count: int = 0 # 이번 턴에 시작한 요약 모델 호출 수
+    summary_pending_message_count: int = 0 # 요약이 끝나지 않아 이번 턴에는 생략 표시로 대체한 메시지 수
+
+    def summary(self) -> str:
+        summary = (f"이력 {self.sent_tokens:,}/{self.budget_tokens:,} 토큰 (전체 {self.full_tokens:,}), "
+                   f"이미지 생략 {self.dropped_image_count}개, 요약된 메시지 {self.summarized_message_count}개")
+        if self.summary_pending_message_count:
+            summary += f" (그중 {self.summary_pending_message_count}개는 요약 생성 중이어서 생략)"
+        return summary
+
+class ContextWindowManager:
+    """
+    모델별 토큰 예산(MODEL_CONTEXT_TOKEN_BUDGETS)에 맞게 ChatSession에 넣을 이력을 줄입니다.
+    1) 예산 안이면 그대로 보냅니다.
+    2) 초과하면 최근 CONTEXT_KEEP_IMAGE_MESSAGES개 이전 메시지의 이미지부터 생략합니다.
+    3) 그래도 초과하면 오래된 메시지를 요약으로 대체합니다. 요약은 대화별로 캐시하고,
+       예산을 다시 넘을 때만 이전 요약 + 새로 밀려난 메시지로 갱신합니다 (매 턴 요약하지 않음).
+       executor가 있으면 갱신은 백그라운드에서 만들고, 그동안은 이전 요약 + 생략 표시로 보냅니다 (요청이 요약을 기다리지 않음).
+    토큰은 로컬 추정치를 쓰고, 예산을 넘는 것으로 추정될 때만 count_tokens로 확인하여 모델별 보정 계수를 갱신합니다.
+    같은 이력으로 다시 호출되면 이전 결과를 그대로 반환하고, 결과가 바뀔 때만 fit_generation을 올립니다.
+    """
+
+    def __init__(self, executor: ThreadPoolExecutor | None = None):
+        self.executor = executor
+        self.summaries = {} # title -> ConversationSummary
+        self.pending_summaries = {} # title -> PendingConversationSummary
+        self.calibration = {} # model_name -> 실제 토큰 / 추정 토큰
+        self.last_report = None
+        self.fit_generation = 0 # fit() 결과가 새로 계산될 때마다 증가
+        self._last_fit = None # (fit key, 결과 Content 리스트)
+
+    def rename_title(self, old_title: str, new_title: str):
+        if old_title in self.summaries:
+            self.summaries[new_title] = self.summaries.pop(old_title)
+        if old_title in self.pending_summaries:
+            self.pending_summaries[new_title] = self.pending_summaries.pop(old_title)
+
+    def _estimate(self, model_name: str, tokens: int) -> int:
+        return int(tokens * self.calibration.get(model_name, 1.0))
+
+    def _confirm_over_budget(self, model_name: str, contents: list, estimated_tokens: int, budget: int) -> bool:
+        """추정치가 예산을 넘을 때 count_tokens로 확인하고 보정 계수를 갱신합니다. 실패하면 추정치를 신뢰합니다."""
+        try:
+            counted_tokens = gemini_client.models.count_tokens(model=model_name, contents=contents).total_tokens
+        except Exception as e:
+            print(f"count_tokens 호출 실패, 추정치 사용: {e}")
+            return True
+        if counted_tokens and estimated_tokens:
+            raw_estimate = estimated_tokens / self.calibration.get(model_name, 1.0)
+            self.calibration[model_name] = min(2.0, max(0.5, counted_tokens / raw_estimate))
+        return counted_tokens > budget
+
+    def _collect_summary(self, title: str):
+        """백그라운드 요약이 끝났으면 요약 캐시에 반영하고, 그 사용량을 현재 턴에 더합니다."""
+        pending = self.pending_summaries.get(title)
+        if pending is None or not pending.future.done():
+            return
+        del self.pending_summaries[title]
+        meter = current_meter()
+        if meter is not None:
+            meter.add_records(pending.usage_meter.records())
+        try:
+            summary_text = pending.future.result()
+        except Exception as e:
+            print(f"이전 대화 요약 오류: {e}")
+            return
+        self.summaries[title] = ConversationSummary(pending.covered_count, pending.last_covered_message, summary_text)
+
+    def _start_summary(self, title: str, previous_summary: str, messages: list, covered_count: int, last_covered_message: ChatMessage):
+        """요약 갱신을 백그라운드로 시작합니다. 이 대화의 요약을 이미 만드는 중이면 그것이 끝날 때까지 새로 시작하지 않습니다."""
+        if title in self.pending_summaries:
+            return
+        usage_meter = UsageMeter(MODEL_PRICING_USD_PER_MILLION_TOKENS)
+        future = self.executor.submit(tracer.bind(usage_meter.run), self._summarize, previous_summary, messages)
+        self.pending_summaries[title] = PendingConversationSummary(future, usage_meter, covered_count, last_covered_message)
+
+    @tracer.traced("context.fit")
+    def fit(self, title: str, model_name: str, history: list, history_contents: list) -> list:
+        """history(ChatMessage 리스트)와 1:1로 변환된 history_contents를 예산에 맞게 줄인 Content 리스트를 반환합니다."""
+        self._collect_summary(title)
+        fit_key = (title, model_name, len(history), history[-1] if history else None, self.summaries.get(title))
+        if self._last_fit is not None and self._last_fit[0] == fit_key:
+            tracer.current_span().set_attribute("reused", True)
+            return self._last_fit[1]
+        fitted_contents = self._fit(title, model_name, history, history_contents)
+        self._last_fit = (fit_key, fitted_contents)
+        self.fit_generation += 1
+        return fitted_contents
+
+    def _fit(self, title: str, model_name: str, history: list, history_contents: list) -> list:
+        budget = MODEL_CONTEXT_TOKEN_BUDGETS.get(model_name, DEFAULT_CONTEXT_TOKEN_BUDGET)
+        message_tokens = [self._estimate(model_name, estimate_message_tokens(message)) for message in history]
+        full_tokens = sum(message_tokens)
+        report = ContextWindowReport(budget_tokens=budget, full_tokens=full_tokens, sent_tokens=full_tokens)
+        self.last_report = report
+        if full_tokens <= budget:
+            return history_contents
+        # 요약이 이미 있거나 만드는 중이면 count_tokens 확인 없이 그대로 이어서 사용
+        if title not in self.summaries and title not in self.pending_summaries and not self._confirm_over_budget(model_name, history_contents, full_tokens, budget):
+            return history_contents
+        message_tokens = [self._estimate(model_name, estimate_message_tokens(message)) for message in history]
+
+        # 2) 오래된 이미지부터 생략
+        contents = list(history_contents)
+        image_cutoff = max(0, len(history) - CONTEXT_KEEP_IMAGE_MESSAGES)
+        for index in range(image_cutoff):
+            message = history[index]
+            if message.token_estimate[1]:
+                contents[index] = types.Content(role=message.role, parts=[
+                    types.Part(text="[이전에 첨부된 이미지는 생략되었습니다]"),
+                    types.Part(text=message.text)
+                ])
+                message_tokens[index] = self._estimate(model_name, message.token_estimate[0])
+                report.dropped_image_count += 1
+        report.sent_tokens = sum(message_tokens)
+        if report.sent_tokens <= budget:
+            return contents
+
+        # 3) 오래된 메시지를 요약으로 대체
+        summary = self.summaries.get(title)
+        if summary is not None and (summary.covered_count > len(history)
+                                    or history[summary.covered_count - 1] is not summary.last_covered_message):
+            summary = None # 앞부분이 바뀐 경우 (다시 생성, 다른 기기에서 수정 등)
+        covered_count = summary.covered_count if summary else 0
+        summary_text = summary.text if summary else ""
+        if estimate_text_tokens(summary_text) + sum(message_tokens[covered_count:]) > budget:
+            # 최근 이력이 예산의 CONTEXT_TAIL_BUDGET_RATIO 안에 들어오도록 요약 범위를 넓힘 (user/model 짝이 깨지지 않게 짝수로)
+            tail_tokens = 0
+            new_covered_count = len(history)
+            while new_covered_count > covered_count and tail_tokens + message_tokens[new_covered_count - 1] <= budget * CONTEXT_TAIL_BUDGET_RATIO:
+                new_covered_count -= 1
+                tail_tokens += message_tokens[new_covered_count]
+            new_covered_count = min(new_covered_count + new_covered_count % 2, len(history))
+            newly_covered = history[covered_count:new_covered_count]
+            if self.executor is None:
+                summary_text = self._summarize(summary_text, newly_covered)
+                self.summaries[title] = ConversationSummary(new_covered_count, history[new_covered_count - 1], summary_text)
+            else:
+                if title not in self.pending_summaries:
+                    report.summary_call_count += 1
+                self._start_summary(title, summary_text, newly_covered, new_covered_count, history[new_covered_count - 1])
+                # 이번 턴은 요약을 기다리지 않고 새로 밀려난 메시지를 생략 표시로 대체 (다음 턴부터 갱신된 요약 사용)
+                summary_text = f"{summary_text}\n(이후 대화 메시지 {len(newly_covered)}개는 생략되었습니다.)".strip()
+                report.summary_pending_message_count = len(newly_covered)
+            covered_count = new_covered_count
+
+        report.summarized_message_count = covered_count
+        report.sent_tokens = estimate_text_tokens(summary_text) + sum(message_tokens[covered_count:])
+        return [
+            types.Content(role="user", parts=[types.Part(text=f"[이전 대화 요약]\n{summary_text}")]),
+            types.Content(role="model", parts=[types.Part(text="네, 이전 대화 요약을 참고하여 이어서 답변하겠습니다.")]),
+        ] + contents[covered_count:]
+
+    def _summarize(self, previous_summary: str, messages: list) -> str:
+        """이전 요약과 새로 밀려난 메시지들로 갱신된 요약을 만듭니다. 실패하면 생략 표시만 남깁니다."""
+        conversation_text = "\n".join(
+            f"{message.role}: {'[이미지] ' if message.image_digest is not None or message.cloudinary_url else ''}{message.text}"
+            for message in messages
+        )
+        prompt = f"""다음은 지금까지의 대화 요약과 그 이후에 이어진 대화입니다.
+대화를 이어가는 데 필요한 사실, 사용자의 요구사항과 선호, 결정된 사항을 빠짐없이 담아 갱신된 요약을 한국어로 작성하세요.
+{CONTEXT_SUMMARY_MAX_CHARS}자 이내로 작성하고, 요약 외의 말은 하지 마세요.
+
+[지금까지의 요약]
+{previous_summary or "(없음)"}
+
+[이후 대화]
+{conversation_text}"""
+        try:
+            response = gemini_client.models.generate_content(model=CONTEXT_SUMMARY_MODEL, contents=prompt)
+            record_usage("summary", CONTEXT_SUMMARY_MODEL, response.usage_metadata)
+            summary_text = (response.text or "").strip()
+            if summary_text:
+                return summary_text[:CONTEXT_SUMMARY_MAX_CHARS * 2]
+        except Exception as e:
+            print(f"이전 대화 요약 오류: {e}")
+        return f"{previous_summary}\n(이전 대화 메시지 {len(messages)}개가 생략되었습니다.)".strip()
+
+    def supervisor_history(self, title: str, history: list) -> list:
+        """
+        Supervisor 평가 프롬프트용 ChatMessage 리스트. SUPERVISOR_HISTORY_TOKEN_BUDGET 안의 최근 메시지만 넣고,
+        그 이전은 캐시된 요약이 있으면 요약으로, 없으면 생략 표시로 대체합니다 (요약 모델을 새로 호출하지 않음).
+        """
+        selected = []
+        used_tokens = 0
+        for message in reversed(history):
+            text_tokens = estimate_text_tokens(message.text or "")
+            if used_tokens + text_tokens > SUPERVISOR_HISTORY_TOKEN_BUDGET:
+                break
+            selected.append(message)
+            used_tokens += text_tokens
+        selected.reverse()
+        omitted_count = len(history) - len(selected)
+        if omitted_count:
+            summary = self.summaries.get(title)
+            if summary is not None and summary.covered_count >= omitted_count:
+                selected.insert(0, ChatMessage("summary", summary.text))
+            else:
+                selected.insert(0, ChatMessage("summary", f"(이전 대화 메시지 {omitted_count}개 생략)"))
+        return selected
+
+# --- Chat Session Manager ---
+class ChatSessionManager:
+    """
+    (대화 제목, 모델, 시스템 명령어) 조합마다 하나의 ChatSession을 유지합니다.
+    이미 변환된 Gemini Content 이력을 캐시해 두고, 매 턴마다 새로 추가된 메시지만 변환해서 이어 붙입니다.
+    조합(key)이 바뀌거나 다시 생성(regenerate)이 요청된 경우에만 전체 이력을 다시 변환합니다.
+    ChatSession은 이전 턴에 send_message_stream이 기록한 이력이 새 이력과 같으면 그대로 재사용하고,
+    토큰 예산 조정 등으로 보낼 이력이 달라진 경우에만 새로 만듭니다.
+    """
+
+    def __init__(self, summary_executor: ThreadPoolExecutor | None = None):
+        self.session_key = None # (title, model_name, system_instruction)
+        self.chat_session = None
+        self.history_contents = [] # chat_history[:synced_count]를 변환한 Content 캐시
+        self.synced_count = 0
+        self.last_synced_item = None # 캐시에 마지막으로 반영된 chat_history 항목 (동일 객체인지 확인용)
+        self.rebuild_count = 0 # ChatSession을 새로 만든 횟수
+        self.reuse_count = 0 # 기존 ChatSession을 그대로 재사용한 횟수
+        self.context_window = ContextWindowManager(summary_executor) # 대화별 요약 캐시는 invalidate()로 지우지 않음
+        self.sent_contents = [] # 토큰 예산에 맞춰 실제로 ChatSession에 넣은 이력
+        self.sent_generation = None # sent_contents를 만든 context_window.fit_generation
+        self.session_history_length = 0 # sent_contents를 반영한 시점의 ChatSession 이력 길이 (컨텍스트 캐시로 보낸 프리픽스는 제외됨)
+
+    def invalidate(self):
+        """다음 요청에서 전체 이력으로 ChatSession을 다시 구성하도록 캐시를 비웁니다."""
+        self.session_key = None
+        self.chat_session = None
+        self.history_contents = []
+        self.synced_count = 0
+        self.last_synced_item = None
+
+    def rename_title(self, old_title: str, new_title: str):
+        """대화 제목만 바뀐 경우 캐시를 버리지 않고 key만 갱신합니다."""
+        if self.session_key is not None and self.session_key[0] == old_title:
+            self.session_key = (new_title,) + self.session_key[1:]
+        self.context_window.rename_title(old_title, new_title)
+
+    def _is_prefix_of(self, history: list) -> bool:
+        """캐시된 이력이 주어진 history의 앞부분과 일치하는지 확인합니다."""
+        if len(history) < self.synced_count:
+            return False
+        if self.synced_count == 0:
+            return True
+        return history[self.synced_count - 1] is self.last_synced_item
+
+    def get_session(self, title: str, model_name: str, history: list, system_instruction: str):
+        """
+        history(이번 턴의 사용자 메시지를 제외한 대화 이력)가 반영된 ChatSession을 반환합니다.
+        """
+        session_key = (title, model_name, system_instruction)
+        if session_key != self.session_key or not self._is_prefix_of(history):
+            self.history_contents = convert_to_gemini_format_for_contents(history)
+            self.session_key = session_key
+            self.chat_session = None
+        elif len(history) > self.synced_count: # 새로 추가된 메시지만 변환
+            self.history_contents.extend(convert_to_gemini_format_for_contents(history[self.synced_count:]))
+        self.synced_count = len(history)
+        self.last_synced_item = history[-1] if history else None
+
+        # 모델별 토큰 예산을 넘으면 오래된 이미지 생략/이전 대화 요약으로 줄인 이력을 사용
+        fitted_contents = self.context_window.fit(title, model_name, history, self.history_contents)
+
+        if self._can_reuse_session(fitted_contents):
+            self.reuse_count += 1
+            cache_info = cached_chat_sessions.get(self.chat_session)
+            if cache_info is not None: # 캐시 실패 시 캐시 없이 다시 만들 ChatSession도 이번 이력을 쓰도록 갱신
+                cache_info.history = list(fitted_contents)
+        else:
+            self.chat_session = create_new_chat_session(
+                model_name,
+                history,
+                system_instruction,
+                converted_history=fitted_contents
+            )
+            self.rebuild_count += 1
+        self.session_history_length = len(self.chat_session.get_history())
+        self.sent_contents = list(fitted_contents) # history_contents는 제자리에서 늘어나므로 복사해 둠
+        self.sent_generation = self.context_window.fit_generation
+        return self.chat_session
+
+    def _can_reuse_session(self, fitted_contents: list) -> bool:
+        """
+        기존 ChatSession의 이력이 이미 fitted_contents와 같은지 확인합니다.
+        이전에 보낸 이력(sent_contents)이 그대로 앞부분에 있고, 그 뒤로 send_message_stream이 기록한 턴이
+        새로 추가된 메시지와 같을 때만 재사용합니다 (요약/이미지 생략으로 이력이 바뀌었거나, 다시 생성,
+        다른 후보 선택, 응답 실패 등으로 기록된 턴이 다르면 새로 생성).
+        """
+        if self.chat_session is None:
+            return False
+        cache_info = cached_chat_sessions.get(self.chat_session)
+        if cache_info is not None:
+            if cache_info.failed:
+                return False
+            # 새로 만들면 캐시 경계가 앞으로 옮겨지는 경우에는 더 긴 프리픽스를 캐시하도록 다시 생성
+            cached_prefix_length = len(self.sent_contents) - self.session_history_length
+            prefix_length = max(0, len(fitted_contents) - CONTEXT_CACHE_RECENT_MESSAGES) \
+                // CONTEXT_CACHE_PREFIX_STEP * CONTEXT_CACHE_PREFIX_STEP
+            if prefix_length > cached_prefix_length:
+                return False
+        sent_count = len(self.sent_contents)
+        if len(fitted_contents) < sent_count:
+            return False
+        if any(sent is not fitted and sent != fitted for sent, fitted in zip(self.sent_contents, fitted_contents)):
+            return False
+        recorded_turns = self.chat_session.get_history()[self.session_history_length:]
+        return self._normalize_contents(recorded_turns) == self._normalize_contents(fitted_contents[sent_count:])
+
+    @staticmethod
+    def _normalize_contents(contents: list) -> list:
+        """
+        비교용으로 Content 리스트를 (role, parts) 리스트로 바꿉니다.
+        스트리밍 응답은 청크마다 Content가 따로 기록되므로, 연속된 같은 role의 Content와 인접한 텍스트 Part를 합칩니다.
+        """
+        normalized = []
+        for content in contents:
+            if normalized and normalized[-1][0] == content.role:
+                parts = normalized[-1][1]
+            else:
+                parts = []
+                normalized.append((content.role, parts))
+            for part in content.parts or []:
+                if part.text is not None:
+                    if parts and parts[-1][0] == "text" and parts[-1][1] == bool(part.thought):
+                        parts[-1] = ("text", parts[-1][1], parts[-1][2] + part.text)
+                    else:
+                        parts.append(("text", bool(part.thought), part.text))
+                elif part.inline_data is not None:
+                    parts.append(("inline_data", part.inline_data.mime_type, part.inline_data.data))
+                else:
+                    parts.append(("part", part))
+        return normalized
+
+    def get_sessions(self, title: str, model_name: str, history: list, system_instruction: str, count: int) -> list:
+        """
+        같은 이력을 가진 ChatSession을 count개 반환합니다 (병렬 후보 생성용).
+        첫 번째는 get_session과 동일하며, 나머지는 캐시된 Content 이력으로 만들어 재변환이 없습니다.
+        """
+        sessions = [self.get_session(title, model_name, history, system_instruction)]
+        for _ in range(count - 1):
+            sessions.append(create_new_chat_session(
+                model_name,
+                history,
+                system_instruction,
+                converted_history=self.sent_contents
+            ))
+        return sessions
+
+    def hit_rate(self) -> float:
+        """ChatSession 재사용 비율 (0.0 ~ 1.0)을 반환합니다."""
+        total = self.rebuild_count + self.reuse_count
+        return self.reuse_count / total if total else 0.0
+
+@st.cache_resource
+def get_context_summary_executor() -> ThreadPoolExecutor:
+    """모든 세션이 공유하는 이전 대화 요약용 스레드 풀을 반환합니다."""
+    return ThreadPoolExecutor(max_workers=CONTEXT_SUMMARY_MAX_WORKERS, thread_name_prefix="faust-context-summary")
+
+def get_chat_session_manager() -> ChatSessionManager:
+    """현재 Streamlit 세션의 ChatSessionManager를 반환합니다 (없으면 생성)."""
+    if st.session_state.chat_session_manager is None:
+        st.session_state.chat_session_manager = ChatSessionManager(get_context_summary_executor())
+    return st.session_state.chat_session_manager
+
+# --- Supervisor Scoring ---
+class SupervisorScoringStats:
+    """
+    채점 모델별 Supervisor 평가 결과 수 (성공, 형식 오류, 호출 오류, 시간 초과)와 형식 오류 재시도 횟수.
+    모든 세션과 스레드가 함께 사용합니다 (프로세스 메모리에만 보관).
+    """
+    OUTCOME_LABELS = {"ok": "성공", "parse_error": "형식 오류", "call_error": "호출 오류", "timeout": "시간 초과"}
+
+    def __init__(self):
+        self._counts = {} # 모델 -> {결과: 횟수}
+        self.parse_retries = 0
+        self._lock = threading.Lock()
+
+    def record(self, model_name: str, outcome: str):
+        with self._lock:
+            counts = self._counts.setdefault(model_name, {})
+            counts[outcome] = counts.get(outcome, 0) + 1
+
+    def record_parse_retry(self):
+        with self._lock:
+            self.parse_retries += 1
+
+    def summary(self) -> str:
+        with self._lock:
+            lines = []
+            for model_name, counts in sorted(self._counts.items()):
+                total = sum(counts.values())
+                outcomes = ", ".join(f"{label} {counts[outcome]}" for outcome, label in self.OUTCOME_LABELS.items() if counts.get(outcome))
+                lines.append(f"{model_name} {total}회 ({outcomes}, 사용 불가 {(total - counts.get('ok', 0)) / total * 100:.1f}%)")
+            if not lines:
+                return "기록 없음"
+            return " / ".join(lines) + f", 형식 오류 재시도 {self.parse_retries}회"
+
+@st.cache_resource
+def get_supervisor_scoring_stats() -> SupervisorScoringStats:
+    """모든 세션이 공유하는 Supervisor 채점 결과 통계를 반환합니다."""
+    return SupervisorScoringStats()
+
+supervisor_scoring_stats = get_supervisor_scoring_stats() # 스레드 풀 작업에서도 사용하므로 모듈 수준에서 가져옴
+
+def get_supervisor_model() -> str:
+    """이 세션의 Supervisor 채점 모델 (설정하지 않았으면 SUPERVISOR_MODEL)."""
+    return st.session_state.supervisor_model or SUPERVISOR_MODEL
+
+def parse_supervisor_score(response) -> int | None:
+    """
+    구조화된 출력({"score": 정수})에서 점수를 꺼냅니다.
+    JSON이 아니거나(출력 한도에 걸려 잘린 경우 포함) score가 없거나 0-100 범위를 벗어나면 None을 반환합니다.
+    """
+    parsed = getattr(response, "parsed", None)
+    if not isinstance(parsed, dict):
+        try:
+            parsed = json.loads(response.text or "")
+        except (TypeError, ValueError):
+            return None
+    score = parsed.get("score") if isinstance(parsed, dict) else None
+    if isinstance(score, bool) or not isinstance(score, (int, float)) or not 0 <= score <= 100:
+        return None
+    return round(score)
+
+@tracer.traced("supervisor.evaluate")
+def evaluate_response(user_input, chat_history, system_instruction, ai_response, model_name: str | None = None) -> int | None:
     """
     Supervisor 모델을 사용하여 AI 응답의 적절성을 평가합니다.
     이 함수는 Supervisor 모델에 대한 단일 턴 질의로, `client.models.generate_content`를 사용합니다.
+    점수는 JSON 스키마를 지정한 구조화된 출력으로 받고, 형식에 맞지 않으면 출력 한도를 늘려 SUPERVISOR_PARSE_RETRIES번 다시 요청합니다.
+    쓸 수 있는 점수를 받지 못하면 (형식 오류 또는 호출 오류) None을 반환하며, 호출한 쪽은 이 평가를 평균에서 제외합니다.
+    스레드 풀에서 호출될 때는 st.session_state에 접근할 수 없으므로 model_name(채점 모델)을 명시적으로 전달해야 합니다.
     """
+    if model_name is None:
+        model_name = get_supervisor_model()
+
     # Supervisor의 시스템 명령어 (페르소나 + 평가 기준)
     supervisor_full_system_instruction = PERSONA_LIST[randint(0, len(PERSONA_LIST)-1)] + "\n" + SYSTEM_INSTRUCTION_SUPERVISOR
 
     # Supervisor에게 전달할 평가 대상 정보 (contents로 전달)
-    # chat_history는 (role, text, ..., ...) 형식으로 변경되었으므로, 텍스트만 추출하여 평가 텍스트에 포함시켜야 함.
+    # chat_history는 supervisor_history()가 고른 ChatMessage 리스트 (이미지 없이 텍스트만 평가에 포함)
     chat_history_text_only = ""
-    # chat_history는 list of tuples. 각 tuple의 두 번째 요소가 텍스트임.
-    for item in chat_history:
-        chat_history_text_only += f"\n{item[0]}: {item[1]}" # item[1]은 텍스트 부분
+    for message in chat_history:
+        chat_history_text_only += f"\n{message.role}: {message.text}"
 
     evaluation_context_text = f"""
     ---
@@ -369,60 +2130,1327 @@ def evaluate_response(user_input, chat_history, system_instruction, ai_response)
     위 정보를 바탕으로, 챗봇 AI의 답변에 대해 0점부터 100점 사이의 점수를 평가하세요.
     """
 
-    try:
-        response = gemini_client.models.generate_content(
-            model=st.session_state.selected_model,
-            contents=[types.Part(text=evaluation_context_text)], # 평가할 정보는 contents로 전달
-            config=types.GenerateContentConfig(
-                system_instruction=supervisor_full_system_instruction, # Supervisor의 시스템 명령어는 config로 전달
+    # 사고(thinking) 토큰도 출력 한도에 포함되므로, 사고하는 모델은 사고 예산만큼 한도를 늘림
+    thinking_budget = SUPERVISOR_THINKING_BUDGETS.get(model_name)
+    thinking_kwargs = {"thinking_config": types.ThinkingConfig(thinking_budget=thinking_budget)} if thinking_budget is not None else {}
+    max_output_tokens = SUPERVISOR_MAX_OUTPUT_TOKENS
+    span = tracer.current_span()
+    span.set_attribute("model", model_name)
+    for attempt in range(SUPERVISOR_PARSE_RETRIES + 1):
+        try:
+            # Supervisor의 시스템 명령어는 페르소나별로 컨텍스트 캐시를 통해 전달 (캐시할 수 없으면 config로 직접 전달)
+            response = generate_content_with_cached_prefix(
+                "supervisor",
+                model_name,
+                supervisor_full_system_instruction,
+                [types.Part(text=evaluation_context_text)], # 평가할 정보는 contents로 전달
                 temperature=0.01,
                 top_p=1.0,
                 top_k=1,
+                max_output_tokens=max_output_tokens + (thinking_budget or 0),
+                response_mime_type="application/json",
+                response_schema=SUPERVISOR_RESPONSE_SCHEMA,
+                **thinking_kwargs,
             )
-        )
-        score_text = response.text.strip()
-        score = int(score_text)
-        if not (0 <= score <= 100):
-            print(f"경고: Supervisor가 0-100 범위를 벗어난 점수를 반환했습니다: {score}")
-            score = max(0, min(100, score))
-        return score
-
-    except ValueError as e:
-        print(f"Supervisor 응답을 점수로 변환하는 데 실패했습니다: {score_text}, 오류: {e}")
-        return 50
-    except Exception as e:
-        print(f"Supervisor 모델 호출 중 오류 발생: {e}")
-        return 50
+        except Exception as e:
+            print(f"Supervisor 모델 호출 중 오류 발생: {e}")
+            supervisor_scoring_stats.record(model_name, "call_error")
+            span.set_attribute("outcome", "call_error")
+            return None
+        record_usage("supervisor", model_name, response.usage_metadata)
+        score = parse_supervisor_score(response)
+        if score is not None:
+            supervisor_scoring_stats.record(model_name, "ok")
+            span.set_attributes(score=score, outcome="ok", attempts=attempt + 1)
+            return score
+        print(f"Supervisor 응답이 점수 형식에 맞지 않습니다 (시도 {attempt + 1}): {response.text!r}")
+        if attempt < SUPERVISOR_PARSE_RETRIES:
+            supervisor_scoring_stats.record_parse_retry()
+            max_output_tokens *= 2 # 출력 한도에 걸려 JSON이 잘린 경우를 위해 늘림
+    supervisor_scoring_stats.record(model_name, "parse_error")
+    span.set_attributes(outcome="parse_error", attempts=SUPERVISOR_PARSE_RETRIES + 1)
+    return None
+
+# --- Parallel Supervisor Panel ---
+@dataclass
+class SupervisorVerdict:
+    """Supervisor 한 명의 평가 결과."""
+    supervisor_index: int
+    score: int | None # None이면 쓸 수 있는 점수를 받지 못함 (형식 오류, 호출 오류, 시간 초과) -> 평균에서 제외
+    latency_seconds: float
+    timed_out: bool = False
+    total_tokens: int = 0 # 이 Supervisor 호출의 입력 + 출력 토큰
+    cost_usd: float = 0.0
+
+@st.cache_resource
+def get_supervisor_executor() -> ThreadPoolExecutor:
+    """모든 세션이 공유하는 Supervisor 평가용 스레드 풀을 반환합니다."""
+    return ThreadPoolExecutor(max_workers=SUPERVISOR_MAX_WORKERS, thread_name_prefix="faust-supervisor")
+
+def _timed_evaluate_response(supervisor_index, started_at: dict, **evaluate_kwargs) -> SupervisorVerdict:
+    """
+    evaluate_response를 호출하고 소요 시간과 사용량을 함께 기록합니다 (스레드 풀 작업 단위).
+    실행을 시작한 시각을 started_at[supervisor_index]에 남겨, 풀에서 기다린 시간은 시간 초과에 포함되지 않도록 합니다.
+    """
+    start_time = time.perf_counter()
+    started_at[supervisor_index] = start_time
+    # Supervisor별 사용량을 따로 세면서 턴 전체 meter에도 기록
+    usage_meter = UsageMeter(MODEL_PRICING_USD_PER_MILLION_TOKENS, parent=current_meter())
+    score = usage_meter.run(evaluate_response, **evaluate_kwargs)
+    usage = usage_meter.total()
+    return SupervisorVerdict(supervisor_index, score, time.perf_counter() - start_time,
+                             total_tokens=usage["total_tokens"], cost_usd=usage["cost_usd"])
+
+def is_supervision_decided(received_scores: list, supervisor_count: int, threshold: float) -> bool:
+    """
+    남은 Supervisor들이 어떤 점수(0~100)를 주더라도 평균의 통과 여부가 바뀌지 않으면 True를 반환합니다.
+    supervisor_count는 점수를 줄 수 있는 Supervisor 수입니다 (평가에 실패한 Supervisor는 빼고 전달).
+    """
+    remaining_count = supervisor_count - len(received_scores)
+    lowest_possible_avg = sum(received_scores) / supervisor_count
+    highest_possible_avg = (sum(received_scores) + 100 * remaining_count) / supervisor_count
+    return lowest_possible_avg >= threshold or highest_possible_avg < threshold
+
+@tracer.traced("supervisor.panel")
+def run_supervisor_panel(user_input, chat_history, system_instruction, ai_response,
+                         supervisor_count: int, threshold: float, model_name: str,
+                         call_timeout: float = SUPERVISOR_CALL_TIMEOUT_SECONDS,
+                         executor: ThreadPoolExecutor | None = None):
+    """
+    supervisor_count명의 Supervisor를 동시에 호출해 답변을 평가합니다.
+    통과 여부가 확정되면 남은 평가를 취소하고 조기 종료합니다.
+    call_timeout은 각 평가가 풀에서 실행을 시작한 때부터 셉니다 (풀이 붐벼 기다리는 동안에는 시간 초과되지 않음).
+    다른 스레드에서 호출할 때는 메인 스레드에서 얻은 executor를 전달해야 합니다.
+    model_name은 채점 모델이며, 점수를 받지 못한 Supervisor는 평균에서 제외합니다.
+    반환값: (받은 점수들의 평균 (하나도 받지 못하면 None), SupervisorVerdict 리스트, 조기 종료 여부)
+    """
+    if executor is None:
+        executor = get_supervisor_executor()
+    submitted_at = time.perf_counter()
+    started_at = {} # supervisor_index -> 실행을 시작한 시각 (작업 스레드가 기록)
+    pending = {
+        executor.submit(
+            tracer.bind(_timed_evaluate_response),
+            i,
+            started_at,
+            user_input=user_input,
+            chat_history=chat_history,
+            system_instruction=system_instruction,
+            ai_response=ai_response,
+            model_name=model_name,
+        ): i
+        for i in range(supervisor_count)
+    }
+    verdicts = []
+    early_exit = False
+
+    while pending:
+        # 시작한 평가 중 가장 먼저 끝나야 하는 시각까지 기다림. 아직 시작하지 않은 평가가 있으면 call_timeout마다 깨어
+        # 그 사이 시작한 평가의 마감 시각을 다시 계산 (그 평가의 마감은 이번 대기가 끝난 뒤이므로 놓치지 않음)
+        now = time.perf_counter()
+        deadlines = [started_at[supervisor_index] + call_timeout for supervisor_index in pending.values() if supervisor_index in started_at]
+        wait_timeout = max(0.0, min(deadlines) - now) if deadlines else call_timeout
+        if len(deadlines) < len(pending):
+            wait_timeout = min(wait_timeout, call_timeout)
+        done, _ = wait(pending, timeout=wait_timeout, return_when=FIRST_COMPLETED)
+        if not done: # 시간 초과: 실행을 시작한 지 call_timeout이 지난 Supervisor는 평균에서 제외
+            now = time.perf_counter()
+            for future, supervisor_index in list(pending.items()):
+                if supervisor_index in started_at and now - started_at[supervisor_index] >= call_timeout:
+                    future.cancel()
+                    del pending[future]
+                    print(f"Supervisor {supervisor_index + 1} 평가가 {call_timeout}초 안에 끝나지 않아 평균에서 제외합니다.")
+                    supervisor_scoring_stats.record(model_name, "timeout")
+                    verdicts.append(SupervisorVerdict(supervisor_index, None, now - started_at[supervisor_index], timed_out=True))
+
+        for future in done:
+            supervisor_index = pending.pop(future)
+            try:
+                verdicts.append(future.result())
+            except Exception as e:
+                print(f"Supervisor {supervisor_index + 1} 평가 작업 중 오류 발생: {e}")
+                supervisor_scoring_stats.record(model_name, "call_error")
+                verdicts.append(SupervisorVerdict(supervisor_index, None, time.perf_counter() - started_at.get(supervisor_index, submitted_at)))
+
+        scores = [v.score for v in verdicts if v.score is not None]
+        if pending and is_supervision_decided(scores, supervisor_count - (len(verdicts) - len(scores)), threshold):
+            for future in pending:
+                future.cancel() # 아직 시작되지 않은 평가는 취소 (이미 실행 중인 호출의 결과는 무시)
+            early_exit = True
+            break
+
+    verdicts.sort(key=lambda v: v.supervisor_index)
+    scores = [v.score for v in verdicts if v.score is not None]
+    avg_score = sum(scores) / len(scores) if scores else None
+    tracer.current_span().set_attributes(supervisors=len(verdicts), avg_score=round(avg_score, 2) if avg_score is not None else None,
+                                         early_exit=early_exit, timed_out=sum(v.timed_out for v in verdicts),
+                                         unscored=len(verdicts) - len(scores), scorer_model=model_name)
+    return avg_score, verdicts, early_exit
+
+# --- Adaptive Supervision ---
+@st.cache_resource
+def get_supervision_policy() -> AdaptiveSupervisionPolicy:
+    """모든 세션이 공유하는 적응형 Supervision 정책을 반환합니다 (점수 기록은 프로세스 메모리에만 보관)."""
+    return AdaptiveSupervisionPolicy(
+        window=ADAPTIVE_SUPERVISION_WINDOW,
+        min_samples=ADAPTIVE_SUPERVISION_MIN_SAMPLES,
+        reduce_pass_rate=ADAPTIVE_SUPERVISION_REDUCE_PASS_RATE,
+        skip_pass_rate=ADAPTIVE_SUPERVISION_SKIP_PASS_RATE,
+        reduced_supervisors=ADAPTIVE_SUPERVISION_REDUCED_SUPERVISORS,
+        audit_rate=ADAPTIVE_SUPERVISION_AUDIT_RATE,
+        audit_failure_full_turns=ADAPTIVE_SUPERVISION_AUDIT_FAILURE_FULL_TURNS,
+    )
+
+def decide_supervision(user_contents: list, system_instruction: str) -> tuple[SupervisionDecision, tuple | None]:
+    """
+    이번 턴의 Supervision 방식을 정합니다 (요청 스레드에서 호출). 반환값: (결정, 정책 key).
+    적응형 정책이 꺼져 있으면 설정된 Supervisor 수를 그대로 사용하지만, 나중에 켰을 때 쓸 수 있도록 점수는 계속 기록합니다.
+    """
+    user_text = next((part.text for part in user_contents if isinstance(part, types.Part) and part.text), "")
+    has_attachment = any(getattr(part, "inline_data", None) is not None for part in user_contents)
+    policy = get_supervision_policy()
+    policy_key = policy.key(st.session_state.selected_model, system_instruction, classify_prompt(user_text, has_attachment))
+    if not st.session_state.adaptive_supervision:
+        return SupervisionDecision("off", st.session_state.supervisor_count), policy_key
+    decision = policy.decide(policy_key, st.session_state.supervision_threshold, st.session_state.supervisor_count)
+    tracer.current_span().set_attributes(supervision_mode=decision.mode, supervisors=decision.supervisor_count,
+                                         prompt_class=policy_key[2])
+    return decision, policy_key
+
+# --- Speculative Parallel Candidate Generation ---
+class CandidateCancelled(Exception):
+    """다른 후보가 먼저 통과하여 생성이 중단된 경우 발생합니다."""
+
+@dataclass
+class CandidateResult:
+    """병렬로 생성·평가된 후보 답변 하나."""
+    candidate_index: int
+    response_text: str
+    avg_score: float | None # None이면 Supervisor 점수를 하나도 받지 못함
+    verdicts: list
+    early_exit: bool
+    latency_seconds: float
+    total_tokens: int = 0 # 후보 생성과 평가에 쓴 입력 + 출력 토큰
+    cost_usd: float = 0.0
+
+@st.cache_resource
+def get_candidate_executor() -> ThreadPoolExecutor:
+    """모든 세션이 공유하는 후보 답변 생성용 스레드 풀을 반환합니다."""
+    return ThreadPoolExecutor(max_workers=CANDIDATE_MAX_WORKERS, thread_name_prefix="faust-candidate")
+
+@tracer.traced("candidate")
+def generate_and_score_candidate(candidate_index: int, chat_session, user_contents, cancel_event: threading.Event,
+                                 supervisor_executor: ThreadPoolExecutor, chat_model_name: str, **panel_kwargs) -> CandidateResult:
+    """
+    후보 답변 하나를 생성(스트림을 끝까지 수신)한 뒤 Supervisor 패널로 평가합니다 (스레드 풀 작업 단위).
+    chat_model_name은 답변을 생성하는 채팅 모델이고, panel_kwargs의 model_name은 채점 모델입니다.
+    cancel_event가 설정되면 스트림 수신과 평가를 중단합니다.
+    """
+    start_time = time.perf_counter()
+    response_chunks = []
+    tracer.current_span().set_attribute("candidate", candidate_index)
+    usage_meter = UsageMeter(MODEL_PRICING_USD_PER_MILLION_TOKENS, parent=current_meter())
+    activate_meter(usage_meter) # 이 작업의 컨텍스트에서만 유효 (Tracer.bind가 복사한 컨텍스트)
+    usage_metadata = None
+    with tracer.span("gemini.stream") as stream_span:
+        try:
+            for chunk in send_message_stream_with_cache_fallback(chat_session, user_contents):
+                if cancel_event.is_set():
+                    raise CandidateCancelled()
+                if not response_chunks:
+                    stream_span.set_attribute("first_chunk_ms", round((time.perf_counter() - start_time) * 1000, 1))
+                response_chunks.append(chunk.text or "")
+                usage_metadata = chunk.usage_metadata or usage_metadata # 누적 사용량은 마지막 청크에 담겨 옴
+        finally: # 중단된 후보도 호출 비용은 발생하므로 기록
+            record_usage("chat", chat_model_name, usage_metadata)
+        stream_span.set_attribute("chunks", len(response_chunks))
+    response_text = "".join(response_chunks)
+    if cancel_event.is_set():
+        raise CandidateCancelled()
+
+    avg_score, verdicts, early_exit = run_supervisor_panel(
+        ai_response=response_text,
+        executor=supervisor_executor,
+        **panel_kwargs
+    )
+    usage = usage_meter.total()
+    return CandidateResult(candidate_index, response_text, avg_score, verdicts, early_exit, time.perf_counter() - start_time,
+                           total_tokens=usage["total_tokens"], cost_usd=usage["cost_usd"])
+
+
+# --- Streaming Response Renderer ---
+STREAM_MAX_FPS = 10 # 스트리밍 중 화면 갱신 최대 횟수 (초당)
+STREAM_RENDER_MIN_CHARS = 120 # 이만큼 새 텍스트가 쌓이면 갱신
+STREAM_RENDER_MAX_DELAY_SECONDS = 0.3 # 새 텍스트가 적어도 이 시간이 지나면 갱신
+STREAM_CURSOR = "▌"
+
+@dataclass
+class StreamRenderStats:
+    chunk_count: int = 0
+    response_bytes: int = 0 # 응답 텍스트 크기 (UTF-8)
+    render_count: int = 0 # 화면 갱신 횟수 (마지막 전체 렌더링 포함)
+    rendered_bytes: int = 0 # 갱신 때마다 전송한 markdown 크기의 합
+    first_chunk_seconds: float | None = None # 첫 청크가 도착할 때까지 걸린 시간 (TTFT)
+    elapsed_seconds: float = 0.0
+
+    def summary(self) -> str:
+        first_chunk = f"첫 청크 {self.first_chunk_seconds:.2f}초, " if self.first_chunk_seconds is not None else ""
+        return (f"{first_chunk}청크 {self.chunk_count}개, 응답 {self.response_bytes / 1024:.1f}KB, 렌더링 {self.render_count}회 "
+                f"(전송 {self.rendered_bytes / 1024:.1f}KB), {self.elapsed_seconds:.1f}초")
+
+class StreamingMarkdownRenderer:
+    """
+    스트리밍 응답을 placeholder에 표시합니다.
+    청크는 리스트 버퍼에 모으고, 시간/크기 기준으로 묶어 최대 STREAM_MAX_FPS로만 갱신합니다.
+    코드 블록 밖의 빈 줄에서 끝난 문단은 별도 요소로 고정하고 이후에는 마지막 문단만 다시 보내므로,
+    긴 답변에서도 갱신 한 번의 비용이 전체 길이에 비례하지 않습니다. finish()에서 전체를 한 번에 다시 렌더링합니다.
+    """
+
+    def __init__(self, placeholder, max_fps: float = STREAM_MAX_FPS, min_chars: int = STREAM_RENDER_MIN_CHARS,
+                 max_delay_seconds: float = STREAM_RENDER_MAX_DELAY_SECONDS, clock=time.perf_counter):
+        self.placeholder = placeholder
+        self.min_frame_interval = 1.0 / max_fps
+        self.min_chars = min_chars
+        self.max_delay_seconds = max_delay_seconds
+        self.clock = clock
+        self.stats = StreamRenderStats()
+        self._frozen_parts = [] # 고정된 문단들
+        self._tail_parts = [] # 아직 고정되지 않은 마지막 문단의 청크들
+        self._pending_chars = 0
+        self._started_at = clock()
+        self._last_render_at = self._started_at
+        self._frozen_area = None
+        self._tail_placeholder = None
+
+    def append(self, text: str | None):
+        if not text:
+            return
+        if self.stats.first_chunk_seconds is None:
+            self.stats.first_chunk_seconds = self.clock() - self._started_at
+        self._tail_parts.append(text)
+        self._pending_chars += len(text)
+        self.stats.chunk_count += 1
+        self.stats.response_bytes += len(text.encode("utf-8"))
+
+        now = self.clock()
+        since_last_render = now - self._last_render_at
+        if since_last_render < self.min_frame_interval:
+            return
+        if self._pending_chars >= self.min_chars or since_last_render >= self.max_delay_seconds:
+            self._render(now)
+
+    def text(self) -> str:
+        return "".join(self._frozen_parts) + "".join(self._tail_parts)
+
+    def finish(self) -> str:
+        """전체 응답을 하나의 markdown 요소로 렌더링하고 응답 텍스트를 반환합니다."""
+        full_text = self.text()
+        self.placeholder.markdown(full_text)
+        self.stats.render_count += 1
+        self.stats.rendered_bytes += len(full_text.encode("utf-8"))
+        self.stats.elapsed_seconds = self.clock() - self._started_at
+        return full_text
+
+    def _render(self, now: float):
+        if self._frozen_area is None:
+            container = self.placeholder.container()
+            self._frozen_area = container.container()
+            self._tail_placeholder = container.empty()
+
+        tail = "".join(self._tail_parts)
+        # 코드 블록 밖의 마지막 빈 줄까지를 고정 (고정된 부분은 항상 코드 블록 밖에서 끝남)
+        split_at = tail.rfind("\n\n")
+        if split_at > 0 and tail.count("```", 0, split_at) % 2 == 0:
+            frozen, tail = tail[:split_at + 2], tail[split_at + 2:]
+            self._frozen_area.markdown(frozen)
+            self._frozen_parts.append(frozen)
+            self.stats.rendered_bytes += len(frozen.encode("utf-8"))
+            self._tail_parts = [tail] if tail else []
+
+        self._tail_placeholder.markdown(tail + STREAM_CURSOR)
+        self.stats.render_count += 1
+        self.stats.rendered_bytes += len(tail.encode("utf-8"))
+        self._pending_chars = 0
+        self._last_render_at = now
+
+def stream_response_to_placeholder(response_stream, placeholder) -> str:
+    """send_message_stream의 응답을 StreamingMarkdownRenderer로 표시하고 전체 텍스트를 반환합니다."""
+    with tracer.span("gemini.stream") as stream_span:
+        # 스트림은 첫 청크를 요청할 때 API 호출이 시작되므로, 렌더러 생성 시점부터 첫 청크까지가 TTFT
+        renderer = StreamingMarkdownRenderer(placeholder)
+        usage_metadata = None
+        try:
+            for chunk in response_stream:
+                renderer.append(chunk.text)
+                usage_metadata = chunk.usage_metadata or usage_metadata # 누적 사용량은 마지막 청크에 담겨 옴
+        finally:
+            record_usage("chat", st.session_state.selected_model, usage_metadata)
+        full_response = renderer.finish()
+        stats = renderer.stats
+        stream_span.set_attributes(first_chunk_ms=round(stats.first_chunk_seconds * 1000, 1) if stats.first_chunk_seconds is not None else None,
+                                   chunks=stats.chunk_count, response_bytes=stats.response_bytes, renders=stats.render_count)
+    print(f"스트리밍 렌더링: {renderer.stats.summary()}")
+    st.session_state.last_stream_render_stats = renderer.stats
+    return full_response
+
+# --- Conversation Title Generation ---
+def heuristic_title(message: ChatMessage) -> str:
+    """사용자 메시지의 첫 줄로 바로 쓸 수 있는 임시 제목을 만듭니다 (TITLE_MAX_CHARS 이내, 단어 중간에서 자르지 않음)."""
+    first_line = next((line for line in (message.text or "").splitlines() if line.strip()), "")
+    title = " ".join(first_line.strip(" #>*-`").split())
+    if len(title) > TITLE_MAX_CHARS:
+        cut = title[:TITLE_MAX_CHARS - 1]
+        if " " in cut:
+            cut = cut.rsplit(" ", 1)[0]
+        title = cut.rstrip(" ,.") + "…"
+    if not title:
+        title = "이미지 대화" if message.image_digest is not None or message.cloudinary_url else "대화"
+    return title
+
+def unique_title(base_title: str, ignore_title: str | None = None) -> str:
+    """saved_sessions에 없는 제목을 반환합니다. 이미 있으면 " (n)"을 붙입니다 (ignore_title은 사용 중으로 보지 않음)."""
+    title_key = base_title
+    count = 1
+    while title_key in st.session_state.saved_sessions and title_key != ignore_title:
+        title_key = f"{base_title} ({count})"
+        count += 1
+    return title_key
+
+@tracer.traced("title.generate")
+def generate_conversation_title(user_text: str) -> str:
+    """
+    사용자 메시지를 요약한 대화 제목을 TITLE_MODEL로 생성합니다 (제목 생성 스레드 풀 작업 단위, st.* 사용 안 함).
+    쓸 수 없는 결과(빈 문자열, 너무 긴 제목)이면 빈 문자열을 반환합니다.
+    """
+    response = gemini_client.models.generate_content(
+        model=TITLE_MODEL,
+        contents=[types.Part(text=f"다음 사용자의 메시지를 요약해서 대화 제목으로 만들어줘 (한 문장, {TITLE_MAX_CHARS}자 이내):\n\n{user_text[:TITLE_PROMPT_MAX_CHARS]}")],
+        config=types.GenerateContentConfig(max_output_tokens=TITLE_MAX_OUTPUT_TOKENS, temperature=0.2)
+    )
+    record_usage("title", TITLE_MODEL, response.usage_metadata)
+    title = (response.text or "").strip().replace("\n", " ").replace('"', '')
+    if not title or len(title) > TITLE_MAX_CHARS or title == "새로운 대화":
+        return ""
+    return title
 
+@st.cache_resource
+def get_title_executor() -> ThreadPoolExecutor:
+    """모든 세션이 공유하는 제목 생성용 스레드 풀을 반환합니다."""
+    return ThreadPoolExecutor(max_workers=TITLE_MAX_WORKERS, thread_name_prefix="faust-title")
+
+@dataclass
+class PendingTitleGeneration:
+    """임시 제목이 붙은 대화와, 그 대화의 진짜 제목을 만드는 중인 Future."""
+    temporary_title: str
+    future: Future
+    usage_meter: UsageMeter # 제목 생성 호출의 사용량 (턴이 끝난 뒤에 끝나므로 턴 meter와 따로 셈)
+
+def start_title_generation(user_message: ChatMessage):
+    """
+    현재 "새로운 대화"에 임시 제목을 바로 붙이고, 모델 제목 생성을 백그라운드로 시작합니다.
+    생성된 제목은 apply_generated_title()이 다음 실행에서 교체합니다.
+    """
+    temporary_title = unique_title(heuristic_title(user_message))
+    get_chat_session_manager().rename_title(st.session_state.current_title, temporary_title)
+    st.session_state.current_title = temporary_title
+    if user_message.text:
+        usage_meter = UsageMeter(MODEL_PRICING_USD_PER_MILLION_TOKENS)
+        future = get_title_executor().submit(tracer.bind(usage_meter.run), generate_conversation_title, user_message.text)
+        st.session_state.pending_title_generation = PendingTitleGeneration(temporary_title, future, usage_meter)
+
+def commit_title_usage(pending: PendingTitleGeneration, history: list | None):
+    """제목 생성 사용량을 사용자 누적 사용량과, 대화가 남아 있으면 그 대화의 첫 답변 메시지에 반영합니다."""
+    records = pending.usage_meter.records()
+    add_user_usage(records)
+    first_model_message = next((message for message in history or () if message.role == "model"), None)
+    if first_model_message is not None:
+        first_model_message.usage = merge_records(first_model_message.usage, records)
+
+def apply_generated_title() -> bool:
+    """
+    백그라운드에서 생성이 끝난 제목으로 임시 제목을 교체합니다 (요청 스레드에서 호출).
+    생성이 끝났으면 제목 생성 사용량을 반영하므로 (제목이 바뀌지 않았더라도) 저장이 필요하다는 뜻으로 True를 반환합니다.
+    그 사이 사용자가 제목을 직접 바꾸었거나 대화를 삭제했다면 생성된 제목은 버립니다.
+    """
+    pending = st.session_state.pending_title_generation
+    if pending is None or not pending.future.done():
+        return False
+    st.session_state.pending_title_generation = None
+    saved_sessions = st.session_state.saved_sessions
+    is_saved = pending.temporary_title in saved_sessions
+    if is_saved:
+        history = saved_sessions[pending.temporary_title]
+    elif st.session_state.current_title == pending.temporary_title:
+        history = st.session_state.chat_history
+    else:
+        history = None # 제목이 바뀌었거나 (익명 사용자의) 대화가 사라짐
+    commit_title_usage(pending, history)
+
+    try:
+        generated_title = pending.future.result()
+    except Exception as e:
+        print(f"제목 생성 오류: {e}. 임시 제목 '{pending.temporary_title}'을 유지합니다.")
+        return True # 제목은 그대로지만 사용량은 저장해야 함
+    if not generated_title or generated_title == pending.temporary_title or history is None:
+        return True # 제목은 그대로지만 사용량은 저장해야 함
+    title_key = unique_title(generated_title, ignore_title=pending.temporary_title)
+    if is_saved:
+        saved_sessions.rename(pending.temporary_title, title_key)
+        if pending.temporary_title in st.session_state.system_instructions:
+            st.session_state.system_instructions[title_key] = st.session_state.system_instructions.pop(pending.temporary_title)
+    get_chat_session_manager().rename_title(pending.temporary_title, title_key)
+    if st.session_state.current_title == pending.temporary_title:
+        st.session_state.current_title = title_key
+    st.toast(f"대화 제목이 '{title_key}'로 설정되었습니다.", icon="📝")
+    return True
+
+@st.fragment(run_every=TITLE_POLL_INTERVAL_SECONDS)
+def watch_title_generation():
+    """제목 생성이 끝날 때까지 이 fragment만 주기적으로 다시 실행하고, 끝나면 앱 전체를 다시 실행해 제목을 교체합니다."""
+    pending = st.session_state.pending_title_generation
+    if pending is not None and pending.future.done():
+        st.rerun()
 
 # --- Firebase User Data Management Functions ---
+# Firestore 저장 구조 (schema_version 2)
+#   user_sessions/{user_id}                                         : {schema_version, last_active_title, conversation_index, usage}
+#       usage = UsageLedger.to_dict() (사용자의 이번 달/누적 토큰 사용량과 비용, 저장마다 늘어난 만큼만 트랜잭션으로 더함)
+#       conversation_index = {conversation_id: {title, updated_at, message_count}} (사이드바 표시용 경량 색인)
+#   user_sessions/{user_id}/conversations/{conversation_id}         : {title, system_instruction, message_count, updated_at, cloudinary_public_ids}
+#   user_sessions/{user_id}/conversations/{conversation_id}/messages/{index:06d} : {index, role, text, cloudinary_url?, cloudinary_public_id?, usage?}
+# 이전 버전은 user_sessions/{user_id} 문서 하나에 모든 대화를 chat_data 필드로 저장했으며, 로드 시 자동으로 이전됩니다.
+# STORAGE_BACKEND = "sqlite"이거나 익명 사용자이면 같은 구조를 로컬 SQLite 파일(LOCAL_STORAGE_SCHEMA)에 저장합니다.
+FIRESTORE_SCHEMA_VERSION = 2
+FIRESTORE_BATCH_MAX_OPERATIONS = 500 # Firestore WriteBatch 한 번에 허용되는 최대 작업 수
+
+# 저장소 백엔드 설정
+STORAGE_BACKEND = st.secrets.get("STORAGE_BACKEND", "firestore") # 로그인 사용자의 저장소: "firestore" 또는 "sqlite"(자체 호스팅/오프라인 테스트)
+LOCAL_STORAGE_PATH = st.secrets.get("LOCAL_STORAGE_PATH", "faust_history.sqlite3")
+LOCAL_STORAGE_BUSY_TIMEOUT_SECONDS = 10.0 # 다른 연결이 쓰는 중일 때 잠금을 기다리는 최대 시간
+# 익명 사용자의 대화를 서버의 로컬 저장소에 저장 (URL의 익명 ID만 알면 누구나 불러올 수 있으므로 기본값은 끔)
+ANONYMOUS_LOCAL_PERSISTENCE = st.secrets.get("ANONYMOUS_LOCAL_PERSISTENCE", False)
+ANONYMOUS_RETENTION_DAYS = st.secrets.get("ANONYMOUS_RETENTION_DAYS", 7) # 마지막 저장 후 이 기간이 지난 익명 사용자의 대화는 삭제
+ANONYMOUS_CLEANUP_INTERVAL_SECONDS = 3600 # 만료된 익명 데이터 정리를 이 간격보다 자주 하지 않음
+ANONYMOUS_ID_QUERY_PARAM = "sid" # 익명 ID를 URL에 남겨 새로고침해도 같은 대화 이력을 불러옴
+# 로컬 저장소 구조 (SQLite, WAL 모드). 메시지는 Firestore와 같은 dict를 JSON으로 저장
+LOCAL_STORAGE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    last_active_title TEXT,
+    usage TEXT,
+    anonymous INTEGER NOT NULL DEFAULT 0,
+    last_saved_at REAL
+);
+CREATE TABLE IF NOT EXISTS conversations (
+    user_id TEXT NOT NULL,
+    conversation_id TEXT NOT NULL,
+    title TEXT NOT NULL,
+    system_instruction TEXT,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL,
+    cloudinary_public_ids TEXT,
+    PRIMARY KEY (user_id, conversation_id)
+);
+CREATE TABLE IF NOT EXISTS messages (
+    user_id TEXT NOT NULL,
+    conversation_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (user_id, conversation_id, idx)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS cloudinary_deletes (
+    public_id TEXT PRIMARY KEY,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    abandoned INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+"""
+MAX_LOADED_CONVERSATIONS = 8 # 세션당 메모리에 보관하는 대화 이력 수 (초과 시 오래 사용하지 않은 대화부터 해제)
+PERSIST_DEBOUNCE_SECONDS = 1.0 # 마지막 저장 요청 후 이 시간 동안 추가 요청이 없으면 기록
+PERSIST_MAX_DELAY_SECONDS = 5.0 # 저장 요청이 계속 들어와도 첫 요청 후 이 시간 안에는 기록
+PERSIST_MAX_ATTEMPTS = 5 # 저장 실패 시 최대 시도 횟수
+PERSIST_RETRY_BASE_SECONDS = 0.5 # 재시도 대기 시간 (시도마다 2배, 최대 PERSIST_RETRY_MAX_SECONDS)
+PERSIST_RETRY_MAX_SECONDS = 8.0
+PERSIST_FLUSH_TIMEOUT_SECONDS = 10.0 # 로그아웃/종료 시 저장 완료를 기다리는 최대 시간
+
+@dataclass
+class ConversationIndexEntry:
+    """사이드바에 필요한 대화 정보만 담은 색인 항목."""
+    updated_at: float
+    message_count: int
+
+class ConversationHistoryCache(MutableMapping):
+    """
+    title -> chat_history 매핑 (st.session_state.saved_sessions).
+    색인(index)에는 모든 대화가 있지만, 이력은 처음 접근할 때 load_history로 불러오고 최대 max_loaded개만 LRU로 보관합니다.
+    is_persisted가 True를 반환하는(이미 저장된) 대화만 해제하므로, 저장되지 않은 변경은 사라지지 않습니다.
+    load_history가 없으면(익명 사용자) 다시 불러올 곳이 없으므로 해제하지 않습니다.
+    Cloudinary 업로드 완료 콜백(업로드 스레드)도 loaded_items()를 읽으므로 _loaded 변경은 lock으로 보호합니다.
+    """
+
+    def __init__(self, max_loaded: int = MAX_LOADED_CONVERSATIONS, load_history=None, is_persisted=None):
+        self.max_loaded = max_loaded
+        self.index = {} # title -> ConversationIndexEntry
+        self._loaded = OrderedDict() # title -> chat_history
+        self._load_history = load_history
+        self._is_persisted = is_persisted
+        self.deleted_titles = set() # 다음 저장 시 저장소에서 삭제할 대화
+        self.renamed_titles = [] # 다음 저장 시 저장소에 반영할 (이전 제목, 새 제목) 목록
+        self.load_count = 0
+        self.eviction_count = 0
+        self._lock = threading.RLock()
+
+    def __getitem__(self, title):
+        with self._lock:
+            if title in self._loaded:
+                self._loaded.move_to_end(title)
+                return self._loaded[title]
+        if title not in self.index or self._load_history is None:
+            raise KeyError(title)
+        history = self._load_history(title) # 저장소 읽기 동안에는 lock을 잡지 않음
+        self.load_count += 1
+        with self._lock:
+            self._loaded[title] = history
+            self._evict()
+        return history
+
+    def __setitem__(self, title, history):
+        entry = self.index.get(title)
+        if entry is None or entry.message_count != len(history):
+            self.index[title] = ConversationIndexEntry(time.time(), len(history))
+        with self._lock:
+            self._loaded[title] = history
+            self._loaded.move_to_end(title)
+            self._evict()
+        self.deleted_titles.discard(title)
+
+    def __delitem__(self, title):
+        if title not in self.index:
+            raise KeyError(title)
+        del self.index[title]
+        with self._lock:
+            self._loaded.pop(title, None)
+        self.deleted_titles.add(title)
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, title):
+        return title in self.index
+
+    def rename(self, old_title, new_title):
+        """이력과 색인 항목을 새 제목으로 옮깁니다. 저장소에서는 같은 대화 문서의 제목만 바뀝니다."""
+        history = self[old_title]
+        entry = self.index.pop(old_title)
+        with self._lock:
+            self._loaded.pop(old_title, None)
+            self._loaded[new_title] = history
+        self.index[new_title] = entry
+        self.deleted_titles.discard(new_title)
+        self.renamed_titles.append((old_title, new_title))
+
+    def is_loaded(self, title) -> bool:
+        return title in self._loaded
+
+    def loaded_items(self):
+        """메모리에 있는 대화만 반환합니다 (저장 시 사용, 추가 로드 없음)."""
+        with self._lock:
+            return list(self._loaded.items())
+
+    def titles_by_recency(self) -> list:
+        return sorted(self.index, key=lambda title: self.index[title].updated_at, reverse=True)
+
+    def _evict(self):
+        """lock을 잡은 상태에서 호출합니다."""
+        if self._load_history is None:
+            return
+        for title in list(self._loaded):
+            if len(self._loaded) <= self.max_loaded:
+                break
+            if self._is_persisted is None or self._is_persisted(title, self._loaded[title]):
+                del self._loaded[title]
+                self.eviction_count += 1
+
+@dataclass
+class SyncedConversation:
+    """저장소에 마지막으로 기록된 대화 상태. 다음 저장 시 바뀐 부분만 쓰기 위해 사용합니다."""
+    conversation_id: str
+    title: str | None = None
+    system_instruction: str | None = None
+    message_fingerprints: list | None = None
+
+def _message_fingerprint(entry: dict) -> int:
+    # usage(records 리스트)처럼 해시할 수 없는 값은 JSON 문자열로 바꿔서 포함
+    return hash(tuple((key, json.dumps(value, sort_keys=True) if isinstance(value, (list, dict)) else value)
+                      for key, value in sorted(entry.items())))
+
+@dataclass
+class ConversationWrite:
+    """저장 한 번에서 대화 하나에 대해 기록할 변경."""
+    conversation_id: str
+    messages: list # 대화의 전체 메시지 dict 리스트
+    first_changed_index: int # 이 위치부터의 메시지만 기록 (앞부분은 이미 저장되어 있음)
+    stored_message_count: int # 저장소에 있는 메시지 수 (len(messages) 이상의 위치는 삭제)
+    conversation_data: dict | None # 바뀐 대화 메타데이터 (바뀌지 않았으면 None)
+
+@dataclass
+class SavePlan:
+    """ConversationStore.save()가 계산한 변경분. 백엔드는 이것만 기록하면 됩니다."""
+    deleted_conversations: list # (conversation_id, 저장소에 있을 수 있는 메시지 수)
+    conversation_writes: list # ConversationWrite
+    index: dict # 저장 후의 conversation_index
+    synced: dict # 저장 후의 conversation_id -> SyncedConversation
+    user_changed: bool # 사용자 정보(색인, 마지막 대화, 사용량)를 기록해야 하는지
+    usage_records: list | None = None # 저장소의 사용자 사용량에 더할 records (UsageLedger.take_unsaved())
+    user_usage: dict | None = None # 백엔드가 usage_records를 더한 뒤의 사용자 사용량 (UsageLedger.to_dict())
+
+class ConversationStore(abc.ABC):
+    """
+    사용자 한 명의 대화 저장소 (백엔드 공통 부분).
+    로그인 시에는 대화 색인만 읽고, 대화 이력은 load_conversation으로 필요할 때 불러옵니다.
+    마지막으로 동기화한 상태를 기억하여, 저장 시 새로 추가/변경된 메시지와 바뀐 메타데이터만 기록합니다.
+    하위 클래스는 load_index, load_conversation, cloudinary_public_ids_in_use, _apply_save_plan을 구현합니다.
+    """
+    backend_name = ""
+
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self.conversation_ids = {} # title -> conversation_id
+        self.index = {} # conversation_id -> {title, updated_at, message_count}
+        self.synced = {} # conversation_id -> SyncedConversation (불러오거나 저장한 대화만)
+        self.synced_last_active_title = None
+        self.user_usage = None # 저장소의 사용자 사용량 (load_index가 읽고, save가 더한 뒤의 값으로 갱신)
+        self.last_write_count = 0 # 마지막 save()에서 기록한 문서/행 작업 수
+        self._lock = threading.RLock() # 요청 스레드와 백그라운드 저장 스레드가 함께 사용
+
+    def rename(self, old_title: str, new_title: str):
+        """대화 제목 변경. 같은 conversation_id를 유지하므로 다음 저장 시 제목 필드만 갱신됩니다."""
+        with self._lock:
+            if old_title in self.conversation_ids:
+                self.conversation_ids[new_title] = self.conversation_ids.pop(old_title)
+
+    def is_persisted(self, title: str, history: list) -> bool:
+        """chat_history가 마지막으로 저장(또는 로드)한 내용과 같은지 여부."""
+        with self._lock:
+            synced = self.synced.get(self.conversation_ids.get(title))
+        return synced is not None and synced.title == title and \
+            synced.message_fingerprints == [_message_fingerprint(message.to_storage_dict()) for message in history]
+
+    @abc.abstractmethod
+    def load_index(self) -> tuple[dict, str] | None:
+        """(title -> ConversationIndexEntry, last_active_title)을 반환합니다. 저장된 데이터가 없으면 None."""
+
+    @abc.abstractmethod
+    def load_conversation(self, title: str) -> tuple[str, list]:
+        """(시스템 명령어, 메시지 dict 리스트)를 불러옵니다."""
+
+    @abc.abstractmethod
+    def cloudinary_public_ids_in_use(self, excluded_titles=()) -> set:
+        """excluded_titles를 제외한 저장된 대화들이 참조하는 Cloudinary public_id 집합 (대화 이력은 읽지 않음)."""
+
+    @abc.abstractmethod
+    def _apply_save_plan(self, plan: SavePlan, last_active_title: str) -> int:
+        """plan을 저장소에 기록하고 작업 수를 반환합니다. 실패하면 예외를 던집니다 (동기화 상태는 바뀌지 않음)."""
+
+    def _set_index(self, conversation_index: dict, last_active_title: str) -> tuple[dict, str]:
+        """저장소에서 읽은 색인을 기억하고 load_index()의 반환값으로 변환합니다."""
+        self.index = conversation_index
+        self.conversation_ids = {entry["title"]: conversation_id for conversation_id, entry in conversation_index.items()}
+        self.synced_last_active_title = last_active_title
+        return ({entry["title"]: ConversationIndexEntry(entry.get("updated_at") or 0.0, entry.get("message_count") or 0)
+                 for entry in conversation_index.values()},
+                self.synced_last_active_title)
+
+    def _set_loaded(self, conversation_id: str, title: str, system_instruction: str, messages: list):
+        with self._lock:
+            self.synced[conversation_id] = SyncedConversation(
+                conversation_id, title, system_instruction, [_message_fingerprint(message) for message in messages]
+            )
+
+    def save(self, snapshot: dict, last_active_title: str, deleted_titles=(), renamed_titles=(), usage_records: list | None = None):
+        """
+        snapshot: title -> (system_instruction, 메시지 dict 리스트). 메모리에 불러온 대화만 포함하면 됩니다.
+        이미 기록된 메시지와 공통 접두사가 같으면 뒤에 추가된 메시지만 쓰고, 줄어든 경우(재생성 등) 남는 메시지만 삭제합니다.
+        renamed_titles를 먼저 반영하고, deleted_titles의 대화는 메시지와 함께 삭제합니다.
+        usage_records는 저장된 사용자 사용량에 원자적으로 더합니다 (같은 사용자의 다른 세션이 기록한 사용량을 덮어쓰지 않도록).
+        last_active_title이 None이면(대화 하나만 갱신하는 저장) 저장된 값을 유지합니다.
+        """
+        with self._lock:
+            if last_active_title is None:
+                last_active_title = self.synced_last_active_title or "새로운 대화"
+            for old_title, new_title in renamed_titles:
+                self.rename(old_title, new_title)
+            plan = self._plan_save(snapshot, last_active_title, deleted_titles)
+            if usage_records:
+                plan.usage_records = usage_records
+                plan.user_changed = True
+            write_count = self._apply_save_plan(plan, last_active_title)
+            # 기록이 모두 성공한 뒤에만 동기화 상태 갱신 (실패 시 다음 저장에서 같은 변경을 다시 기록)
+            self.synced = plan.synced
+            self.index = plan.index
+            self.conversation_ids = {entry["title"]: conversation_id for conversation_id, entry in plan.index.items()}
+            self.synced_last_active_title = last_active_title
+            if plan.user_usage is not None:
+                self.user_usage = plan.user_usage
+            self.last_write_count = write_count
+
+    def _plan_save(self, snapshot: dict, last_active_title: str, deleted_titles) -> SavePlan:
+        plan = SavePlan([], [], dict(self.index), dict(self.synced), False)
+        now = time.time()
+
+        for title in deleted_titles:
+            conversation_id = self.conversation_ids.get(title)
+            if conversation_id is None or title in snapshot:
+                continue
+            synced = self.synced.get(conversation_id)
+            message_count = max(len(synced.message_fingerprints) if synced else 0,
+                                (self.index.get(conversation_id) or {}).get("message_count") or 0)
+            plan.deleted_conversations.append((conversation_id, message_count))
+            plan.synced.pop(conversation_id, None)
+            plan.index.pop(conversation_id, None)
+
+        for title, (system_instruction, messages) in snapshot.items():
+            conversation_id = self.conversation_ids.setdefault(title, uuid.uuid4().hex)
+            synced = self.synced.get(conversation_id) or SyncedConversation(conversation_id, message_fingerprints=[])
+            fingerprints = [_message_fingerprint(message) for message in messages]
+
+            common_prefix = 0
+            for old_fingerprint, new_fingerprint in zip(synced.message_fingerprints, fingerprints):
+                if old_fingerprint != new_fingerprint:
+                    break
+                common_prefix += 1
+
+            messages_changed = common_prefix != len(messages) or len(messages) != len(synced.message_fingerprints)
+            conversation_data = None
+            if messages_changed or synced.title != title or synced.system_instruction != system_instruction:
+                updated_at = now if messages_changed or conversation_id not in self.index else self.index[conversation_id].get("updated_at", now)
+                conversation_data = {
+                    "title": title,
+                    "system_instruction": system_instruction,
+                    "message_count": len(messages),
+                    "updated_at": updated_at
+                }
+                if messages_changed:
+                    conversation_data["cloudinary_public_ids"] = sorted(
+                        {message["cloudinary_public_id"] for message in messages if message.get("cloudinary_public_id")}
+                    )
+                plan.index[conversation_id] = {"title": title, "updated_at": updated_at, "message_count": len(messages)}
+            if conversation_data is not None: # 메시지가 바뀌었으면 메타데이터(message_count 등)도 항상 바뀜
+                plan.conversation_writes.append(ConversationWrite(
+                    conversation_id, messages, common_prefix, len(synced.message_fingerprints), conversation_data))
+            plan.synced[conversation_id] = SyncedConversation(conversation_id, title, system_instruction, fingerprints)
+
+        plan.user_changed = plan.index != self.index or last_active_title != self.synced_last_active_title
+        return plan
+
+class FirestoreConversationStore(ConversationStore):
+    """대화별 문서 + messages 서브컬렉션으로 저장하는 Firestore 백엔드."""
+    backend_name = "Firestore"
+
+    def __init__(self, db, user_id: str):
+        super().__init__(user_id)
+        self.db = db
+        self.user_ref = db.collection("user_sessions").document(user_id)
+
+    def _conversation_ref(self, conversation_id: str):
+        return self.user_ref.collection("conversations").document(conversation_id)
+
+    def _message_ref(self, conversation_id: str, index: int):
+        return self._conversation_ref(conversation_id).collection("messages").document(f"{index:06d}")
+
+    def load_index(self) -> tuple[dict, str] | None:
+        """사용자 문서의 conversation_index를 읽습니다. 이전 형식(chat_data)이면 먼저 새 구조로 이전합니다."""
+        user_doc = self.user_ref.get()
+        if not user_doc.exists:
+            return None
+        user_data = user_doc.to_dict()
+        if user_data.get("schema_version", 1) < FIRESTORE_SCHEMA_VERSION and "chat_data" in user_data:
+            self._migrate_legacy_chat_data(user_data)
+            user_data = self.user_ref.get().to_dict()
+
+        conversation_index = user_data.get("conversation_index")
+        if conversation_index is None: # 색인이 없는 경우 대화 문서의 메타데이터로 한 번 재구성
+            conversation_index = {
+                conversation_doc.id: {key: conversation_doc.to_dict().get(key) for key in ("title", "updated_at", "message_count")}
+                for conversation_doc in self.user_ref.collection("conversations").select(["title", "updated_at", "message_count"]).stream()
+            }
+        self.user_usage = user_data.get("usage")
+        return self._set_index(conversation_index, user_data.get("last_active_title", "새로운 대화"))
+
+    def load_conversation(self, title: str) -> tuple[str, list]:
+        with self._lock:
+            conversation_id = self.conversation_ids[title]
+        conversation_doc = self._conversation_ref(conversation_id).get()
+        conversation = conversation_doc.to_dict() if conversation_doc.exists else {}
+        messages = [message_doc.to_dict() for message_doc in
+                    self._conversation_ref(conversation_id).collection("messages").order_by("index").stream()]
+        for message in messages:
+            message.pop("index", None)
+        system_instruction = conversation.get("system_instruction", default_system_instruction)
+        self._set_loaded(conversation_id, title, system_instruction, messages)
+        return system_instruction, messages
+
+    def cloudinary_public_ids_in_use(self, excluded_titles=()) -> set:
+        with self._lock:
+            excluded_ids = {self.conversation_ids.get(title) for title in excluded_titles}
+        public_ids = set()
+        for conversation_doc in self.user_ref.collection("conversations").select(["cloudinary_public_ids"]).stream():
+            if conversation_doc.id not in excluded_ids:
+                public_ids.update(conversation_doc.to_dict().get("cloudinary_public_ids") or [])
+        return public_ids
+
+    def _migrate_legacy_chat_data(self, user_data: dict):
+        """user_sessions/{user_id}.chat_data 하나에 저장된 이전 형식을 대화별 문서로 옮깁니다."""
+        legacy_instructions = user_data.get("system_instructions", {})
+        snapshot = {title: (legacy_instructions.get(title, default_system_instruction), messages)
+                    for title, messages in user_data.get("chat_data", {}).items()}
+        # 이전 도중 실패해도 다음 로그인 시 같은 문서를 덮어쓰도록 제목으로부터 결정적인 ID 사용
+        for title in snapshot:
+            self.conversation_ids[title] = "legacy-" + hashlib.sha1(title.encode("utf-8")).hexdigest()[:20]
+        self.save(snapshot, user_data.get("last_active_title", "새로운 대화"))
+        self.user_ref.update({"chat_data": firestore.DELETE_FIELD, "system_instructions": firestore.DELETE_FIELD})
+        print(f"사용자 ID '{self.user_id}'의 이전 형식 데이터 {len(snapshot)}개 대화를 대화별 문서로 이전했습니다.")
+
+    def _apply_save_plan(self, plan: SavePlan, last_active_title: str) -> int:
+        operations = [] # (kind, ref, data)
+        for conversation_id, message_count in plan.deleted_conversations:
+            # Firestore는 하위 컬렉션을 자동 삭제하지 않으므로 메시지도 직접 삭제
+            for index in range(message_count):
+                operations.append(("delete", self._message_ref(conversation_id, index), None))
+            operations.append(("delete", self._conversation_ref(conversation_id), None))
+
+        for write in plan.conversation_writes:
+            for index in range(write.first_changed_index, len(write.messages)):
+                # to_storage_dict()는 None인 필드를 빼므로, 같은 위치의 이전 메시지 필드가 남지 않도록 문서 전체를 교체
+                operations.append(("replace", self._message_ref(write.conversation_id, index), {"index": index, **write.messages[index]}))
+            for index in range(len(write.messages), write.stored_message_count):
+                operations.append(("delete", self._message_ref(write.conversation_id, index), None))
+            if write.conversation_data is not None:
+                operations.append(("set", self._conversation_ref(write.conversation_id), write.conversation_data))
+
+        if plan.user_changed:
+            # merge에 필드 목록을 지정하여 conversation_index 맵은 통째로 교체 (삭제된 대화 항목이 남지 않도록)
+            user_data = {
+                "schema_version": FIRESTORE_SCHEMA_VERSION,
+                "last_active_title": last_active_title,
+                "conversation_index": plan.index
+            }
+            operations.append(("set", self.user_ref, user_data))
+
+        for chunk_start in range(0, len(operations), FIRESTORE_BATCH_MAX_OPERATIONS):
+            batch = self.db.batch()
+            for kind, ref, data in operations[chunk_start:chunk_start + FIRESTORE_BATCH_MAX_OPERATIONS]:
+                if kind == "set" and ref is self.user_ref:
+                    batch.set(ref, data, merge=list(data.keys()))
+                elif kind == "set":
+                    batch.set(ref, data, merge=True)
+                elif kind == "replace":
+                    batch.set(ref, data)
+                else:
+                    batch.delete(ref)
+            batch.commit()
+
+        if plan.usage_records:
+            plan.user_usage = self._add_usage(plan.usage_records)
+            return len(operations) + 1
+        return len(operations)
+
+    def _add_usage(self, usage_records: list) -> dict:
+        """
+        사용자 문서의 usage에 usage_records를 트랜잭션으로 더하고 결과를 반환합니다.
+        usage는 records 리스트라서 Increment를 쓸 수 없으므로, 읽고-더하고-쓰는 사이에 다른 세션이 기록하면 다시 시도합니다.
+        """
+        @firestore.transactional
+        def add_in_transaction(transaction):
+            user_doc = self.user_ref.get(transaction=transaction)
+            user_usage = UsageLedger.merged(user_doc.to_dict().get("usage") if user_doc.exists else None, usage_records)
+            transaction.set(self.user_ref, {"usage": user_usage}, merge=["usage"])
+            return user_usage
+        return add_in_transaction(self.db.transaction())
+
+class LocalDatabase:
+    """
+    SQLite(WAL 모드) 파일 하나를 여러 스레드에서 쓰기 위한 연결 관리자.
+    sqlite3 연결은 스레드 간에 공유할 수 없으므로 스레드마다 연결을 하나씩 엽니다.
+    WAL 모드에서는 읽기가 쓰기를 기다리지 않으므로, 요청 스레드의 로드와 백그라운드 저장이 서로 막지 않습니다.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._cleanup_lock = threading.Lock()
+        self.last_cleanup_at = 0.0
+        with self.connect() as connection:
+            connection.executescript(LOCAL_STORAGE_SCHEMA)
+            # 사용량/보관 기간 열이 추가되기 전에 만든 파일이면 열을 추가
+            user_columns = {row[1] for row in connection.execute("PRAGMA table_info(users)")}
+            if "usage" not in user_columns:
+                connection.execute("ALTER TABLE users ADD COLUMN usage TEXT")
+            if "anonymous" not in user_columns:
+                connection.execute("ALTER TABLE users ADD COLUMN anonymous INTEGER NOT NULL DEFAULT 0")
+                connection.execute("ALTER TABLE users ADD COLUMN last_saved_at REAL")
+                # 로그인 사용자 ID는 이메일이므로, 그 밖의 기존 사용자는 익명 사용자로 보고 마지막 대화 시각부터 보관 기간을 셈
+                connection.execute("UPDATE users SET anonymous = 1, last_saved_at = (SELECT MAX(updated_at) FROM conversations "
+                                   "WHERE conversations.user_id = users.user_id) WHERE user_id NOT LIKE '%@%'")
+
+    def delete_expired_anonymous_users(self, retention_seconds: float, now: float | None = None) -> int:
+        """
+        마지막 저장 후 retention_seconds가 지난 익명 사용자의 대화/메시지/사용자 정보를 삭제하고 삭제한 사용자 수를 반환합니다.
+        ANONYMOUS_CLEANUP_INTERVAL_SECONDS 안에 이미 정리했으면 아무것도 하지 않습니다.
+        """
+        now = time.time() if now is None else now
+        with self._cleanup_lock:
+            if now - self.last_cleanup_at < ANONYMOUS_CLEANUP_INTERVAL_SECONDS:
+                return 0
+            self.last_cleanup_at = now
+        cutoff = now - retention_seconds
+        connection = self.connect()
+        with connection: # 하나의 트랜잭션
+            expired_user_ids = [(user_id,) for (user_id,) in connection.execute(
+                "SELECT user_id FROM users WHERE anonymous = 1 AND (last_saved_at IS NULL OR last_saved_at < ?)", (cutoff,))]
+            connection.executemany("DELETE FROM messages WHERE user_id = ?", expired_user_ids)
+            connection.executemany("DELETE FROM conversations WHERE user_id = ?", expired_user_ids)
+            connection.executemany("DELETE FROM users WHERE user_id = ?", expired_user_ids)
+        if expired_user_ids:
+            print(f"보관 기간({retention_seconds / 86400:g}일)이 지난 익명 사용자 {len(expired_user_ids)}명의 대화를 삭제했습니다.")
+        return len(expired_user_ids)
+
+    def connect(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=LOCAL_STORAGE_BUSY_TIMEOUT_SECONDS)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL") # WAL에서는 커밋마다 fsync하지 않아도 손상되지 않음
+            self._local.connection = connection
+        return connection
+
+class SQLiteConversationStore(ConversationStore):
+    """
+    로컬 SQLite 파일에 저장하는 백엔드 (자체 호스팅, 네트워크 없는 테스트, 익명 사용자의 로컬 저장).
+    메시지는 (user_id, conversation_id, idx) 기본 키로 저장하므로 대화 하나를 순서대로 읽거나 뒤에 추가하는 작업이 인덱스만 사용합니다.
+    """
+    backend_name = "로컬 저장소"
+
+    def __init__(self, database: LocalDatabase, user_id: str, anonymous: bool = False):
+        super().__init__(user_id)
+        self.database = database
+        self.anonymous = anonymous # 익명 사용자는 ANONYMOUS_RETENTION_DAYS가 지나면 삭제됨
+
+    def load_index(self) -> tuple[dict, str] | None:
+        connection = self.database.connect()
+        user_row = connection.execute("SELECT last_active_title, usage FROM users WHERE user_id = ?", (self.user_id,)).fetchone()
+        if user_row is None:
+            return None
+        self.user_usage = json.loads(user_row[1]) if user_row[1] else None
+        conversation_index = {
+            conversation_id: {"title": title, "updated_at": updated_at, "message_count": message_count}
+            for conversation_id, title, updated_at, message_count in connection.execute(
+                "SELECT conversation_id, title, updated_at, message_count FROM conversations WHERE user_id = ?", (self.user_id,))
+        }
+        return self._set_index(conversation_index, user_row[0] or "새로운 대화")
+
+    def load_conversation(self, title: str) -> tuple[str, list]:
+        with self._lock:
+            conversation_id = self.conversation_ids[title]
+        connection = self.database.connect()
+        conversation_row = connection.execute(
+            "SELECT system_instruction FROM conversations WHERE user_id = ? AND conversation_id = ?",
+            (self.user_id, conversation_id)).fetchone()
+        messages = [json.loads(data) for (data,) in connection.execute(
+            "SELECT data FROM messages WHERE user_id = ? AND conversation_id = ? ORDER BY idx", (self.user_id, conversation_id))]
+        system_instruction = conversation_row[0] if conversation_row and conversation_row[0] is not None else default_system_instruction
+        self._set_loaded(conversation_id, title, system_instruction, messages)
+        return system_instruction, messages
+
+    def cloudinary_public_ids_in_use(self, excluded_titles=()) -> set:
+        with self._lock:
+            excluded_ids = {self.conversation_ids.get(title) for title in excluded_titles}
+        public_ids = set()
+        for conversation_id, public_ids_json in self.database.connect().execute(
+                "SELECT conversation_id, cloudinary_public_ids FROM conversations WHERE user_id = ?", (self.user_id,)):
+            if conversation_id not in excluded_ids and public_ids_json:
+                public_ids.update(json.loads(public_ids_json))
+        return public_ids
+
+    def _apply_save_plan(self, plan: SavePlan, last_active_title: str) -> int:
+        write_count = 0
+        connection = self.database.connect()
+        with connection: # 하나의 트랜잭션 (실패하면 전체 롤백)
+            for conversation_id, _ in plan.deleted_conversations:
+                connection.execute("DELETE FROM messages WHERE user_id = ? AND conversation_id = ?", (self.user_id, conversation_id))
+                connection.execute("DELETE FROM conversations WHERE user_id = ? AND conversation_id = ?", (self.user_id, conversation_id))
+                write_count += 2
+
+            for write in plan.conversation_writes:
+                if write.first_changed_index < write.stored_message_count:
+                    connection.execute("DELETE FROM messages WHERE user_id = ? AND conversation_id = ? AND idx >= ?",
+                                       (self.user_id, write.conversation_id, write.first_changed_index))
+                    write_count += 1
+                appended = [(self.user_id, write.conversation_id, index, json.dumps(write.messages[index], ensure_ascii=False))
+                            for index in range(write.first_changed_index, len(write.messages))]
+                connection.executemany("INSERT INTO messages (user_id, conversation_id, idx, data) VALUES (?, ?, ?, ?)", appended)
+                write_count += len(appended)
+                if write.conversation_data is not None:
+                    data = write.conversation_data
+                    public_ids = data.get("cloudinary_public_ids")
+                    # cloudinary_public_ids가 없으면(메시지가 바뀌지 않음) 기존 값을 유지
+                    connection.execute(
+                        "INSERT INTO conversations (user_id, conversation_id, title, system_instruction, message_count, updated_at, cloudinary_public_ids) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (user_id, conversation_id) DO UPDATE SET "
+                        "title = excluded.title, system_instruction = excluded.system_instruction, message_count = excluded.message_count, "
+                        "updated_at = excluded.updated_at, cloudinary_public_ids = COALESCE(excluded.cloudinary_public_ids, cloudinary_public_ids)",
+                        (self.user_id, write.conversation_id, data["title"], data["system_instruction"], data["message_count"],
+                         data["updated_at"], json.dumps(public_ids) if public_ids is not None else None))
+                    write_count += 1
+
+            if plan.user_changed:
+                connection.execute("INSERT INTO users (user_id, last_active_title, anonymous, last_saved_at) VALUES (?, ?, ?, ?) "
+                                   "ON CONFLICT (user_id) DO UPDATE SET last_active_title = excluded.last_active_title, "
+                                   "anonymous = excluded.anonymous, last_saved_at = excluded.last_saved_at",
+                                   (self.user_id, last_active_title, int(self.anonymous), time.time()))
+                write_count += 1
+            if plan.usage_records:
+                # 위의 쓰기로 이 트랜잭션이 쓰기 잠금을 잡고 있으므로, 다른 세션의 저장과 섞이지 않고 기존 값에 더해짐
+                (stored_usage,) = connection.execute("SELECT usage FROM users WHERE user_id = ?", (self.user_id,)).fetchone()
+                plan.user_usage = UsageLedger.merged(json.loads(stored_usage) if stored_usage else None, plan.usage_records)
+                connection.execute("UPDATE users SET usage = ? WHERE user_id = ?",
+                                   (json.dumps(plan.user_usage, ensure_ascii=False), self.user_id))
+                write_count += 1
+        return write_count
+
+@dataclass
+class PersistenceJob:
+    """사용자 한 명의 대기 중인 저장 작업. 같은 사용자의 요청이 연달아 들어오면 하나로 합쳐집니다."""
+    store: ConversationStore
+    snapshot: dict
+    last_active_title: str | None # None이면 저장된 값 유지 (submit_conversation으로만 만들어진 작업)
+    deleted_titles: set
+    renamed_titles: list
+    first_enqueued_at: float
+    last_enqueued_at: float
+    attempts: int = 0
+    next_attempt_at: float = 0.0
+    force: bool = False # flush 요청 시 디바운스 없이 즉시 기록
+    trace_parent: Span | None = None # 저장을 요청한 쪽의 span (기록 span을 같은 턴의 trace에 남기기 위함)
+    usage_records: list | None = None # 저장소의 사용자 사용량에 더할 records (합쳐지는 작업끼리는 서로 더함)
+
+class PersistenceQueue:
+    """
+    저장소(Firestore/로컬) 기록을 요청 경로에서 분리하는 write-behind 큐.
+    사용자별로 가장 최근 스냅샷만 남기고(삭제/제목 변경 목록은 누적), 디바운스 후 백그라운드 스레드 하나에서 기록합니다.
+    실패 시 지수 백오프로 재시도하며, 마지막까지 실패한 오류는 pop_error()로 요청 스레드에 전달됩니다.
+    """
+
+    def __init__(self):
+        self._pending = {} # user_id -> PersistenceJob
+        self._in_flight = set()
+        self._condition = threading.Condition()
+        self.submitted_count = 0
+        self.coalesced_count = 0
+        self.flushed_count = 0
+        self.retry_count = 0
+        self.failed_count = 0
+        self.last_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+        self._errors = {} # user_id -> 오류 메시지
+        self._thread = threading.Thread(target=self._run, name="faust-persistence", daemon=True)
+        self._thread.start()
+
+    def submit(self, user_id: str, store: ConversationStore, snapshot: dict, last_active_title: str,
+               deleted_titles=(), renamed_titles=(), usage_records: list | None = None):
+        now = time.monotonic()
+        trace_parent = tracer.active_span()
+        with self._condition:
+            self.submitted_count += 1
+            job = self._pending.get(user_id)
+            if job is None:
+                self._pending[user_id] = PersistenceJob(store, snapshot, last_active_title, set(deleted_titles),
+                                                        list(renamed_titles), now, now, trace_parent=trace_parent,
+                                                        usage_records=usage_records or None)
+            else:
+                # 최신 스냅샷이 이전 스냅샷을 대체 (모든 스냅샷은 메모리에 있는 대화 전체를 담고 있음)
+                job.store = store
+                job.snapshot = snapshot
+                job.last_active_title = last_active_title
+                job.usage_records = merge_records(job.usage_records, usage_records) or None
+                job.deleted_titles.update(deleted_titles)
+                job.renamed_titles.extend(renamed_titles)
+                job.last_enqueued_at = now
+                job.trace_parent = job.trace_parent or trace_parent # 기록 span은 처음 저장을 요청한 턴에 남김
+                self.coalesced_count += 1
+            self._condition.notify_all()
+
+    def submit_conversation(self, user_id: str, store: ConversationStore, title: str, system_instruction: str, messages: list):
+        """
+        대화 하나의 최신 상태만 저장을 예약합니다 (요청 스레드 밖, 예: Cloudinary 업로드 완료 콜백에서 호출).
+        대기 중인 작업이 있으면 그 스냅샷에 이 대화만 덮어쓰고, 없으면 이 대화만 담은 작업을 만듭니다.
+        """
+        now = time.monotonic()
+        with self._condition:
+            self.submitted_count += 1
+            job = self._pending.get(user_id)
+            if job is None:
+                self._pending[user_id] = PersistenceJob(store, {title: (system_instruction, messages)}, None, set(), [], now, now)
+            elif title not in job.deleted_titles: # 그 사이 삭제된 대화는 다시 만들지 않음
+                job.snapshot = {**job.snapshot, title: (system_instruction, messages)}
+                job.last_enqueued_at = now
+                self.coalesced_count += 1
+            self._condition.notify_all()
+
+    def depth(self) -> int:
+        """기록 대기 중이거나 기록 중인 사용자 수."""
+        with self._condition:
+            return len(self._pending) + len(self._in_flight)
+
+    def average_flush_seconds(self) -> float:
+        return self.total_flush_seconds / self.flushed_count if self.flushed_count else 0.0
+
+    def pop_error(self, user_id: str) -> str | None:
+        with self._condition:
+            return self._errors.pop(user_id, None)
+
+    def flush(self, user_id: str | None = None, timeout: float = PERSIST_FLUSH_TIMEOUT_SECONDS) -> bool:
+        """대기 중인 저장을 즉시 기록하도록 하고 끝날 때까지 기다립니다 (user_id가 None이면 모든 사용자)."""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            for pending_user_id, job in self._pending.items():
+                if user_id is None or pending_user_id == user_id:
+                    job.force = True
+            self._condition.notify_all()
+            while any(user_id is None or waiting_user_id == user_id for waiting_user_id in (*self._pending, *self._in_flight)):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return True
+
+    def _due_at(self, job: PersistenceJob) -> float:
+        if job.force:
+            return job.next_attempt_at
+        debounced_at = min(job.last_enqueued_at + PERSIST_DEBOUNCE_SECONDS, job.first_enqueued_at + PERSIST_MAX_DELAY_SECONDS)
+        return max(debounced_at, job.next_attempt_at)
+
+    def _next_due_job(self):
+        """기록할 때가 된 작업을 꺼냅니다. 없으면 다음 작업 시각까지 대기합니다 (lock을 잡은 상태에서 호출)."""
+        while True:
+            ready_user_ids = [user_id for user_id in self._pending if user_id not in self._in_flight]
+            if not ready_user_ids:
+                self._condition.wait()
+                continue
+            user_id = min(ready_user_ids, key=lambda pending_user_id: self._due_at(self._pending[pending_user_id]))
+            wait_seconds = self._due_at(self._pending[user_id]) - time.monotonic()
+            if wait_seconds <= 0:
+                self._in_flight.add(user_id)
+                return user_id, self._pending.pop(user_id)
+            self._condition.wait(wait_seconds)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                user_id, job = self._next_due_job()
+
+            start_time = time.perf_counter()
+            error = None
+            save_span = tracer.start_span("storage.save", parent=job.trace_parent, root=job.trace_parent is None,
+                                          backend=job.store.backend_name, attempt=job.attempts + 1)
+            try:
+                job.store.save(job.snapshot, job.last_active_title, job.deleted_titles, job.renamed_titles, job.usage_records)
+                save_span.set_attribute("writes", job.store.last_write_count)
+            except Exception as e:
+                error = e
+                save_span.record_exception(e)
+            save_span.end()
+            flush_seconds = time.perf_counter() - start_time
+
+            with self._condition:
+                self._in_flight.discard(user_id)
+                if error is None:
+                    self.flushed_count += 1
+                    self.last_flush_seconds = flush_seconds
+                    self.total_flush_seconds += flush_seconds
+                    print(f"User data for ID '{user_id}' saved to {job.store.backend_name} ({job.store.last_write_count} writes, {flush_seconds * 1000:.0f}ms).")
+                else:
+                    job.attempts += 1
+                    newer_job = self._pending.get(user_id)
+                    if newer_job is not None:
+                        # 그 사이 들어온 새 스냅샷으로 재시도하되, 실패한 작업의 삭제/제목 변경은 먼저 반영되도록 보존
+                        newer_job.deleted_titles |= job.deleted_titles
+                        newer_job.renamed_titles[:0] = job.renamed_titles
+                        newer_job.usage_records = merge_records(job.usage_records, newer_job.usage_records) or None
+                        newer_job.attempts = job.attempts
+                        self.retry_count += 1
+                    elif job.attempts < PERSIST_MAX_ATTEMPTS:
+                        job.next_attempt_at = time.monotonic() + min(PERSIST_RETRY_BASE_SECONDS * 2 ** (job.attempts - 1), PERSIST_RETRY_MAX_SECONDS)
+                        self._pending[user_id] = job
+                        self.retry_count += 1
+                    else:
+                        self.failed_count += 1
+                        self._errors[user_id] = str(error)
+                        if job.usage_records:
+                            print(f"사용자 ID '{user_id}'의 사용량을 저장하지 못했습니다: {format_usage(job.usage_records)}")
+                    print(f"Error saving data to {job.store.backend_name} (attempt {job.attempts}/{PERSIST_MAX_ATTEMPTS}): {error}")
+                self._condition.notify_all()
+
+@st.cache_resource
+def get_persistence_queue() -> PersistenceQueue:
+    """모든 세션이 공유하는 백그라운드 저장 큐를 반환합니다. 프로세스 종료 시 남은 저장을 기록합니다."""
+    persistence_queue = PersistenceQueue()
+    atexit.register(persistence_queue.flush)
+    return persistence_queue
+
+@st.cache_resource
+def get_local_database() -> LocalDatabase:
+    """모든 세션이 공유하는 로컬 SQLite 저장소를 반환합니다."""
+    return LocalDatabase(LOCAL_STORAGE_PATH)
+
+def create_conversation_store(user_id: str) -> ConversationStore:
+    """로그인 사용자는 STORAGE_BACKEND의 저장소를, 익명 사용자는 로컬 저장소를 사용합니다."""
+    if st.session_state.is_logged_in and STORAGE_BACKEND == "firestore":
+        return FirestoreConversationStore(db, user_id)
+    return SQLiteConversationStore(get_local_database(), user_id, anonymous=not st.session_state.is_logged_in)
+
+def get_conversation_store(user_id: str) -> ConversationStore:
+    """현재 Streamlit 세션의 사용자에 대한 ConversationStore를 반환합니다 (사용자가 바뀌면 새로 생성)."""
+    store = st.session_state.get("conversation_store")
+    if store is None or store.user_id != user_id:
+        store = create_conversation_store(user_id)
+        st.session_state.conversation_store = store
+    return store
+
+def new_saved_sessions(user_id=None) -> ConversationHistoryCache:
+    """saved_sessions 매핑을 만듭니다. user_id가 주어지면(이력을 저장하는 사용자) 대화 이력을 저장소에서 필요할 때 불러옵니다."""
+    if user_id is None:
+        return ConversationHistoryCache()
+    store = get_conversation_store(user_id)
+
+    def load_history(title):
+        system_instruction, messages = store.load_conversation(title)
+        st.session_state.system_instructions[title] = system_instruction
+        return [ChatMessage.from_storage_dict(entry) for entry in messages]
+
+    return ConversationHistoryCache(load_history=load_history, is_persisted=store.is_persisted)
+
+@tracer.traced("storage.load")
 def load_user_data_from_firestore(user_id):
-    """지정된 user_id로 Firestore에서 사용자 데이터를 로드합니다."""
+    """
+    지정된 user_id로 저장소(Firestore 또는 로컬 저장소)에서 대화 색인과 마지막으로 활성화된 대화만 로드합니다.
+    나머지 대화는 선택 시 로드됩니다. 이력을 저장하지 않는 익명 사용자는 저장소를 읽지 않습니다.
+    """
     try:
-        sessions_ref = db.collection("user_sessions").document(user_id)
-        doc = sessions_ref.get()
-        if doc.exists:
-            data = doc.to_dict()
-            st.session_state.saved_sessions = data.get("chat_data", {})
-            for title, history_list in st.session_state.saved_sessions.items():
-                # Firestore에서 불러온 데이터는 (role, text, cloudinary_url, cloudinary_public_id) 형태
-                processed_history = []
-                for item_dict in history_list:
-                    role = item_dict["role"]
-                    text = item_dict["text"]
-                    # 로그인 사용자의 경우, 이미지 바이트는 Firestore에 저장되지 않았으므로 None
-                    image_bytes_raw = None
-                    image_mime_type = None
-                    cloudinary_url = item_dict.get("cloudinary_url")
-                    cloudinary_public_id = item_dict.get("cloudinary_public_id") # public_id 로드
-                    image_bytes_display_resized = None # 로컬 표시용 바이트는 로드 시 필요 없으므로 None
-
-                    # chat_history에 7개 요소 튜플로 추가
-                    processed_history.append((role, text, image_bytes_raw, image_mime_type, cloudinary_url, cloudinary_public_id, image_bytes_display_resized))
-                st.session_state.saved_sessions[title] = processed_history
-
-            st.session_state.system_instructions = data.get("system_instructions", {})
-            st.session_state.current_title = data.get("last_active_title", "새로운 대화")
+        st.session_state.system_instructions = {}
+        st.session_state.usage_ledger = UsageLedger()
+        st.session_state.saved_sessions = new_saved_sessions(user_id if st.session_state.persist_history else None)
+        store = get_conversation_store(user_id) if st.session_state.persist_history else None
+        loaded = store.load_index() if store is not None else None
+        if loaded is not None:
+            conversation_index, last_active_title = loaded
+            tracer.current_span().set_attributes(backend=store.backend_name, conversations=len(conversation_index))
+            st.session_state.saved_sessions.index = conversation_index
+            st.session_state.current_title = last_active_title
+            st.session_state.usage_ledger = UsageLedger.from_dict(store.user_usage)
 
             if st.session_state.current_title in st.session_state.saved_sessions:
                 st.session_state.chat_history = st.session_state.saved_sessions[st.session_state.current_title]
@@ -430,88 +3458,85 @@ def load_user_data_from_firestore(user_id):
                 st.session_state.chat_history = []
 
             st.session_state.temp_system_instruction = st.session_state.system_instructions.get(st.session_state.current_title, default_system_instruction)
-            current_instruction = st.session_state.system_instructions.get(st.session_state.current_title, default_system_instruction)
 
-            # --- ChatSession 초기화 (로드된 데이터 기준) ---
-            st.session_state.chat_session = create_new_chat_session(
-                st.session_state.selected_model,
-                st.session_state.chat_history,
-                current_instruction
-            )
-            st.toast(f"Firestore에서 사용자 ID '{user_id}'의 데이터를 불러왔습니다.", icon="✅")
+            # --- ChatSession은 첫 메시지 전송 시 ChatSessionManager가 로드된 이력으로 생성 ---
+            get_chat_session_manager().invalidate()
+            st.toast(f"{store.backend_name}에서 사용자 ID '{user_id}'의 데이터를 불러왔습니다.", icon="✅")
         else:
             # 데이터가 없는 경우 새로운 사용자 데이터 초기화
-            st.session_state.saved_sessions = {}
-            st.session_state.system_instructions = {}
             st.session_state.chat_history = []
             st.session_state.current_title = "새로운 대화"
             st.session_state.temp_system_instruction = default_system_instruction
-            # --- 새로운 대화에 대한 ChatSession 초기화 ---
-            st.session_state.chat_session = create_new_chat_session(
-                st.session_state.selected_model,
-                [],
-                default_system_instruction
-            )
-            st.toast(f"Firestore에 사용자 ID '{user_id}'에 대한 데이터가 없습니다. 새로운 대화를 시작하세요.", icon="ℹ️")
+            get_chat_session_manager().invalidate()
+            if st.session_state.is_logged_in:
+                st.toast(f"{store.backend_name}에 사용자 ID '{user_id}'에 대한 데이터가 없습니다. 새로운 대화를 시작하세요.", icon="ℹ️")
     except Exception as e:
-        error_message = f"Firestore에서 데이터 로드 중 오류 발생: {e}"
+        error_message = f"저장된 대화 로드 중 오류 발생: {e}"
         print(error_message)
         st.error(error_message)
         # 오류 발생 시에도 기본 상태로 폴백하고 ChatSession은 기본값으로 초기화
-        st.session_state.saved_sessions = {}
+        st.session_state.saved_sessions = new_saved_sessions()
         st.session_state.system_instructions = {}
         st.session_state.chat_history = []
         st.session_state.current_title = "새로운 대화"
         st.session_state.temp_system_instruction = default_system_instruction # 오타 수정 (원래 코드에 있던 오타 `session_session`을 `session_state`로 수정함)
-        st.session_state.chat_session = create_new_chat_session(
-            st.session_state.selected_model,
-            [],
-            default_system_instruction
-        )
+        get_chat_session_manager().invalidate()
 
+@tracer.traced("storage.enqueue")
 def save_user_data_to_firestore(user_id):
-    """현재 사용자 데이터를 Firestore에 저장합니다. 로그인된 사용자만 저장합니다."""
-    # 비로그인(익명) 사용자일 경우 Firestore에 저장하지 않습니다.
-    if not st.session_state.is_logged_in:
-        print(f"익명 사용자 '{user_id}'의 데이터는 Firestore에 저장하지 않습니다.")
+    """
+    현재 사용자 데이터의 저장을 예약합니다. 바뀐 대화/메시지만 기록합니다.
+    로그인 사용자는 STORAGE_BACKEND에, 익명 사용자는 ANONYMOUS_LOCAL_PERSISTENCE가 켜진 경우 로컬 저장소에 저장합니다.
+    """
+    if not st.session_state.persist_history:
+        print(f"익명 사용자 '{user_id}'의 데이터는 저장하지 않습니다.")
         return
 
-    try:
-        sessions_ref = db.collection("user_sessions").document(user_id)
-        chat_data_to_save = {}
-        for title, history_list in st.session_state.saved_sessions.items():
-            # (role, text, image_bytes_raw, image_mime_type, cloudinary_url, cloudinary_public_id, image_bytes_display_resized) 튜플
-            serialized_history = []
-            for item in history_list:
-                role = item[0]
-                text = item[1]
-                # image_bytes_raw = item[2] # Gemini API용 원본 바이트 (Firestore에 저장 안 함)
-                # image_mime_type = item[3] # (Firestore에 저장 안 함)
-                cloudinary_url = item[4] if len(item) > 4 else None # 로그인용 (저장)
-                cloudinary_public_id = item[5] if len(item) > 5 else None # 로그인용 (저장)
-                # image_bytes_display_resized = item[6] # 비로그인용 (저장 안 함)
-
-                entry = {"role": role, "text": text}
-                # 로그인 사용자의 경우, 이미지 바이트는 Firestore에 저장하지 않고 Cloudinary URL과 public_id만 저장
-                if cloudinary_url is not None:
-                    entry["cloudinary_url"] = cloudinary_url
-                if cloudinary_public_id is not None:
-                    entry["cloudinary_public_id"] = cloudinary_public_id
-
-                serialized_history.append(entry)
-            chat_data_to_save[title] = serialized_history
-
-        data_to_save = {
-            "chat_data": chat_data_to_save,
-            "system_instructions": st.session_state.system_instructions,
-            "last_active_title": st.session_state.current_title
-        }
-        sessions_ref.set(data_to_save)
-        print(f"User data for ID '{user_id}' saved to Firestore.")
-    except Exception as e:
-        error_message = f"Error saving data to Firestore: {e}"
-        print(error_message)
-        st.error(error_message)
+    apply_finished_cloudinary_uploads() # 그 사이 끝난 업로드의 public_id를 이번 스냅샷에 포함
+
+    persistence_queue = get_persistence_queue()
+    previous_error = persistence_queue.pop_error(user_id)
+    if previous_error:
+        st.error(f"Error saving data to {get_conversation_store(user_id).backend_name}: {previous_error}")
+
+    # 스냅샷은 요청 스레드에서 만들고, 실제 기록은 백그라운드 큐가 디바운스/병합 후 수행
+    saved_sessions = st.session_state.saved_sessions
+    # 메모리에 불러온 대화만 저장 대상 (불러오지 않은 대화는 바뀌었을 수 없음)
+    snapshot = {
+        title: (st.session_state.system_instructions.get(title, default_system_instruction),
+                [message.to_storage_dict() for message in history_list])
+        for title, history_list in saved_sessions.loaded_items()
+    }
+    persistence_queue.submit(user_id, get_conversation_store(user_id), snapshot, st.session_state.current_title,
+                             deleted_titles=saved_sessions.deleted_titles, renamed_titles=saved_sessions.renamed_titles,
+                             usage_records=st.session_state.usage_ledger.take_unsaved())
+    saved_sessions.deleted_titles = set()
+    saved_sessions.renamed_titles = []
+
+def logout():
+    """진행 중인 업로드와 대기 중인 저장을 모두 기록한 뒤 로그아웃합니다."""
+    if st.session_state.is_logged_in and st.session_state.pending_cloudinary_uploads:
+        apply_finished_cloudinary_uploads(wait_timeout=CLOUDINARY_UPLOAD_WAIT_TIMEOUT_SECONDS)
+        save_user_data_to_firestore(st.session_state.user_id)
+    if st.session_state.persist_history and not get_persistence_queue().flush(st.session_state.user_id):
+        print(f"로그아웃 전 사용자 ID '{st.session_state.user_id}'의 저장이 제한 시간 내에 끝나지 않았습니다.")
+    st.logout()
+
+@st.cache_resource
+def get_cold_start_report() -> dict:
+    """프로세스의 첫 실행(콜드 스타트) 시간 보고를 담아 두는 공유 저장소를 반환합니다."""
+    return {}
+
+def finish_startup_timing():
+    """시작 시간 측정을 마치고, 프로세스의 첫 실행이면 콜드 스타트 보고로 남깁니다."""
+    startup_timer.finish(LAZY_LOAD_TARGETS)
+    st.session_state.last_startup_timer = startup_timer
+    cold_start_report = get_cold_start_report()
+    if "summary" not in cold_start_report:
+        cold_start_report["summary"] = startup_timer.summary()
+        print(f"Cold start: {cold_start_report['summary']}")
+
+startup_timer.mark("정의")
 
 # --- App Logic Execution Flow ---
 # 앱 시작 시 사용자 인증 상태 확인 및 데이터 로드
@@ -523,6 +3548,7 @@ if not st.session_state.data_loaded:
         if user_email: # 이메일 정보가 있다면
             st.session_state.user_id = user_email # 이메일을 user_id로 사용
             st.session_state.is_logged_in = True
+            st.session_state.persist_history = True
             st.session_state.logged_in_user_email = user_email
             st.toast(f"'{user_email}'님으로 로그인되었습니다.", icon="🎉")
             print(f"Logged in user: {user_email}")
@@ -536,20 +3562,33 @@ if not st.session_state.data_loaded:
         st.session_state.is_logged_in = False
         st.session_state.logged_in_user_email = None
         # st.session_state.user_id는 이미 초기화 시 str(uuid.uuid4())로 설정되어 있습니다.
-        st.toast("로그인하지 않은 상태입니다. 대화 이력은 이 기기에만 임시 저장됩니다.", icon="ℹ️")
+        if ANONYMOUS_LOCAL_PERSISTENCE:
+            # URL에 남긴 익명 ID가 있으면 이어서 사용 (UUID 형식만 허용하여 다른 사용자의 ID로 접근하지 못하도록 함)
+            previous_anonymous_id = st.query_params.get(ANONYMOUS_ID_QUERY_PARAM)
+            try:
+                if previous_anonymous_id and str(uuid.UUID(previous_anonymous_id)) == previous_anonymous_id:
+                    st.session_state.user_id = previous_anonymous_id
+            except ValueError:
+                pass
+            st.query_params[ANONYMOUS_ID_QUERY_PARAM] = st.session_state.user_id
+            st.session_state.persist_history = True
+            get_local_database().delete_expired_anonymous_users(ANONYMOUS_RETENTION_DAYS * 86400)
+            st.toast(f"로그인하지 않은 상태입니다. 대화 이력은 서버에 {ANONYMOUS_RETENTION_DAYS}일 동안 보관되며, "
+                     "이 페이지의 주소로 다시 불러올 수 있습니다.", icon="ℹ️")
+        else:
+            st.toast("로그인하지 않은 상태입니다. 대화 이력은 저장되지 않으며 새로고침하면 사라집니다.", icon="ℹ️")
         print("User is not logged in. Using anonymous ID.")
 
     load_user_data_from_firestore(st.session_state.user_id) # 결정된 user_id로 데이터 로드
     st.session_state.data_loaded = True
 
-# ChatSession이 None일 경우 초기화 (앱 시작 시 또는 로그아웃 후)
-if st.session_state.chat_session is None:
-    current_instruction = st.session_state.system_instructions.get(st.session_state.current_title, default_system_instruction)
-    st.session_state.chat_session = create_new_chat_session(
-        st.session_state.selected_model,
-        st.session_state.chat_history,
-        current_instruction
-    )
+# 지난 실행 이후 끝난 백그라운드 Cloudinary 업로드와 제목 생성을 반영하고 저장
+uploads_applied = apply_finished_cloudinary_uploads()
+title_applied = apply_generated_title()
+if (uploads_applied or title_applied) and st.session_state.persist_history:
+    save_user_data_to_firestore(st.session_state.user_id)
+enforce_usage_budget()
+startup_timer.mark("데이터 로드")
 
 # --- Sidebar UI ---
 with st.sidebar:
@@ -562,9 +3601,13 @@ with st.sidebar:
     if st.session_state.is_logged_in: # 로그인된 상태
         st.success(f"로그인 됨: **{st.session_state.logged_in_user_email}**")
         st.markdown(f"사용자 ID: `{st.session_state.user_id}`")
-        st.button("로그아웃", on_click=st.logout, use_container_width=True, disabled=st.session_state.is_generating or st.session_state.delete_confirmation_pending)
+        st.button("로그아웃", on_click=logout, use_container_width=True, disabled=st.session_state.is_generating or st.session_state.delete_confirmation_pending)
     else: # 로그인되지 않은 상태 (익명)
-        st.info("로그인하지 않은 상태입니다. 현재 대화는 이 기기에만 임시 저장됩니다.")
+        if st.session_state.persist_history:
+            st.info(f"로그인하지 않은 상태입니다. 대화는 서버에 {ANONYMOUS_RETENTION_DAYS}일 동안 보관되며, "
+                    "주소(URL)에 포함된 익명 ID만 알면 누구나 불러올 수 있으니 주소를 공유하지 마세요.")
+        else:
+            st.info("로그인하지 않은 상태입니다. 현재 대화는 이 브라우저 세션에만 있고 새로고침하면 사라집니다.")
         st.markdown(f"익명 ID: `{st.session_state.user_id}`") # 익명 ID 표시
 
         st.markdown("---")
@@ -573,22 +3616,24 @@ with st.sidebar:
         st.button("Google로 로그인", on_click=st.login, args=["google"], use_container_width=True, disabled=st.session_state.is_generating or st.session_state.delete_confirmation_pending)
         st.write("---") # UI 구분선 추가
         st.write("로그인 없이 계속하기")
-        st.write("익명 모드로 채팅을 시작합니다. 대화 이력은 저장되지 않습니다.")
+        if st.session_state.persist_history:
+            st.write(f"익명 모드로 채팅합니다. 대화 이력은 서버에 {ANONYMOUS_RETENTION_DAYS}일 동안 보관된 뒤 삭제됩니다.")
+        else:
+            st.write("익명 모드로 채팅합니다. 대화 이력은 저장되지 않습니다.")
 
 
     st.markdown("---")
 
     if st.button("➕ 새로운 대화", use_container_width=True,
                              disabled=st.session_state.is_generating or st.session_state.delete_confirmation_pending):
-        # 현재 대화 상태를 저장 (로그인된 사용자만)
-        if st.session_state.is_logged_in and st.session_state.current_title != "새로운 대화" and st.session_state.chat_history:
+        # 현재 대화 상태를 저장 (이력을 저장하는 사용자만)
+        if st.session_state.persist_history and st.session_state.current_title != "새로운 대화" and st.session_state.chat_history:
             st.session_state.saved_sessions[st.session_state.current_title] = st.session_state.chat_history.copy()
             current_instruction_to_save = st.session_state.temp_system_instruction if st.session_state.temp_system_instruction is not None else st.session_state.system_instructions.get(st.session_state.current_title, default_system_instruction)
             st.session_state.system_instructions[st.session_state.current_title] = current_instruction_to_save
-            save_user_data_to_firestore(st.session_state.user_id) # 로그인된 사용자만 저장
+            save_user_data_to_firestore(st.session_state.user_id) # 이력을 저장하는 사용자만 저장
 
         # 새로운 대화 상태로 초기화
-        st.session_state.chat_session = None
         st.session_state.chat_history = []
         st.session_state.current_title = "새로운 대화"
         st.session_state.temp_system_instruction = default_system_instruction
@@ -596,51 +3641,40 @@ with st.sidebar:
         st.session_state.saved_sessions["새로운 대화"] = [] # 빈 목록으로 저장되도록 보장 (Firestore에 저장되진 않음)
         st.session_state.system_instructions["새로운 대화"] = default_system_instruction
 
-        # --- 새로운 ChatSession 초기화 ---
-        st.session_state.chat_session = create_new_chat_session(
-            st.session_state.selected_model,
-            [],
-            default_system_instruction
-        )
-        # 로그인된 사용자만 저장 (새로운 대화 시작 시점)
-        if st.session_state.is_logged_in:
+        # --- 새로운 대화는 빈 이력으로 ChatSession을 다시 구성 ---
+        get_chat_session_manager().invalidate()
+        # 이력을 저장하는 사용자만 저장 (새로운 대화 시작 시점)
+        if st.session_state.persist_history:
             save_user_data_to_firestore(st.session_state.user_id)
         st.rerun()
 
     if st.session_state.saved_sessions:
         st.subheader("📁 저장된 대화")
-        sorted_keys = sorted(st.session_state.saved_sessions.keys(),
-                                 key=lambda x: st.session_state.saved_sessions[x][-1][1] if st.session_state.saved_sessions[x] else "",
-                                 reverse=True)
-        for key in sorted_keys:
-            if key == "새로운 대화" and not st.session_state.saved_sessions[key]:
+        # 대화 이력을 불러오지 않고 색인(최근 수정 시각, 메시지 수)만으로 목록 구성
+        conversation_index = st.session_state.saved_sessions.index
+        for key in st.session_state.saved_sessions.titles_by_recency():
+            if key == "새로운 대화" and not conversation_index[key].message_count:
                 continue
             display_key = key if len(key) <= 30 else key[:30] + "..."
             if st.button(f"💬 {display_key}", use_container_width=True, key=f"load_session_{key}",
                                  disabled=st.session_state.is_generating or st.session_state.delete_confirmation_pending):
-                # 현재 대화 상태를 저장 (로그인된 사용자만)
-                if st.session_state.is_logged_in and st.session_state.current_title != "새로운 대화" and st.session_state.chat_history:
+                # 현재 대화 상태를 저장 (이력을 저장하는 사용자만)
+                if st.session_state.persist_history and st.session_state.current_title != "새로운 대화" and st.session_state.chat_history:
                     st.session_state.saved_sessions[st.session_state.current_title] = st.session_state.chat_history.copy()
                     current_instruction_to_save = st.session_state.temp_system_instruction if st.session_state.temp_system_instruction is not None else st.session_state.system_instructions.get(st.session_state.current_title, default_system_instruction)
                     st.session_state.system_instructions[st.session_state.current_title] = current_instruction_to_save
-                    save_user_data_to_firestore(st.session_state.user_id) # 로그인된 사용자만 저장
+                    save_user_data_to_firestore(st.session_state.user_id) # 이력을 저장하는 사용자만 저장
 
                 st.session_state.chat_history = st.session_state.saved_sessions[key]
                 st.session_state.current_title = key
                 st.session_state.new_title = key
                 st.session_state.temp_system_instruction = st.session_state.system_instructions.get(key, default_system_instruction)
 
-                # --- 로드된 대화 이력으로 ChatSession 초기화 ---
-                current_instruction = st.session_state.system_instructions.get(st.session_state.current_title, default_system_instruction)
-                st.session_state.chat_session = create_new_chat_session(
-                    st.session_state.selected_model,
-                    st.session_state.chat_history,
-                    current_instruction
-                )
+                # --- ChatSession은 (제목, 모델, 시스템 명령어)가 바뀌었으므로 다음 메시지 전송 시 다시 구성됨 ---
                 st.session_state.editing_instruction = False
                 st.session_state.editing_title = False
-                # 로그인된 사용자만 저장 (대화 로드 시점)
-                if st.session_state.is_logged_in:
+                # 이력을 저장하는 사용자만 저장 (대화 로드 시점)
+                if st.session_state.persist_history:
                     save_user_data_to_firestore(st.session_state.user_id)
                 st.rerun()
 
@@ -656,15 +3690,7 @@ with st.sidebar:
         )
         if selected_model_option != st.session_state.selected_model:
             st.session_state.selected_model = selected_model_option
-            # --- 모델 변경 시 ChatSession 다시 초기화 ---
-            current_instruction = st.session_state.system_instructions.get(
-                st.session_state.current_title, default_system_instruction
-            )
-            st.session_state.chat_session = create_new_chat_session(
-                st.session_state.selected_model,
-                st.session_state.chat_history,
-                current_instruction
-            )
+            # --- 모델 변경 시 ChatSession은 다음 메시지 전송 시 다시 구성됨 (ChatSessionManager key에 모델 포함) ---
             st.toast(f"AI 모델이 '{st.session_state.selected_model}'으로 변경되었습니다.", icon="🤖")
             st.rerun()
 
@@ -673,14 +3699,30 @@ with st.sidebar:
         st.session_state.use_supervision = st.toggle(
             "Supervision 사용",
             value=st.session_state.use_supervision,
-            help="AI 답변의 적절성을 평가하고 필요시 재시도하는 기능을 사용합니다. (기본: 비활성화)",
+            help="AI 답변의 적절성을 평가하고 필요시 재시도하는 기능을 사용합니다. (기본: 비활성화)"
+                 + (" 이번 달 사용량이 예산을 넘어 사용할 수 없습니다." if st.session_state.usage_budget_exceeded else ""),
             key="supervision_toggle",
-            disabled=st.session_state.is_generating or st.session_state.delete_confirmation_pending
+            disabled=st.session_state.is_generating or st.session_state.delete_confirmation_pending or st.session_state.usage_budget_exceeded
+        )
+        st.session_state.speculative_generation = st.toggle(
+            "후보 답변 병렬 생성",
+            value=st.session_state.speculative_generation,
+            help="재시도 횟수만큼의 후보 답변을 동시에 생성·평가하고, 가장 먼저 통과한 답변(없으면 최고 점수 답변)을 사용합니다. 응답은 빨라지지만 API 호출량은 늘어납니다.",
+            key="speculative_generation_toggle",
+            disabled=st.session_state.is_generating or not st.session_state.use_supervision or st.session_state.delete_confirmation_pending
+        )
+        st.session_state.adaptive_supervision = st.toggle(
+            "적응형 Supervision",
+            value=st.session_state.adaptive_supervision,
+            help="지금까지의 점수를 모델·시스템 명령어·질문 유형별로 기록하여, 거의 항상 통과하는 경우 Supervisor 수를 줄이거나 평가를 생략합니다. "
+                 "생략 대상 중 일부는 전체 평가로 감사하여 품질 저하를 감지합니다.",
+            key="adaptive_supervision_toggle",
+            disabled=st.session_state.is_generating or not st.session_state.use_supervision or st.session_state.delete_confirmation_pending
         )
         st.session_state.supervision_max_retries = st.slider(
             "최대 재시도 횟수",
             min_value=1,
-            max_value=5,
+            max_value=SUPERVISION_MAX_RETRIES,
             value=st.session_state.supervision_max_retries,
             disabled=st.session_state.is_generating or not st.session_state.use_supervision or st.session_state.delete_confirmation_pending,
             key="supervision_max_retries_slider"
@@ -688,7 +3730,7 @@ with st.sidebar:
         st.session_state.supervisor_count = st.slider(
             "Supervisor 개수",
             min_value=1,
-            max_value=5,
+            max_value=SUPERVISOR_MAX_COUNT,
             value=st.session_state.supervisor_count,
             disabled=st.session_state.is_generating or not st.session_state.use_supervision or st.session_state.delete_confirmation_pending,
             key="supervisor_count_slider"
@@ -702,9 +3744,105 @@ with st.sidebar:
             disabled=st.session_state.is_generating or not st.session_state.use_supervision or st.session_state.delete_confirmation_pending,
             key="supervision_threshold_slider"
         )
+        supervisor_model_options = AVAILABLE_MODELS if SUPERVISOR_MODEL in AVAILABLE_MODELS else [SUPERVISOR_MODEL] + AVAILABLE_MODELS
+        st.session_state.supervisor_model = st.selectbox(
+            "Supervisor 채점 모델",
+            options=supervisor_model_options,
+            index=supervisor_model_options.index(get_supervisor_model()),
+            help="답변 점수만 매기는 모델입니다. 채팅 모델과 별개로, 저렴하고 빠른 모델을 쓰는 것이 좋습니다.",
+            key="supervisor_model_selector",
+            disabled=st.session_state.is_generating or not st.session_state.use_supervision or st.session_state.delete_confirmation_pending
+        )
         if not st.session_state.use_supervision:
             st.info("Supervision 기능이 비활성화되어 있습니다. AI 답변은 바로 표시됩니다.")
+        else:
+            st.caption(f"Supervisor 채점 결과: {supervisor_scoring_stats.summary()}")
+            if st.session_state.adaptive_supervision:
+                st.caption(f"적응형 Supervision: {get_supervision_policy().summary()}")
+
+        st.write("---")
+        st.session_state.pdf_ingestion_mode = st.selectbox(
+            "PDF 전달 방식",
+            options=list(PDF_INGESTION_MODES.keys()),
+            format_func=lambda mode: PDF_INGESTION_MODES[mode],
+            index=list(PDF_INGESTION_MODES.keys()).index(st.session_state.pdf_ingestion_mode),
+            help="텍스트 우선 방식은 텍스트 레이어가 있는 페이지를 텍스트로 보내 업로드 크기와 토큰을 크게 줄입니다.",
+            key="pdf_ingestion_mode_selector",
+            disabled=st.session_state.is_generating or st.session_state.delete_confirmation_pending
+        )
+        st.session_state.image_preprocess_mode = st.selectbox(
+            "이미지 전처리",
+            options=list(IMAGE_PREPROCESS_MODES.keys()),
+            format_func=lambda mode: IMAGE_PREPROCESS_MODES[mode],
+            index=list(IMAGE_PREPROCESS_MODES.keys()).index(st.session_state.image_preprocess_mode),
+            help="업로드한 이미지를 한 번 축소·재인코딩하여, 이후 모든 턴에서 다시 보내는 이미지 크기를 줄입니다.",
+            key="image_preprocess_mode_selector",
+            disabled=st.session_state.is_generating or st.session_state.delete_confirmation_pending
+        )
+
+        st.write("---")
+        if st.session_state.last_turn_usage is not None:
+            st.caption(f"직전 턴 사용량: {format_usage(st.session_state.last_turn_usage, USAGE_CATEGORY_LABELS)}")
+        conversation_usage = merge_records(*(message.usage for message in st.session_state.chat_history if message.usage))
+        if conversation_usage:
+            st.caption(f"이 대화 사용량: {format_usage(conversation_usage, USAGE_CATEGORY_LABELS)}")
+        usage_ledger = st.session_state.usage_ledger
+        token_budget, cost_budget = get_usage_budget(st.session_state.user_id)
+        budget_text = " / ".join(text for text in (f"{token_budget:,} 토큰" if token_budget else "",
+                                                   f"${cost_budget:.2f}" if cost_budget else "") if text)
+        st.caption(f"이번 달({usage_ledger.period}) 사용량: {format_usage(usage_ledger.current)}"
+                   + (f" (예산 {budget_text})" if budget_text else ""))
+        st.caption(f"누적 사용량: {format_usage(usage_ledger.lifetime)}")
+        if not st.session_state.is_logged_in and (USAGE_ANONYMOUS_MONTHLY_TOKEN_BUDGET or USAGE_ANONYMOUS_MONTHLY_COST_BUDGET_USD):
+            st.caption(f"익명 사용자 전체의 이번 달 사용량: {format_usage(get_anonymous_usage_ledger().current)}")
+        if st.session_state.usage_budget_exceeded:
+            st.warning("이번 달 사용량이 예산을 넘어 Supervision이 꺼져 있습니다.")
+        chat_session_manager = get_chat_session_manager()
+        st.caption(f"ChatSession 재사용: {chat_session_manager.reuse_count}회 / 재구성: {chat_session_manager.rebuild_count}회 "
+                   f"(재사용률 {chat_session_manager.hit_rate() * 100:.0f}%)")
+        saved_sessions = st.session_state.saved_sessions
+        st.caption(f"대화 이력: {len(saved_sessions.loaded_items())}/{len(saved_sessions)}개 로드됨 "
+                   f"(필요 시 로드 {saved_sessions.load_count}회, 메모리 해제 {saved_sessions.eviction_count}회)")
+        persistence_queue = get_persistence_queue()
+        if st.session_state.persist_history:
+            conversation_store = get_conversation_store(st.session_state.user_id)
+            st.caption(f"저장소: {conversation_store.backend_name} (마지막 저장 작업 {conversation_store.last_write_count}건)")
+        st.caption(f"저장 대기열: {persistence_queue.depth()}건, 마지막 저장 {persistence_queue.last_flush_seconds * 1000:.0f}ms "
+                   f"(평균 {persistence_queue.average_flush_seconds() * 1000:.0f}ms), 병합 {persistence_queue.coalesced_count}회, "
+                   f"재시도 {persistence_queue.retry_count}회, 실패 {persistence_queue.failed_count}회")
+        if context_cache is not None:
+            st.caption(f"컨텍스트 캐시: {context_cache.stats()}")
+        if chat_session_manager.context_window.last_report is not None:
+            st.caption(f"컨텍스트: {chat_session_manager.context_window.last_report.summary()}")
+        if st.session_state.last_stream_render_stats is not None:
+            st.caption(f"마지막 응답 스트리밍: {st.session_state.last_stream_render_stats.summary()}")
+        blob_count, blob_bytes, disk_blob_count, disk_blob_bytes = blob_store.stats()
+        st.caption(f"이미지 Blob: 메모리 {blob_count}개 {blob_bytes / (1024 * 1024):.1f}MB / {blob_store.max_bytes / (1024 * 1024):.0f}MB, "
+                   f"디스크 {disk_blob_count}개 {disk_blob_bytes / (1024 * 1024):.1f}MB, 디스크에서 다시 읽음 {blob_store.disk_read_count}회 (모든 세션 공유)")
+        upload_cache = get_upload_cache()
+        st.caption(f"업로드 캐시: {upload_cache.current_bytes / (1024 * 1024):.1f}MB / {upload_cache.max_bytes / (1024 * 1024):.0f}MB, "
+                   f"적중 {upload_cache.hit_count}회 / 미스 {upload_cache.miss_count}회")
+        if is_cloudinary_configured:
+            delete_queue = get_cloudinary_delete_queue()
+            st.caption(f"Cloudinary: 업로드 중 {len(st.session_state.pending_cloudinary_uploads)}개, 삭제 대기 {delete_queue.depth()}개, "
+                       f"삭제 {delete_queue.deleted_count}개 (요청 {delete_queue.request_count}회), 재시도 {delete_queue.retry_count}회")
+            if delete_queue.abandoned:
+                st.warning(f"Cloudinary 이미지 {len(delete_queue.abandoned)}개를 삭제하지 못했습니다.")
+                st.button("삭제 다시 시도", key="retry_cloudinary_deletes", on_click=delete_queue.retry_abandoned)
+        if st.session_state.last_startup_timer is not None:
+            st.caption(f"직전 실행 시간: {st.session_state.last_startup_timer.summary()}")
+        if "summary" in get_cold_start_report():
+            st.caption(f"콜드 스타트: {get_cold_start_report()['summary']}")
+        st.session_state.show_trace_panel = st.toggle(
+            "턴별 추적 표시",
+            value=st.session_state.show_trace_panel,
+            help="최근 턴의 단계별 소요 시간(입력 처리, 첫 청크, 스트리밍, Supervisor 평가, 업로드, 저장)을 waterfall로 표시합니다.",
+            key="show_trace_panel_toggle"
+        )
+        if TRACE_EXPORT_PATH:
+            st.caption(f"추적 내보내기: {TRACE_EXPORT_PATH} (실패 {tracer.export_error_count}회)")
 
+startup_timer.mark("사이드바")
 
 # --- Main Content Area ---
 col1, col2, col3 = st.columns([0.9, 0.05, 0.05])
@@ -727,11 +3865,12 @@ with col2:
             new_title = st.session_state.new_title_input
             if new_title and new_title != st.session_state.current_title:
                 if st.session_state.current_title in st.session_state.saved_sessions:
-                    st.session_state.saved_sessions[new_title] = st.session_state.saved_sessions.pop(st.session_state.current_title)
+                    st.session_state.saved_sessions.rename(st.session_state.current_title, new_title)
                     st.session_state.system_instructions[new_title] = st.session_state.system_instructions.pop(st.session_state.current_title)
+                    get_chat_session_manager().rename_title(st.session_state.current_title, new_title)
                     st.session_state.current_title = new_title
-                    # 로그인된 사용자만 저장
-                    if st.session_state.is_logged_in:
+                    # 이력을 저장하는 사용자만 저장
+                    if st.session_state.persist_history:
                         save_user_data_to_firestore(st.session_state.user_id)
                     st.toast(f"대화 제목이 '{st.session_state.current_title}'로 변경되었습니다.", icon="📝")
                 else:
@@ -763,44 +3902,58 @@ if st.session_state.delete_confirmation_pending:
             if deleted_title in st.session_state.saved_sessions:
                 # 삭제 대상 대화에서 Cloudinary public_id가 있는 이미지들을 찾아 삭제
                 if st.session_state.is_logged_in and is_cloudinary_configured:
-                    for item in st.session_state.saved_sessions[deleted_title]:
-                        # item[5]는 cloudinary_public_id
-                        if len(item) > 5 and item[5] is not None:
-                            delete_from_cloudinary(item[5]) # Cloudinary에서 이미지 삭제 호출
-                            print(f"Cloudinary 이미지 {item[5]} 삭제 시도 중...")
+                    # 업로드 캐시 덕분에 같은 파일은 여러 대화가 같은 public_id를 공유할 수 있으므로, 다른 대화에서 쓰는 이미지는 남겨둠
+                    # 불러오지 않은 대화는 대화 문서의 public_id 목록으로 확인 (이력을 모두 불러오지 않음)
+                    public_ids_in_use = get_conversation_store(st.session_state.user_id).cloudinary_public_ids_in_use(excluded_titles=[deleted_title])
+                    public_ids_in_use.update(
+                        message.cloudinary_public_id
+                        for title, session_messages in st.session_state.saved_sessions.loaded_items() if title != deleted_title
+                        for message in session_messages if message.cloudinary_public_id is not None
+                    )
+                    deleted_messages = st.session_state.saved_sessions[deleted_title]
+                    deleted_public_ids = {
+                        message.cloudinary_public_id for message in deleted_messages
+                        if message.cloudinary_public_id is not None and message.cloudinary_public_id not in public_ids_in_use
+                    }
+                    if deleted_public_ids: # 백그라운드에서 최대 100개씩 묶어 삭제 (실패하면 재시도 장부에 남음)
+                        get_cloudinary_delete_queue().enqueue(deleted_public_ids)
+                        print(f"Cloudinary 이미지 {len(deleted_public_ids)}개 삭제 예약.")
+                    get_upload_cache().forget_cloudinary_public_ids(deleted_public_ids)
+
+                    # 아직 업로드 중인 이미지는 업로드가 끝나면 삭제 (다른 대화의 메시지가 같은 업로드를 기다리고 있으면 남겨둠)
+                    remaining_pending_messages = [
+                        message for message in st.session_state.pending_cloudinary_uploads if message not in deleted_messages
+                    ]
+                    upload_futures_in_use = {message.pending_upload for message in remaining_pending_messages}
+                    for upload_future in {message.pending_upload for message in deleted_messages if message.pending_upload is not None}:
+                        if upload_future not in upload_futures_in_use:
+                            delete_from_cloudinary_when_uploaded(upload_future, get_upload_cache())
+                    st.session_state.pending_cloudinary_uploads = remaining_pending_messages
 
                 # Firestore에서 대화 삭제 (save_user_data_to_firestore가 담당)
                 del st.session_state.saved_sessions[deleted_title]
-                del st.session_state.system_instructions[deleted_title]
+                st.session_state.system_instructions.pop(deleted_title, None)
 
                 st.session_state.current_title = "새로운 대화"
                 st.session_state.chat_history = []
                 st.session_state.temp_system_instruction = default_system_instruction
-                st.session_state.chat_session = create_new_chat_session(
-                    st.session_state.selected_model,
-                    [],
-                    default_system_instruction
-                )
+                get_chat_session_manager().invalidate()
                 st.toast(f"'{deleted_title}' 대화가 삭제되었습니다.", icon="🗑️")
                 if "새로운 대화" not in st.session_state.saved_sessions:
                     st.session_state.saved_sessions["새로운 대화"] = []
                     st.session_state.system_instructions["새로운 대화"] = default_system_instruction
-                # 로그인된 사용자만 저장 (삭제 반영)
-                if st.session_state.is_logged_in:
+                # 이력을 저장하는 사용자만 저장 (삭제 반영)
+                if st.session_state.persist_history:
                     save_user_data_to_firestore(st.session_state.user_id)
             elif deleted_title == "새로운 대화": # "새로운 대화"는 저장된 세션에 없을 수 있음
                 st.session_state.chat_history = []
                 st.session_state.temp_system_instruction = default_system_instruction
-                st.session_state.chat_session = create_new_chat_session(
-                    st.session_state.selected_model,
-                    [],
-                    default_system_instruction
-                )
+                get_chat_session_manager().invalidate()
                 st.toast("현재 대화가 초기화되었습니다.", icon="🗑️")
                 st.session_state.saved_sessions["새로운 대화"] = [] # 빈 목록으로 저장되도록 보장
                 st.session_state.system_instructions["새로운 대화"] = default_system_instruction
-                # 로그인된 사용자만 저장
-                if st.session_state.is_logged_in:
+                # 이력을 저장하는 사용자만 저장
+                if st.session_state.persist_history:
                     save_user_data_to_firestore(st.session_state.user_id)
             else:
                 st.warning(f"'{deleted_title}' 대화를 찾을 수 없습니다. 이미 삭제되었거나 저장되지 않았습니다.")
@@ -835,16 +3988,10 @@ if st.session_state.editing_instruction:
                 st.session_state.system_instructions[st.session_state.current_title] = st.session_state.temp_system_instruction
                 st.session_state.saved_sessions[st.session_state.current_title] = st.session_state.chat_history.copy()
 
-                # --- 시스템 명령어 변경 시 ChatSession 다시 초기화 ---
-                current_instruction = st.session_state.system_instructions.get(st.session_state.current_title, default_system_instruction)
-                st.session_state.chat_session = create_new_chat_session(
-                    st.session_state.selected_model,
-                    st.session_state.chat_history,
-                    current_instruction
-                )
+                # --- 시스템 명령어 변경 시 ChatSession은 다음 메시지 전송 시 다시 구성됨 (ChatSessionManager key에 명령어 포함) ---
 
-                # 로그인된 사용자만 저장
-                if st.session_state.is_logged_in:
+                # 이력을 저장하는 사용자만 저장
+                if st.session_state.persist_history:
                     save_user_data_to_firestore(st.session_state.user_id)
                 st.success("AI 설정이 저장되었습니다.")
                 st.session_state.editing_instruction = False
@@ -856,44 +4003,123 @@ if st.session_state.editing_instruction:
                 st.rerun()
 
 # --- Chat Display Area ---
-chat_display_container = st.container()
+@dataclass
+class MessageRenderSpec:
+    """메시지를 화면에 그릴 때 필요한 값 중 매 rerun마다 다시 계산할 필요가 없는 것들."""
+    image_url: str | None = None # Cloudinary 변환 URL (로그인 사용자)
+    image_format: str | None = None # 표시용 바이트의 이미지 포맷 (st.image가 포맷을 다시 판별하지 않도록 지정)
+
+def get_message_render_spec(message: ChatMessage) -> MessageRenderSpec:
+    """메시지별 표시 정보를 처음 그릴 때 한 번만 계산하여 메시지에 보관합니다."""
+    if message.render_spec is None:
+        render_spec = MessageRenderSpec()
+        if message.cloudinary_public_id: # Cloudinary public_id가 있으면 (로그인 사용자)
+            # Cloudinary Transformation을 URL에 적용하여 이미지 크기 제어
+            # c_limit: 지정된 크기 내에서 이미지 비율 유지하며 조절
+            # w: width. Streamlit이 자체적으로 폭을 조절하는 대신 고정 너비로 제공
+            render_spec.image_url = cloudinary.utils.cloudinary_url(
+                message.cloudinary_public_id, # 'source' 인자로 public_id를 전달
+                width=LOCAL_DISPLAY_WIDTH, # LOCAL_DISPLAY_WIDTH와 동일한 너비로 Cloudinary에서 변환
+                crop="limit", # 'limit' 모드로 지정된 폭을 넘지 않도록 비율 유지
+                secure=True # HTTPS 사용
+            )[0] # cloudinary_url 함수는 튜플을 반환하므로 첫 번째 요소 (URL)만 가져옴
+        elif message.display_digest is not None and message.image_mime_type: # 비로그인 사용자: 리사이즈된 바이트
+            try:
+                image_format = Image.open(io.BytesIO(message.display_bytes)).format
+            except Exception:
+                image_format = None
+            render_spec.image_format = image_format if image_format in ("JPEG", "PNG") else "auto"
+        message.render_spec = render_spec
+    return message.render_spec
+
+CHAT_DISPLAY_WINDOW_MESSAGES = 20 # 처음에 표시하는 최근 메시지 수
+CHAT_DISPLAY_PAGE_MESSAGES = 20 # "이전 메시지 더 보기"를 누를 때마다 추가로 표시하는 메시지 수
+
+# 다른 대화로 바뀌면 다시 최근 메시지만 표시
+if st.session_state.chat_display_title != st.session_state.current_title:
+    st.session_state.chat_display_title = st.session_state.current_title
+    st.session_state.chat_display_limit = CHAT_DISPLAY_WINDOW_MESSAGES
+
+def show_earlier_messages():
+    st.session_state.chat_display_limit += CHAT_DISPLAY_PAGE_MESSAGES
+
+@st.fragment
+def render_chat_history():
+    """
+    최근 chat_display_limit개의 메시지만 그립니다. 이전 메시지 더 보기는 이 fragment만 다시 실행하므로
+    사이드바 등 나머지 화면은 다시 그리지 않습니다.
+    """
+    chat_history = st.session_state.chat_history
+    first_index = max(0, len(chat_history) - st.session_state.chat_display_limit)
+    if first_index > 0:
+        st.button(f"⬆️ 이전 메시지 {min(first_index, CHAT_DISPLAY_PAGE_MESSAGES)}개 더 보기 (숨겨진 메시지 {first_index}개)",
+                  key="load_earlier_messages", use_container_width=True, on_click=show_earlier_messages)
 
-# --- Final Chat History Display (Always Rendered) ---
-with chat_display_container:
-    for i, item in enumerate(st.session_state.chat_history):
-        role, message = item[0], item[1]
-        image_bytes_raw = item[2] if len(item) > 2 else None
-        image_mime_type = item[3] if len(item) > 3 else None
-        cloudinary_url_raw = item[4] if len(item) > 4 else None # Cloudinary 원본 URL (사용되지 않음)
-        cloudinary_public_id = item[5] if len(item) > 5 else None # Cloudinary public_id (URL 생성 및 삭제에 사용)
-        image_bytes_display_resized = item[6] if len(item) > 6 else None # 비로그인 사용자용 리사이즈된 바이트
+    for i in range(first_index, len(chat_history)):
+        chat_message = chat_history[i]
+        role, message = chat_message.role, chat_message.text
+        render_spec = get_message_render_spec(chat_message)
 
         with st.chat_message("ai" if role == "model" else "user"):
-            if cloudinary_public_id: # Cloudinary public_id가 있으면 (로그인 사용자)
-                # Cloudinary Transformation을 URL에 적용하여 이미지 크기 제어
-                # c_limit: 지정된 크기 내에서 이미지 비율 유지하며 조절
-                # w: width. Streamlit이 자체적으로 폭을 조절하는 대신 고정 너비로 제공
-                # h: height. 필요시 추가 가능 (crop="limit"과 함께 사용)
-                transformed_cloudinary_url = cloudinary.utils.cloudinary_url(
-                    cloudinary_public_id, # 'source' 인자로 public_id를 전달
-                    width=LOCAL_DISPLAY_WIDTH, # LOCAL_DISPLAY_WIDTH와 동일한 너비로 Cloudinary에서 변환
-                    crop="limit", # 'limit' 모드로 지정된 폭을 넘지 않도록 비율 유지
-                    secure=True # HTTPS 사용
-                )[0] # cloudinary_url 함수는 튜플을 반환하므로 첫 번째 요소 (URL)만 가져옴
-
-                st.markdown(f"![업로드된 이미지]({transformed_cloudinary_url})")
-            elif image_bytes_display_resized and image_mime_type: # Cloudinary URL이 없고 리사이즈된 바이트 데이터가 있으면 (비로그인 사용자)
-                st.image(image_bytes_display_resized, caption="업로드된 이미지", use_container_width=False) # 이미 리사이즈된 이미지이므로 width 지정 불필요
+            if render_spec.image_url:
+                st.markdown(f"![업로드된 이미지]({render_spec.image_url})")
+            elif render_spec.image_format: # 리사이즈된 바이트 데이터가 있으면 (비로그인 사용자)
+                display_bytes = chat_message.display_bytes
+                if display_bytes is None: # BlobStore 예산을 넘어 삭제된 오래된 이미지
+                    st.caption("🖼️ 이전에 첨부된 이미지는 더 이상 보관되어 있지 않습니다.")
+                else:
+                    st.image(display_bytes, caption="업로드된 이미지", use_container_width=False,
+                             output_format=render_spec.image_format) # 이미 리사이즈된 이미지이므로 width 지정 불필요
 
             st.markdown(message) # 텍스트 메시지 표시 (이미지 아래에)
-            if role == "model" and i == len(st.session_state.chat_history) - 1 and not st.session_state.is_generating \
+            if role == "model" and i == len(chat_history) - 1 and not st.session_state.is_generating \
                 and not st.session_state.delete_confirmation_pending:
                 if st.button("🔄 다시 생성", key=f"regenerate_button_final_{i}", use_container_width=True):
                     st.session_state.regenerate_requested = True
                     st.session_state.is_generating = True
-                    st.session_state.chat_history.pop()
+                    st.session_state.regenerated_usage = st.session_state.chat_history.pop().usage or []
+                    get_chat_session_manager().invalidate() # 다시 생성 시에는 전체 이력으로 ChatSession 재구성
                     st.rerun()
 
+chat_display_container = st.container()
+
+# --- Final Chat History Display (Always Rendered) ---
+with chat_display_container:
+    render_chat_history()
+
+# --- Trace Debug Panel ---
+def render_trace_panel():
+    """최근 턴 하나의 span들을 시작 시각 기준 waterfall 차트와 표로 보여줍니다."""
+    trace_ids = [trace_id for trace_id in st.session_state.recent_turn_trace_ids if tracer.get_trace(trace_id)]
+    with st.expander("⏱️ 턴별 추적", expanded=True):
+        if not trace_ids:
+            st.caption("아직 기록된 턴이 없습니다.")
+            return
+        trace_id = st.selectbox(
+            "턴", trace_ids,
+            format_func=lambda trace_id: f"{trace_ids.index(trace_id) + 1}번째 최근 턴 ({trace_id[:8]})",
+            key="trace_panel_turn_selector"
+        )
+        rows = waterfall_rows(tracer.get_trace(trace_id))
+        for row in rows:
+            row["label"] = f"{row['order'] + 1:>2} {'· ' * row['depth']}{row['name']}"
+        st.vega_lite_chart({
+            "data": {"values": rows},
+            "mark": {"type": "bar", "cornerRadius": 2},
+            "encoding": {
+                "y": {"field": "label", "type": "nominal", "sort": {"field": "order"}, "title": None},
+                "x": {"field": "start_ms", "type": "quantitative", "title": "ms"},
+                "x2": {"field": "end_ms"},
+                "color": {"field": "thread", "type": "nominal", "title": "스레드"},
+                "tooltip": [{"field": "name"}, {"field": "duration_ms", "title": "ms"}, {"field": "status"}, {"field": "attributes"}],
+            },
+        }, use_container_width=True)
+        st.dataframe([{key: row[key] for key in ("label", "start_ms", "duration_ms", "thread", "status", "attributes")} for row in rows],
+                     use_container_width=True, hide_index=True)
+
+if st.session_state.show_trace_panel:
+    render_trace_panel()
+
 # --- Input Area ---
 col_prompt_input, col_upload_icon = st.columns([0.85, 0.15])
 
@@ -918,6 +4144,8 @@ else:
 # (명령어 실행 환경: 가상환경 내에서 Streamlit 앱이 실행될 때)
 if user_prompt is not None and not st.session_state.is_generating:
     if user_prompt != "" or st.session_state.uploaded_file is not None:
+        # 턴 span은 입력 처리부터 응답 생성이 끝날 때까지 (두 번의 스크립트 실행에 걸쳐) 이어짐
+        tracer.activate(start_turn_span(has_file=st.session_state.uploaded_file is not None))
         user_input_gemini_parts = []
 
         # chat_history에 저장될 이미지 데이터, 타입, URL 변수 초기화
@@ -926,6 +4154,7 @@ if user_prompt is not None and not st.session_state.is_generating:
         image_mime_type_for_chat_history = None
         cloudinary_url_for_chat_history = None # 로그인 사용자 전용
         cloudinary_public_id_for_chat_history = None # 로그인 사용자 전용
+        pending_upload_for_chat_history = None # 로그인 사용자 전용 (백그라운드 Cloudinary 업로드)
 
         # UI에 표시될 사용자 메시지 (텍스트 부분만)
         user_prompt_for_display = user_prompt if user_prompt is not None else ""
@@ -939,52 +4168,72 @@ if user_prompt is not None and not st.session_state.is_generating:
             image_bytes_for_chat_history_raw = file_data
             image_mime_type_for_chat_history = file_type
 
+            # 같은 내용의 파일을 이미 처리했다면 캐시된 결과(페이지 Part, 리사이즈 이미지, Cloudinary public_id)를 재사용
+            upload_cache = get_upload_cache()
+            content_hash = hashlib.sha256(file_data).hexdigest()
+
             # --- 이미지 파일 (png, jpg, jpeg) 처리 ---
             if file_type.startswith("image/"):
+                upload_cache_key = (content_hash, file_type, st.session_state.image_preprocess_mode)
+                processed_upload = upload_cache.get(upload_cache_key)
+                if processed_upload is None:
+                    # 업로드 시 한 번만 축소/재인코딩하고, 이후 모든 턴(대화 이력)에는 전처리된 이미지를 사용
+                    preprocessed_bytes, preprocessed_mime_type, preprocess_summary = preprocess_image_for_gemini(
+                        file_data, file_type, st.session_state.image_preprocess_mode)
+                    if preprocess_summary:
+                        print(f"이미지 전처리: {preprocess_summary}")
+                    processed_upload = ProcessedUpload(
+                        # 이번 턴에 Gemini로 보낼 이미지 Part (ChatSession 이력에는 이번 턴의 사용자 메시지가 포함되지 않음)
+                        gemini_parts=[types.Part(
+                            inline_data=types.Blob(
+                                mime_type=preprocessed_mime_type,
+                                data=preprocessed_bytes
+                            )
+                        )],
+                        history_image_bytes=preprocessed_bytes,
+                        history_mime_type=preprocessed_mime_type,
+                        summary=preprocess_summary
+                    )
+                user_input_gemini_parts.extend(processed_upload.gemini_parts)
+                image_bytes_for_chat_history_raw = processed_upload.history_image_bytes
+                image_mime_type_for_chat_history = processed_upload.history_mime_type
+                if processed_upload.summary:
+                    st.caption(f"🖼️ 이미지 전처리: {processed_upload.summary}")
+
                 if st.session_state.is_logged_in and is_cloudinary_configured: # 로그인 & Cloudinary 설정 완료
-                    upload_result = upload_to_cloudinary(file_data) # 원본 파일 업로드
-                    if upload_result:
-                        cloudinary_url_for_chat_history, cloudinary_public_id_for_chat_history = upload_result
-                    else:
-                        st.warning("로그인 상태이지만 Cloudinary 업로드에 실패했습니다. 이미지는 현재 세션에만 임시 저장됩니다.")
-                        # Cloudinary 업로드 실패 시 세션에 임시 저장 및 표시
-                        image_bytes_for_chat_history_display = resize_image_for_display(file_data, LOCAL_DISPLAY_WIDTH)
+                    # 원본 파일 업로드는 백그라운드에서 진행 (같은 파일은 재사용)
+                    cloudinary_url_for_chat_history, cloudinary_public_id_for_chat_history, pending_upload_for_chat_history = \
+                        start_cloudinary_upload(upload_cache, processed_upload, st.session_state.user_id)
+                    if pending_upload_for_chat_history is not None:
+                        # 업로드가 끝날 때까지는 세션의 리사이즈 이미지로 표시
+                        image_bytes_for_chat_history_display = upload_cache.get_display_bytes(processed_upload)
                 else: # 비로그인 사용자 또는 Cloudinary 설정 안 됨
                     # 세션에 임시 저장 및 표시 (리사이즈하여 저장)
-                    image_bytes_for_chat_history_display = resize_image_for_display(file_data, LOCAL_DISPLAY_WIDTH)
+                    image_bytes_for_chat_history_display = upload_cache.get_display_bytes(processed_upload)
+                upload_cache.put(upload_cache_key, processed_upload)
 
             # --- PDF 파일 처리 ---
             elif file_type == "application/pdf":
                 try:
-                    pdf_document = fitz.open(stream=file_data, filetype="pdf")
-                    processed_page_count = 0
-
-                    first_page_image_bytes_raw = None # PDF 원본 첫 페이지 바이트 (Gemini용)
-                    first_page_image_mime_type = None
-
-                    for page_num in range(min(len(pdf_document), MAX_PDF_PAGES_TO_PROCESS)):
-                        page = pdf_document.load_page(page_num)
-                        pix = page.get_pixmap(matrix=fitz.Matrix(300/72, 300/72))
-                        img_bytes = pix.tobytes(format="png")
-
-                        # Gemini API에 전달할 Part (원본 이미지 데이터)
-                        user_input_gemini_parts.append(types.Part(
-                            inline_data=types.Blob(
-                                mime_type="image/png", # PDF 페이지는 PNG로 변환됨
-                                data=base64.b64encode(img_bytes).decode('utf-8')
-                            )
-                        ))
-
-                        if page_num == 0: # 첫 페이지만 chat_history에 저장할 이미지로 지정
-                            first_page_image_bytes_raw = img_bytes
-                            first_page_image_mime_type = "image/png"
-
-                        processed_page_count += 1
+                    upload_cache_key = (content_hash, file_type, st.session_state.pdf_ingestion_mode, PDF_RENDER_DPI, MAX_PDF_PAGES_TO_PROCESS)
+                    processed_upload = upload_cache.get(upload_cache_key)
+                    if processed_upload is not None:
+                        user_input_gemini_parts.extend(processed_upload.gemini_parts)
+                        st.caption(f"📄 이전에 처리한 PDF를 재사용했습니다. ({processed_upload.summary})")
+                    else:
+                        processed_upload = process_pdf_upload(file_data, st.session_state.pdf_ingestion_mode)
+                        user_input_gemini_parts.extend(processed_upload.gemini_parts)
+                        print(f"PDF 렌더링: {processed_upload.summary}")
+                        st.caption(f"📄 {processed_upload.summary}")
 
-                    if len(pdf_document) > MAX_PDF_PAGES_TO_PROCESS:
+                    if processed_upload.total_pages > MAX_PDF_PAGES_TO_PROCESS:
                         st.warning(f"PDF 파일이 {MAX_PDF_PAGES_TO_PROCESS} 페이지를 초과하여 처음 {MAX_PDF_PAGES_TO_PROCESS} 페이지만 처리되었습니다.")
+                    if processed_upload.omitted_pages:
+                        st.warning(f"PDF 페이지의 크기가 {PDF_PARTS_MEMORY_BUDGET_BYTES // (1024 * 1024)}MB를 넘어 "
+                                   f"마지막 {processed_upload.omitted_pages}페이지는 전달되지 않았습니다.")
 
-                    pdf_document.close()
+                    first_page_image_bytes_raw = processed_upload.history_image_bytes
+                    first_page_image_mime_type = processed_upload.history_mime_type
 
                     if first_page_image_bytes_raw: # PDF에서 첫 페이지 이미지가 추출된 경우
                         # Gemini에 전달할 원본 바이트는 항상 저장 (image_bytes_for_chat_history_raw에 저장)
@@ -992,18 +4241,18 @@ if user_prompt is not None and not st.session_state.is_generating:
                         image_mime_type_for_chat_history = first_page_image_mime_type
 
                         if st.session_state.is_logged_in and is_cloudinary_configured: # 로그인 & Cloudinary 설정 완료
-                            upload_result = upload_to_cloudinary(first_page_image_bytes_raw) # 원본 파일 업로드
-                            if upload_result:
-                                cloudinary_url_for_chat_history, cloudinary_public_id_for_chat_history = upload_result
-                            else:
-                                st.warning("로그인 상태이지만 Cloudinary 업로드에 실패하여 PDF 이미지는 현재 세션에만 임시 저장됩니다.")
-                                # Cloudinary 업로드 실패 시 세션에 임시 저장 및 표시
-                                image_bytes_for_chat_history_display = resize_image_for_display(first_page_image_bytes_raw, LOCAL_DISPLAY_WIDTH)
+                            # 첫 페이지 업로드는 백그라운드에서 진행 (같은 파일은 재사용)
+                            cloudinary_url_for_chat_history, cloudinary_public_id_for_chat_history, pending_upload_for_chat_history = \
+                                start_cloudinary_upload(upload_cache, processed_upload, st.session_state.user_id)
+                            if pending_upload_for_chat_history is not None:
+                                # 업로드가 끝날 때까지는 세션의 리사이즈 이미지로 표시
+                                image_bytes_for_chat_history_display = upload_cache.get_display_bytes(processed_upload)
                         else: # 비로그인 사용자 또는 Cloudinary 설정 안 됨
                             # 세션에 임시 저장 및 표시 (리사이즈하여 저장)
-                            image_bytes_for_chat_history_display = resize_image_for_display(first_page_image_bytes_raw, LOCAL_DISPLAY_WIDTH)
+                            image_bytes_for_chat_history_display = upload_cache.get_display_bytes(processed_upload)
                     else:
                         st.warning("PDF에서 유효한 이미지를 추출할 수 없습니다. Gemini에 PDF 내용이 전달되지 않습니다.")
+                    upload_cache.put(upload_cache_key, processed_upload)
 
                 except Exception as e:
                     st.error(f"PDF 파일 처리 중 오류 발생: {e}. PDF 내용을 포함하지 않고 대화를 계속합니다.")
@@ -1020,25 +4269,40 @@ if user_prompt is not None and not st.session_state.is_generating:
             st.warning("제공된 유효한 입력(텍스트 또는 이미지)이 없어 AI에 전달되지 않았습니다. 다시 시도해주세요.")
             st.session_state.is_generating = False
             st.session_state.uploaded_file = None
+            end_turn_span()
             st.rerun()
 
         # chat_history에 사용자 메시지 추가
-        # (role, text_content, image_bytes_raw, image_mime_type, cloudinary_url, cloudinary_public_id, image_bytes_display_resized) 튜플 형태로 확장
-        st.session_state.chat_history.append(
-            ("user", user_prompt_for_display.strip(),
-             image_bytes_for_chat_history_raw, # Gemini에 전달될 원본 바이트 (채팅 기록에도 저장)
-             image_mime_type_for_chat_history,
-             cloudinary_url_for_chat_history, # 로그인 및 Cloudinary 성공 시 URL
-             cloudinary_public_id_for_chat_history, # 로그인 및 Cloudinary 성공 시 public_id
-             image_bytes_for_chat_history_display) # 비로그인 또는 Cloudinary 실패 시 UI 표시용 리사이즈된 바이트
+        # 이미지 바이트는 BlobStore에 보관되고 메시지는 그 digest만 가짐
+        user_message = new_chat_message(
+            "user", user_prompt_for_display.strip(),
+            image_bytes=image_bytes_for_chat_history_raw, # Gemini에 전달될 원본 바이트 (채팅 기록에도 저장)
+            image_mime_type=image_mime_type_for_chat_history,
+            cloudinary_url=cloudinary_url_for_chat_history, # 로그인 및 Cloudinary 업로드가 이미 끝난 경우 URL
+            cloudinary_public_id=cloudinary_public_id_for_chat_history, # 로그인 및 Cloudinary 업로드가 이미 끝난 경우 public_id
+            display_bytes=image_bytes_for_chat_history_display # 비로그인 또는 업로드 진행 중 UI 표시용 리사이즈된 바이트
         )
+        if pending_upload_for_chat_history is not None: # 업로드가 끝나면 완료 콜백이 public_id를 채워 저장하고, apply_finished_cloudinary_uploads()가 표시를 갱신
+            user_message.pending_upload = pending_upload_for_chat_history
+            st.session_state.pending_cloudinary_uploads.append(user_message)
+            persist_cloudinary_upload_when_finished(user_message, st.session_state.user_id)
+        st.session_state.chat_history.append(user_message)
 
         st.session_state.is_generating = True
         st.session_state.last_user_input_gemini_parts = user_input_gemini_parts
         st.rerun()
 
+if st.session_state.pending_title_generation is not None:
+    watch_title_generation()
+
+startup_timer.mark("본문")
+finish_startup_timing() # 응답 생성 시간은 시작 시간에 포함하지 않음
+
 # --- AI Response Generation and Display Logic (Normal & Regeneration) ---
 if st.session_state.is_generating:
+    # 다시 생성 요청은 입력 처리 없이 바로 여기서 턴이 시작됨
+    tracer.activate(st.session_state.turn_span or start_turn_span(regenerate=True))
+    activate_meter(st.session_state.turn_usage) # 이 턴의 모든 Gemini 호출(재시도, Supervisor, 요약 포함)을 기록
     with chat_display_container:
         with st.chat_message("ai"):
             message_placeholder = st.empty()
@@ -1049,7 +4313,98 @@ if st.session_state.is_generating:
             initial_user_contents = st.session_state.last_user_input_gemini_parts
             current_instruction = st.session_state.system_instructions.get(st.session_state.current_title, default_system_instruction)
 
+            supervise_turn = False
             if st.session_state.use_supervision:
+                # 적응형 정책이 켜져 있으면 기록된 점수에 따라 Supervisor 수를 줄이거나 평가를 생략
+                supervision_decision, supervision_policy_key = decide_supervision(initial_user_contents, current_instruction)
+                supervise_turn = not supervision_decision.skip
+                if supervision_decision.mode != "off":
+                    st.caption(f"🧭 적응형 Supervision: {supervision_decision.summary()}")
+
+            if supervise_turn and st.session_state.speculative_generation:
+                candidate_count = st.session_state.supervision_max_retries
+                message_placeholder.markdown(f"🤖 후보 답변 {candidate_count}개를 동시에 생성 중...")
+
+                user_text_for_eval = ""
+                for part in initial_user_contents:
+                    if isinstance(part, types.Part) and part.text:
+                        user_text_for_eval = part.text
+                        break
+                history_for_supervisor_text_only = get_chat_session_manager().context_window.supervisor_history(
+                    st.session_state.current_title, st.session_state.chat_history[:-1])
+
+                candidate_sessions = get_chat_session_manager().get_sessions(
+                    st.session_state.current_title,
+                    st.session_state.selected_model,
+                    st.session_state.chat_history[:-1],
+                    current_instruction,
+                    candidate_count
+                )
+                cancel_event = threading.Event()
+                supervisor_executor = get_supervisor_executor() # 작업 스레드에서는 st.cache_resource를 호출하지 않도록 미리 가져옴
+                candidate_futures = [
+                    get_candidate_executor().submit(
+                        tracer.bind(generate_and_score_candidate),
+                        i,
+                        candidate_session,
+                        initial_user_contents,
+                        cancel_event,
+                        supervisor_executor,
+                        st.session_state.selected_model,
+                        user_input=user_text_for_eval,
+                        chat_history=history_for_supervisor_text_only,
+                        system_instruction=current_instruction,
+                        supervisor_count=supervision_decision.supervisor_count,
+                        threshold=st.session_state.supervision_threshold,
+                        model_name=get_supervisor_model()
+                    )
+                    for i, candidate_session in enumerate(candidate_sessions)
+                ]
+
+                finished_count = 0
+                pending_futures = set(candidate_futures)
+                while pending_futures:
+                    done_futures, pending_futures = wait(pending_futures, return_when=FIRST_COMPLETED)
+                    candidate_passed = False
+                    for future in done_futures:
+                        finished_count += 1
+                        try:
+                            candidate = future.result()
+                        except CandidateCancelled:
+                            continue
+                        except Exception as e:
+                            st.error(f"후보 답변 생성 또는 평가 중 오류 발생: {e}")
+                            continue
+
+                        if candidate.avg_score is None: # 점수 없는 후보는 점수를 받은 후보가 없을 때만 사용
+                            st.warning(f"⚠️ 후보 {candidate.candidate_index + 1}의 Supervisor 평가 결과를 받지 못했습니다 "
+                                       f"({candidate.latency_seconds:.1f}초, {candidate.total_tokens:,} 토큰)")
+                            if not best_ai_response:
+                                best_ai_response = candidate.response_text
+                            continue
+                        get_supervision_policy().record(supervision_policy_key, candidate.avg_score, st.session_state.supervision_threshold,
+                                                        candidate.verdicts, audited=supervision_decision.mode == "audit")
+                        st.info(f"후보 {candidate.candidate_index + 1} 평균 Supervisor 점수: {candidate.avg_score:.2f}점 "
+                                f"({candidate.latency_seconds:.1f}초, {candidate.total_tokens:,} 토큰)")
+                        if candidate.avg_score >= st.session_state.supervision_threshold:
+                            best_ai_response = candidate.response_text
+                            highest_score = candidate.avg_score
+                            st.success(f"✅ 후보 {candidate.candidate_index + 1}의 답변이 Supervision 통과 기준을 만족합니다!")
+                            candidate_passed = True
+                            break
+                        elif candidate.avg_score > highest_score:
+                            highest_score = candidate.avg_score
+                            best_ai_response = candidate.response_text
+                    if candidate_passed:
+                        cancel_event.set() # 진행 중인 후보는 다음 청크에서 중단
+                        for future in pending_futures:
+                            future.cancel() # 아직 시작되지 않은 후보는 취소
+                        break
+                    message_placeholder.markdown(f"🤖 후보 답변 생성 및 평가 중... ({finished_count}/{candidate_count} 완료)")
+
+                if best_ai_response and 0 <= highest_score < st.session_state.supervision_threshold:
+                    st.warning(f"❌ 모든 후보가 Supervision 통과 기준({st.session_state.supervision_threshold}점)을 만족하지 못해 최고 점수 답변을 사용합니다.")
+            elif supervise_turn:
                 attempt_count = 0
                 while attempt_count < st.session_state.supervision_max_retries:
                     attempt_count += 1
@@ -1057,54 +4412,56 @@ if st.session_state.is_generating:
                     full_response = ""
 
                     try:
-                        # ChatSession을 매 시도마다 재초기화
-                        st.session_state.chat_session = create_new_chat_session(
+                        # 이번 턴의 사용자 메시지를 제외한 이력으로 ChatSession을 가져옴 (새로 추가된 메시지만 변환)
+                        chat_session = get_chat_session_manager().get_session(
+                            st.session_state.current_title,
                             st.session_state.selected_model,
-                            st.session_state.chat_history, # 현재까지의 대화 이력 전달
+                            st.session_state.chat_history[:-1],
                             current_instruction # 시스템 명령어 전달 (이제 config에 포함되어 전달됨)
                         )
 
-                        response_stream = st.session_state.chat_session.send_message_stream(initial_user_contents)
-
-                        for chunk in response_stream:
-                            full_response += chunk.text
-                            message_placeholder.markdown(full_response + "▌")
-                        message_placeholder.markdown(full_response)
+                        response_stream = send_message_stream_with_cache_fallback(chat_session, initial_user_contents)
+                        full_response = stream_response_to_placeholder(response_stream, message_placeholder)
 
                         # --- Supervisor 평가 시작 ---
-                        total_score = 0
-                        supervisor_feedback_list = []
-
                         user_text_for_eval = ""
                         for part in initial_user_contents:
                             if isinstance(part, types.Part) and part.text:
                                 user_text_for_eval = part.text
                                 break
 
-                        for i in range(st.session_state.supervisor_count):
-                            # Supervisor 평가 시에는 이미지 데이터 없이 텍스트만 전달
-                            # chat_history가 (role, text, raw_bytes, mime_type, cloudinary_url, public_id, resized_bytes) 튜플이므로,
-                            # 텍스트만 추출해서 전달해야 함.
-                            history_for_supervisor_text_only = []
-                            # 마지막 사용자 메시지를 제외하기 위해 chat_history[:-1] 사용
-                            # 주의: chat_history의 각 item이 튜플이므로, item[1] (텍스트 부분)만 추출
-                            for hist_item in st.session_state.chat_history[:-1]:
-                                history_for_supervisor_text_only.append((hist_item[0], hist_item[1]))
-
-                            score = evaluate_response(
-                                user_input=user_text_for_eval,
-                                chat_history=history_for_supervisor_text_only, # 텍스트만 추출된 히스토리 전달
-                                system_instruction=current_instruction,
-                                ai_response=full_response
-                            )
-                            total_score += score
-                            supervisor_feedback_list.append(f"Supervisor {i+1} 점수: {score}점")
-
-                        avg_score = total_score / st.session_state.supervisor_count
+                        # Supervisor 평가 시에는 이미지 데이터 없이 텍스트만 전달
+                        # 마지막 사용자 메시지를 제외하기 위해 chat_history[:-1] 사용
+                        history_for_supervisor_text_only = get_chat_session_manager().context_window.supervisor_history(
+                            st.session_state.current_title, st.session_state.chat_history[:-1])
+
+                        message_placeholder.markdown(full_response + f"\n\n🧐 Supervisor {supervision_decision.supervisor_count}명이 평가 중...")
+                        avg_score, supervisor_verdicts, supervision_early_exit = run_supervisor_panel(
+                            user_input=user_text_for_eval,
+                            chat_history=history_for_supervisor_text_only, # 텍스트만 추출된 히스토리 전달
+                            system_instruction=current_instruction,
+                            ai_response=full_response,
+                            supervisor_count=supervision_decision.supervisor_count,
+                            threshold=st.session_state.supervision_threshold,
+                            model_name=get_supervisor_model()
+                        )
+                        message_placeholder.markdown(full_response)
+                        if avg_score is None: # 채점 모델이 답하지 못하는 상황이므로 다시 생성해도 평가할 수 없음
+                            st.warning("⚠️ Supervisor 평가 결과를 하나도 받지 못해 (형식 오류, 호출 오류 또는 시간 초과) 이 답변을 점수 없이 사용합니다.")
+                            if not best_ai_response:
+                                best_ai_response = full_response
+                            break
+                        # 감사 결과는 첫 시도의 점수로만 판단 (재시도 답변은 일반 기록)
+                        get_supervision_policy().record(supervision_policy_key, avg_score, st.session_state.supervision_threshold,
+                                                        supervisor_verdicts, audited=supervision_decision.mode == "audit" and attempt_count == 1)
 
                         st.info(f"평균 Supervisor 점수: {avg_score:.2f}점")
-                        for feedback in supervisor_feedback_list:
-                            st.info(feedback)
+                        for verdict in supervisor_verdicts:
+                            score_text = f"{verdict.score}점" if verdict.score is not None else ("시간 초과 (평균에서 제외)" if verdict.timed_out else "평가 실패 (평균에서 제외)")
+                            st.info(f"Supervisor {verdict.supervisor_index + 1} 점수: {score_text} "
+                                    f"({verdict.latency_seconds:.1f}초, {verdict.total_tokens:,} 토큰)")
+                        if supervision_early_exit:
+                            st.caption(f"통과 여부가 확정되어 {len(supervisor_verdicts)}/{supervision_decision.supervisor_count}명의 평가만으로 조기 종료했습니다.")
 
                         if avg_score >= st.session_state.supervision_threshold:
                             best_ai_response = full_response
@@ -1126,19 +4483,16 @@ if st.session_state.is_generating:
                 message_placeholder.markdown("🤖 답변 생성 중...")
                 full_response = ""
                 try:
-                    # ChatSession을 매 시도마다 재초기화
-                    st.session_state.chat_session = create_new_chat_session(
+                    # 이번 턴의 사용자 메시지를 제외한 이력으로 ChatSession을 가져옴 (새로 추가된 메시지만 변환)
+                    chat_session = get_chat_session_manager().get_session(
+                        st.session_state.current_title,
                         st.session_state.selected_model,
-                        st.session_state.chat_history, # 현재까지의 대화 이력 전달
+                        st.session_state.chat_history[:-1],
                         current_instruction # 시스템 명령어 전달 (이제 config에 포함되어 전달됨)
                     )
 
-                    response_stream = st.session_state.chat_session.send_message_stream(initial_user_contents)
-
-                    for chunk in response_stream:
-                        full_response += chunk.text
-                        message_placeholder.markdown(full_response + "▌")
-                    message_placeholder.markdown(full_response)
+                    response_stream = send_message_stream_with_cache_fallback(chat_session, initial_user_contents)
+                    full_response = stream_response_to_placeholder(response_stream, message_placeholder)
                     best_ai_response = full_response
                     highest_score = 100
                 except Exception as e:
@@ -1147,64 +4501,45 @@ if st.session_state.is_generating:
                     st.session_state.uploaded_file = None
 
             if best_ai_response:
-                # AI 응답에는 이미지가 없으므로 (role, text, None, None, None, None, None) 튜플로 저장
-                st.session_state.chat_history.append(("model", best_ai_response, None, None, None, None, None))
+                # AI 응답에는 이미지가 없음
+                st.session_state.chat_history.append(new_chat_message("model", best_ai_response))
                 message_placeholder.markdown(best_ai_response)
-                if st.session_state.use_supervision:
+                if supervise_turn and highest_score >= 0: # 점수 없이 사용한 답변은 점수를 표시하지 않음
                     st.toast(f"대화가 성공적으로 완료되었습니다. 최종 점수: {highest_score:.2f}점", icon="👍")
                 else:
                     st.toast("대화가 성공적으로 완료되었습니다.", icon="👍")
             else:
                 st.error("모든 재시도 후에도 만족스러운 답변을 얻지 못했습니다. 이전 최고 점수 답변을 표시합니다.")
                 if highest_score != -1:
-                    # AI 응답에는 이미지가 없으므로 (role, text, None, None, None, None, None) 튜플로 저장
-                    st.session_state.chat_history.append(("model", best_ai_response, None, None, None, None, None))
+                    # AI 응답에는 이미지가 없음
+                    st.session_state.chat_history.append(new_chat_message("model", best_ai_response))
                     message_placeholder.markdown(best_ai_response)
-                    if st.session_state.use_supervision:
+                    if supervise_turn:
                         st.toast(f"최고 점수 답변이 표시되었습니다. 점수: {highest_score:.2f}점", icon="❗")
                     else:
                         st.toast("최고 점수 답변이 표시되었습니다.", icon="❗")
                 else:
-                    # AI 응답에는 이미지가 없으므로 (role, text, None, None, None, None, None) 튜플로 저장
-                    st.session_state.chat_history.append(("model", "죄송합니다. 현재 요청에 대해 답변을 생성할 수 없습니다.", None, None, None, None, None))
+                    # AI 응답에는 이미지가 없음
+                    st.session_state.chat_history.append(new_chat_message("model", "죄송합니다. 현재 요청에 대해 답변을 생성할 수 없습니다."))
                     message_placeholder.markdown("죄송합니다. 현재 요청에 대해 답변을 생성할 수 없습니다.")
 
+            commit_turn_usage(st.session_state.chat_history[-1]) # 위의 모든 경우에 답변 메시지가 마지막에 추가됨
             st.session_state.uploaded_file = None
             st.session_state.is_generating = False
 
             if st.session_state.current_title == "새로운 대화" and \
                len(st.session_state.chat_history) >= 2 and \
-               st.session_state.chat_history[-2][0] == "user" and st.session_state.chat_history[-1][0] == "model":
-                with st.spinner("대화 제목 생성 중..."):
-                    try:
-                        # 사용자 메시지에서 텍스트 부분만 추출하여 제목 생성 프롬프트에 사용
-                        # chat_history[-2]는 (role, text, ...) 튜플이므로 text만 가져옴
-                        summary_prompt_text = st.session_state.chat_history[-2][1]
-                        summary_response = gemini_client.models.generate_content(
-                            model=st.session_state.selected_model,
-                            contents=[types.Part(text=f"다음 사용자의 메시지를 요약해서 대화 제목으로 만들어줘 (한 문장, 30자 이내):\n\n{summary_prompt_text}")]
-                        )
-                        original_title = summary_response.text.strip().replace("\n", " ").replace('"', '')
-                        if not original_title or len(original_title) > 30:
-                            original_title = "새로운 대화"
-                    except Exception as e:
-                        print(f"제목 생성 오류: {e}. 기본 제목 사용.")
-                        original_title = "새로운 대화"
-
-                    title_key = original_title
-                    count = 1
-                    while title_key in st.session_state.saved_sessions:
-                        title_key = f"{original_title} ({count})"
-                        count += 1
-                    st.session_state.current_title = title_key
-                    st.toast(f"대화 제목이 '{title_key}'로 설정되었습니다.", icon="📝")
-
-            # 로그인된 사용자만 저장
-            if st.session_state.is_logged_in:
-                # chat_history는 이제 이미지 데이터도 포함 (role, text, image_bytes_raw, image_mime_type, cloudinary_url, cloudinary_public_id, image_bytes_display_resized)
+               st.session_state.chat_history[-2].role == "user" and st.session_state.chat_history[-1].role == "model":
+                # 임시 제목을 바로 붙이고, 모델 제목은 백그라운드에서 생성 (첫 답변 직후 저장/재실행을 기다리게 하지 않음)
+                start_title_generation(st.session_state.chat_history[-2])
+
+            # 이력을 저장하는 사용자만 저장
+            if st.session_state.persist_history:
+                # 목록만 복사됨 (ChatMessage는 공유, 이미지 바이트는 BlobStore에 한 번만 보관)
                 st.session_state.saved_sessions[st.session_state.current_title] = st.session_state.chat_history.copy()
                 current_instruction_for_save = st.session_state.temp_system_instruction if st.session_state.temp_system_instruction is not None else st.session_state.system_instructions.get(st.session_state.current_title, default_system_instruction)
                 st.session_state.system_instructions[st.session_state.current_title] = current_instruction_for_save
                 save_user_data_to_firestore(st.session_state.user_id)
 
+            end_turn_span()
             st.rerun()
\ No newline at end of file
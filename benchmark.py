@@ -0,0 +1,442 @@
+"""
+FausT 오프라인 벤치마크.
+
+fake_services의 가짜 Gemini/Firestore/Cloudinary(지연 시간 주입 가능)로 FausT.py를 Streamlit AppTest에서 실행하고,
+턴 전체의 벽시계 시간과 추적 span(TRACE_EXPORT_PATH로 내보낸 JSONL)에 기록된 단계별 시간을 측정합니다.
+외부 서비스의 지연 시간은 고정값이므로, 결과의 차이는 앱 코드의 변화에서 옵니다.
+
+    python benchmark.py                                  # 전체 실행, benchmark_results.json에 저장
+    python benchmark.py --suite supervision --quick
+    python benchmark.py --output after.json --compare before.json
+
+스위트:
+    history      대화 길이별 Gemini 형식 변환(convert_to_gemini_format_for_contents), 컨텍스트 맞춤, 재실행(rerun) 비용
+    supervision  supervisor_count / 재시도 횟수 / 병렬 후보 생성 / 통과·실패별 턴 시간과 호출 수
+    adaptive     적응형 Supervision을 끈/켠 연속 대화의 턴 시간, Supervisor 호출 수, 생략/축소된 턴 수
+    pdf          1/10/100페이지 PDF 업로드 처리 (text_first, raster)
+    storage      대화 수별 저장소 이전·로드·저장 시간과 Firestore 읽기/쓰기 수 (다시 생성 후 메시지 문서에 이전 필드가 남지 않는지 확인)
+"""
+import os
+import sys
+import json
+import hashlib
+import time
+import atexit
+import shutil
+import argparse
+import platform
+import datetime
+import itertools
+import statistics
+import subprocess
+import tempfile
+from collections import defaultdict
+from dataclasses import asdict
+from unittest import mock
+
+import streamlit
+import streamlit.logger
+from streamlit.testing.v1 import AppTest
+
+from fake_services import FakeLatency, FakeServices, install_fake_services
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_PATH = os.path.join(APP_DIR, "FausT.py")
+DEFAULT_OUTPUT_PATH = "benchmark_results.json"
+APP_TIMEOUT_SECONDS = 300 # AppTest 실행 1회의 최대 시간 (100페이지 raster PDF 포함)
+RERUNS_PER_SAMPLE = 3 # history 스위트에서 표본마다 측정하는 입력 없는 재실행 횟수
+STORAGE_SAVE_WAIT_SECONDS = 15.0 # 턴 이후 백그라운드 저장(storage.save span)을 기다리는 최대 시간
+SEEDED_MESSAGE_TEXT = "벤치마크용으로 미리 저장해 둔 메시지입니다. " * 8
+SEEDED_MESSAGES_PER_CONVERSATION = 20 # storage 스위트의 대화당 메시지 수
+STALE_MESSAGE_FIELDS = {"cloudinary_url": "https://res.cloudinary.invalid/fake/stale", "cloudinary_public_id": "stale"} # 다시 생성으로 사라져야 하는 필드
+ADAPTIVE_TURNS = (20, 40) # adaptive 스위트의 턴 수 (--quick, 기본). 정책이 점수를 모아 생략을 시작할 만큼 충분히 길어야 함
+
+class FakeUser(dict):
+    """st.user 대체 객체 (AppTest에서는 OIDC 로그인을 할 수 없으므로 로그인 상태를 직접 지정)."""
+
+    def __init__(self, email: str | None = None):
+        super().__init__({"email": email} if email else {})
+        self.is_logged_in = email is not None
+
+class TraceReader:
+    """앱이 TRACE_EXPORT_PATH에 추가한 span을 마지막으로 읽은 위치 이후부터 읽습니다."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._offset = 0
+
+    def read_new(self) -> list:
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, "rb") as trace_file:
+            trace_file.seek(self._offset)
+            data = trace_file.read()
+        complete = data[:data.rfind(b"\n") + 1] # 쓰는 중인 마지막 줄은 다음에 읽음
+        self._offset += len(complete)
+        return [json.loads(line) for line in complete.decode("utf-8").splitlines() if line]
+
+def span_ms(span: dict) -> float:
+    return (span["endTimeUnixNano"] - span["startTimeUnixNano"]) / 1e6
+
+def spans_named(spans: list, name: str) -> list:
+    return [span for span in spans if span["name"] == name]
+
+class BenchmarkRunner:
+    """가짜 서비스 위에서 AppTest 세션을 만들고 턴을 보내며, 측정 결과를 모읍니다."""
+
+    def __init__(self, services: FakeServices, work_dir: str, repeat: int):
+        self.services = services
+        self.repeat = repeat
+        self.trace = TraceReader(os.path.join(work_dir, "trace.jsonl"))
+        self.secrets = {
+            "FIREBASE_CREDENTIAL_PATH": "{}",
+            "CLOUDINARY_CLOUD_NAME": "benchmark",
+            "CLOUDINARY_API_KEY": "benchmark",
+            "CLOUDINARY_API_SECRET": "benchmark",
+            "GEMINI_CONTEXT_CACHE_BACKEND": "local",
+            "STORAGE_BACKEND": "firestore",
+            "LOCAL_STORAGE_PATH": os.path.join(work_dir, "local.sqlite3"),
+            "TRACE_EXPORT_PATH": self.trace.path,
+        }
+        self.results = []
+        self._user_numbers = itertools.count(1)
+
+    def new_email(self, prefix: str) -> str:
+        return f"{prefix}-{next(self._user_numbers)}@benchmark.invalid"
+
+    def _run(self, app: AppTest, email: str | None, action=None) -> float:
+        """action(없으면 app.run)을 실행하고 걸린 시간(ms)을 반환합니다. 앱에서 예외가 나면 중단합니다."""
+        start_time = time.perf_counter()
+        with mock.patch.object(streamlit, "user", FakeUser(email)):
+            (action or app.run)()
+            while app.session_state.is_generating and not app.exception: # 입력 처리 후 응답 생성 실행
+                app.run()
+        elapsed_ms = (time.perf_counter() - start_time) * 1000
+        if app.exception:
+            raise RuntimeError(f"앱 실행 중 예외: {app.exception[0].value}")
+        return elapsed_ms
+
+    def start(self, email: str | None = None, **session_state) -> tuple[AppTest, float]:
+        """새 세션을 만들고 첫 실행(로그인 사용자는 저장소 로드 포함)을 수행합니다. (AppTest, 첫 실행 ms)"""
+        app = AppTest.from_file(APP_PATH, default_timeout=APP_TIMEOUT_SECONDS)
+        for key, value in self.secrets.items():
+            app.secrets[key] = value
+        for key, value in session_state.items():
+            app.session_state[key] = value
+        return app, self._run(app, email)
+
+    def rerun(self, app: AppTest) -> float:
+        """입력 없는 재실행 (위젯 조작마다 일어나는 스크립트 전체 실행)."""
+        return self._run(app, app.session_state.logged_in_user_email)
+
+    def send_turn(self, app: AppTest, text: str, upload: tuple | None = None) -> float:
+        """메시지(와 파일)를 보내고 응답 생성이 끝날 때까지 걸린 시간(ms)을 반환합니다."""
+        if upload is not None:
+            app.file_uploader[0].set_value(upload)
+        elapsed_ms = self._run(app, app.session_state.logged_in_user_email, app.chat_input[0].set_value(text).run)
+        if upload is not None:
+            app.file_uploader[0].set_value(None) # 다음 턴에 같은 파일을 다시 보내지 않도록 함
+        return elapsed_ms
+
+    def regenerate(self, app: AppTest) -> float:
+        """마지막 답변의 "다시 생성" 버튼을 누르고 새 답변이 끝날 때까지 걸린 시간(ms)을 반환합니다."""
+        button = app.button(key=f"regenerate_button_final_{len(app.session_state.chat_history) - 1}")
+        return self._run(app, app.session_state.logged_in_user_email, button.click().run)
+
+    def check_stored_messages(self, email: str, app: AppTest):
+        """
+        현재 대화의 저장된 메시지 문서가 세션의 메시지와 같은지 확인합니다.
+        같은 위치의 메시지가 바뀌었는데 이전 메시지의 필드(cloudinary_public_id 등)가 남아 있으면 중단합니다.
+        """
+        conversation_id = "legacy-" + hashlib.sha1(app.session_state.current_title.encode("utf-8")).hexdigest()[:20]
+        stored = dict(self.services.firestore._list(f"user_sessions/{email}/conversations/{conversation_id}/messages"))
+        expected = {f"{index:06d}": {"index": index, **message.to_storage_dict()}
+                    for index, message in enumerate(app.session_state.chat_history)}
+        if stored != expected:
+            stale = {document_id: sorted(set(stored.get(document_id, {})) - set(data)) for document_id, data in expected.items()}
+            raise RuntimeError(f"저장된 메시지가 세션과 다릅니다 (남은 필드: { {key: value for key, value in stale.items() if value} })")
+
+    def wait_for_span(self, name: str, timeout: float = STORAGE_SAVE_WAIT_SECONDS) -> list:
+        """name span이 내보내질 때까지 기다리며 그동안 읽은 span을 모두 반환합니다."""
+        spans = []
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            spans.extend(self.trace.read_new())
+            if spans_named(spans, name):
+                break
+            time.sleep(0.1)
+        return spans
+
+    def seed_legacy_user(self, email: str, conversations: int, messages_per_conversation: int, last_message_fields: dict | None = None):
+        """
+        이전 형식(chat_data 하나)의 사용자 문서를 넣어 둡니다. 첫 로그인 시 앱이 대화별 문서로 이전합니다.
+        last_message_fields는 각 대화의 마지막 메시지에 더할 필드입니다 (다시 생성 후 이전 필드가 남지 않는지 확인용).
+        """
+        chat_data = {
+            f"대화 {conversation + 1}": [
+                {"role": "user" if index % 2 == 0 else "model", "text": f"{conversation}-{index} {SEEDED_MESSAGE_TEXT}",
+                 **(last_message_fields if last_message_fields and index == messages_per_conversation - 1 else {})}
+                for index in range(messages_per_conversation)
+            ]
+            for conversation in range(conversations)
+        }
+        self.services.firestore.seed(f"user_sessions/{email}", {
+            "chat_data": chat_data, "system_instructions": {}, "last_active_title": "대화 1"})
+
+    def record(self, suite: str, case: str, params: dict, samples: dict):
+        """표본의 중앙값을 결과에 추가하고 한 줄로 출력합니다."""
+        metrics = {name: round(statistics.median(values), 2) for name, values in samples.items() if values}
+        self.results.append({"suite": suite, "case": case, "params": params, "metrics": metrics,
+                             "samples": {name: [round(value, 2) for value in values] for name, values in samples.items()}})
+        print(f"  {case:<44}" + ", ".join(f"{name} {value:g}" for name, value in metrics.items()), flush=True)
+
+def _stats_delta(before, after, keys) -> dict:
+    return {key: after[key] - before[key] for key in keys}
+
+# --- 스위트 ---
+def bench_history(runner: BenchmarkRunner, quick: bool):
+    """대화 길이별로 전체 변환(새 세션의 첫 턴), 증분 변환(다음 턴), 컨텍스트 맞춤, 재실행 시간을 측정합니다."""
+    for message_count in (20, 200) if quick else (20, 200, 1000):
+        samples = defaultdict(list)
+        for _ in range(runner.repeat):
+            email = runner.new_email("history")
+            runner.seed_legacy_user(email, 1, message_count)
+            runner.start(email) # 이전 형식 데이터 이전
+            app, _ = runner.start(email)
+            for _ in range(RERUNS_PER_SAMPLE):
+                samples["rerun_ms"].append(runner.rerun(app))
+            runner.trace.read_new()
+
+            samples["first_turn_ms"].append(runner.send_turn(app, "이전 대화를 이어서 답해줘"))
+            spans = runner.trace.read_new()
+            conversions = spans_named(spans, "history.convert")
+            if conversions:
+                samples["convert_full_ms"].append(span_ms(max(conversions, key=lambda span: span["attributes"].get("messages", 0))))
+            samples["fit_ms"].extend(span_ms(span) for span in spans_named(spans, "context.fit"))
+            samples["create_session_ms"].extend(span_ms(span) for span in spans_named(spans, "gemini.create_chat_session"))
+
+            samples["next_turn_ms"].append(runner.send_turn(app, "하나 더 물어볼게"))
+            spans = runner.trace.read_new()
+            samples["convert_incremental_ms"].extend(span_ms(span) for span in spans_named(spans, "history.convert"))
+        runner.record("history", f"messages={message_count}", {"messages": message_count}, samples)
+
+def bench_supervision(runner: BenchmarkRunner, quick: bool):
+    """Supervisor 수, 재시도 횟수, 병렬 후보 생성, 통과/실패(항상 재시도) 조합별 턴 시간과 호출 수를 측정합니다."""
+    outcomes = {"pass": (80,), "fail": (30,)} # 기본 통과 점수 50 기준
+    for supervisor_count in (1, 3) if quick else (1, 3, 5):
+        for max_retries in (1, 3):
+            for speculative in (False, True) if max_retries > 1 else (False,):
+                for outcome, scores in outcomes.items():
+                    runner.services.set_supervisor_scores(scores)
+                    app, _ = runner.start(use_supervision=True, supervisor_count=supervisor_count,
+                                          supervision_max_retries=max_retries, speculative_generation=speculative)
+                    runner.trace.read_new()
+                    samples = defaultdict(list)
+                    for turn in range(runner.repeat):
+                        before = runner.services.snapshot()
+                        samples["turn_ms"].append(runner.send_turn(app, f"Supervision 벤치마크 질문 {turn + 1}"))
+                        delta = _stats_delta(before, runner.services.snapshot(), ("gemini.stream", "gemini.supervisor"))
+                        samples["streams"].append(delta["gemini.stream"])
+                        samples["supervisor_calls"].append(delta["gemini.supervisor"])
+                        spans = runner.trace.read_new()
+                        samples["panel_ms"].extend(span_ms(span) for span in spans_named(spans, "supervisor.panel"))
+                        for turn_span in spans_named(spans, "turn"):
+                            if "tokens" in turn_span["attributes"]:
+                                samples["turn_tokens"].append(turn_span["attributes"]["tokens"])
+                                samples["turn_cost_micro_usd"].append(turn_span["attributes"]["cost_usd"] * 1e6)
+                        samples["first_chunk_ms"].extend(span["attributes"]["first_chunk_ms"] for span in spans_named(spans, "gemini.stream")
+                                                         if span["attributes"].get("first_chunk_ms") is not None)
+                    case = f"count={supervisor_count} retries={max_retries} spec={int(speculative)} {outcome}"
+                    runner.record("supervision", case, {"supervisor_count": supervisor_count, "max_retries": max_retries,
+                                                        "speculative": speculative, "outcome": outcome}, samples)
+    runner.services.set_supervisor_scores((80,))
+
+def bench_adaptive(runner: BenchmarkRunner, quick: bool):
+    """
+    거의 항상 통과하는 대화를 적응형 Supervision 없이, 그리고 켠 채로 이어서 보내 턴 시간과 Supervisor 호출 수를 비교합니다.
+    정책은 프로세스에서 공유되므로 켠 경우는 끈 경우에 기록된 점수에서 시작합니다 (이미 운영 중인 앱과 같은 상황).
+    """
+    turn_count = ADAPTIVE_TURNS[0] if quick else ADAPTIVE_TURNS[1]
+    runner.services.set_supervisor_scores((80, 85, 75)) # 기본 통과 점수 50 기준
+    for adaptive in (False, True):
+        app, _ = runner.start(use_supervision=True, supervisor_count=3, adaptive_supervision=adaptive)
+        runner.trace.read_new()
+        samples = defaultdict(list)
+        modes = defaultdict(int)
+        for turn in range(turn_count):
+            before = runner.services.snapshot()
+            samples["turn_ms"].append(runner.send_turn(app, f"적응형 Supervision 벤치마크 질문 {turn + 1}에 답해 주세요"))
+            samples["supervisor_calls"].append(_stats_delta(before, runner.services.snapshot(), ("gemini.supervisor",))["gemini.supervisor"])
+            for turn_span in spans_named(runner.trace.read_new(), "turn"):
+                modes[turn_span["attributes"].get("supervision_mode", "off")] += 1
+        samples["total_supervisor_calls"].append(sum(samples["supervisor_calls"]))
+        for mode in ("skip", "reduced", "audit"):
+            samples[f"{mode}_turns"].append(modes[mode])
+        runner.record("adaptive", f"adaptive={int(adaptive)} turns={turn_count}", {"adaptive": adaptive, "turns": turn_count}, samples)
+    runner.services.set_supervisor_scores((80,))
+
+def make_benchmark_pdf(page_count: int, variant: str) -> bytes:
+    """텍스트 페이지와 이미지 페이지(3페이지마다)가 섞인 PDF를 만듭니다. variant가 다르면 내용(해시)이 달라집니다."""
+    import fitz
+    document = fitz.open()
+    for page_num in range(page_count):
+        page = document.new_page()
+        if page_num % 3 == 2: # 텍스트 레이어가 없는 스캔 페이지 흉내
+            pixmap = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 850, 1100), 0)
+            pixmap.set_rect(pixmap.irect, (40 + page_num % 200, 90, 160))
+            page.insert_image(page.rect, pixmap=pixmap)
+        else:
+            page.insert_text((72, 72), f"{variant} / {page_num + 1}페이지", fontsize=14)
+            for line in range(45):
+                page.insert_text((72, 100 + line * 14), "The quick brown fox jumps over the lazy dog. " * 2, fontsize=9)
+    pdf_bytes = document.tobytes()
+    document.close()
+    return pdf_bytes
+
+def bench_pdf(runner: BenchmarkRunner, quick: bool):
+    """페이지 수와 전달 방식별로 PDF 업로드 턴 시간과 pdf.process 시간을 측정합니다 (표본마다 다른 PDF로 캐시 적중 방지)."""
+    for page_count in (1, 10) if quick else (1, 10, 100):
+        for mode in ("text_first", "raster"):
+            app, _ = runner.start(pdf_ingestion_mode=mode)
+            runner.trace.read_new()
+            samples = defaultdict(list)
+            for sample in range(runner.repeat):
+                pdf_bytes = make_benchmark_pdf(page_count, f"{mode}-{sample}-{time.time_ns()}")
+                samples["turn_ms"].append(runner.send_turn(app, "이 PDF를 요약해줘",
+                                                           upload=(f"benchmark-{page_count}.pdf", pdf_bytes, "application/pdf")))
+                spans = runner.trace.read_new()
+                samples["pdf_process_ms"].extend(span_ms(span) for span in spans_named(spans, "pdf.process"))
+            runner.record("pdf", f"pages={page_count} mode={mode}", {"pages": page_count, "mode": mode}, samples)
+
+def bench_storage(runner: BenchmarkRunner, quick: bool):
+    """
+    대화 수별로 이전 형식 데이터 이전, 새 세션의 로드(색인 + 마지막 대화), 한 턴 후의 저장 시간을 측정합니다.
+    로드 직후 Cloudinary 필드가 있던 마지막 답변을 다시 생성하고, 그 위치의 메시지 문서에 이전 필드가 남지 않았는지 확인합니다.
+    """
+    stat_keys = ("firestore.reads", "firestore.writes", "firestore.round_trips")
+    for conversation_count in (10, 100) if quick else (10, 100, 500):
+        samples = defaultdict(list)
+        for _ in range(runner.repeat):
+            email = runner.new_email("storage")
+            runner.seed_legacy_user(email, conversation_count, SEEDED_MESSAGES_PER_CONVERSATION, STALE_MESSAGE_FIELDS)
+            _, migrate_ms = runner.start(email)
+            samples["migrate_ms"].append(migrate_ms)
+            runner.trace.read_new()
+
+            before = runner.services.snapshot()
+            app, load_run_ms = runner.start(email)
+            delta = _stats_delta(before, runner.services.snapshot(), stat_keys)
+            samples["load_run_ms"].append(load_run_ms)
+            samples["load_reads"].append(delta["firestore.reads"])
+            samples["load_round_trips"].append(delta["firestore.round_trips"])
+            samples["load_ms"].extend(span_ms(span) for span in spans_named(runner.trace.read_new(), "storage.load"))
+
+            # Cloudinary 필드가 있던 마지막 답변을 다시 생성하여 같은 위치의 메시지 문서를 교체
+            samples["regenerate_ms"].append(runner.regenerate(app))
+            runner.wait_for_span("storage.save")
+            runner.check_stored_messages(email, app)
+
+            samples["turn_ms"].append(runner.send_turn(app, "저장 벤치마크 질문"))
+            saves = spans_named(runner.wait_for_span("storage.save"), "storage.save")
+            samples["save_ms"].extend(span_ms(span) for span in saves)
+            samples["save_writes"].extend(span["attributes"].get("writes", 0) for span in saves)
+        runner.record("storage", f"conversations={conversation_count}",
+                      {"conversations": conversation_count, "messages_per_conversation": SEEDED_MESSAGES_PER_CONVERSATION}, samples)
+
+SUITES = {
+    "history": bench_history,
+    "supervision": bench_supervision,
+    "adaptive": bench_adaptive,
+    "pdf": bench_pdf,
+    "storage": bench_storage,
+}
+
+# --- 결과 파일 ---
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=APP_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def write_results(path: str, results: list, latency: FakeLatency, args):
+    report = {
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "quick": args.quick,
+        "repeat": args.repeat,
+        "latency": asdict(latency),
+        "results": results,
+    }
+    with open(path, "w", encoding="utf-8") as output_file:
+        json.dump(report, output_file, ensure_ascii=False, indent=2)
+    print(f"결과 저장: {path}")
+
+def compare_results(baseline_path: str, results: list):
+    """같은 (스위트, 케이스)의 ms 지표를 이전 결과와 비교해 출력합니다."""
+    with open(baseline_path, encoding="utf-8") as baseline_file:
+        baseline = json.load(baseline_file)
+    print(f"비교 기준: {baseline_path} ({baseline.get('git_commit')}, {baseline.get('created_at')})")
+    baseline_metrics = {(result["suite"], result["case"]): result["metrics"] for result in baseline["results"]}
+    print(f"{'케이스':<58}{'지표':<24}{'이전':>10}{'현재':>10}{'변화':>9}")
+    for result in results:
+        previous = baseline_metrics.get((result["suite"], result["case"]))
+        if previous is None:
+            continue
+        for name, value in result["metrics"].items():
+            if not name.endswith("_ms") or not previous.get(name):
+                continue
+            change = (value - previous[name]) / previous[name] * 100
+            print(f"{result['suite'] + ' ' + result['case']:<58}{name:<24}{previous[name]:>10.1f}{value:>10.1f}{change:>+8.1f}%")
+
+def main():
+    parser = argparse.ArgumentParser(description="가짜 Gemini/Firestore/Cloudinary로 FausT를 실행하는 오프라인 벤치마크")
+    parser.add_argument("--suite", default=",".join(SUITES), help=f"쉼표로 구분한 스위트 ({', '.join(SUITES)})")
+    parser.add_argument("--repeat", type=int, default=3, help="케이스마다 측정할 표본 수 (중앙값 사용)")
+    parser.add_argument("--quick", action="store_true", help="가장 큰 크기(1000개 메시지, 100페이지, 500개 대화, Supervisor 5명)를 제외")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT_PATH)
+    parser.add_argument("--compare", help="비교할 이전 결과 파일")
+    defaults = FakeLatency()
+    parser.add_argument("--gemini-call-ms", type=float, default=defaults.gemini_call_seconds * 1000)
+    parser.add_argument("--first-chunk-ms", type=float, default=defaults.first_chunk_seconds * 1000)
+    parser.add_argument("--chunk-interval-ms", type=float, default=defaults.chunk_interval_seconds * 1000)
+    parser.add_argument("--response-chunks", type=int, default=defaults.response_chunks)
+    parser.add_argument("--firestore-read-ms", type=float, default=defaults.firestore_read_seconds * 1000)
+    parser.add_argument("--firestore-write-ms", type=float, default=defaults.firestore_write_seconds * 1000)
+    parser.add_argument("--cloudinary-upload-ms", type=float, default=defaults.cloudinary_upload_seconds * 1000)
+    args = parser.parse_args()
+
+    suites = [name.strip() for name in args.suite.split(",") if name.strip()]
+    unknown = [name for name in suites if name not in SUITES]
+    if unknown:
+        parser.error(f"알 수 없는 스위트: {', '.join(unknown)}")
+    latency = FakeLatency(
+        gemini_call_seconds=args.gemini_call_ms / 1000,
+        first_chunk_seconds=args.first_chunk_ms / 1000,
+        chunk_interval_seconds=args.chunk_interval_ms / 1000,
+        response_chunks=args.response_chunks,
+        firestore_read_seconds=args.firestore_read_ms / 1000,
+        firestore_write_seconds=args.firestore_write_ms / 1000,
+        cloudinary_upload_seconds=args.cloudinary_upload_ms / 1000,
+    )
+
+    os.chdir(APP_DIR) # 앱이 assets/ 등을 상대 경로로 참조
+    streamlit.logger.set_log_level("error") # AppTest 실행마다 나오는 ScriptRunContext/사용 중단 경고 생략
+    work_dir = tempfile.mkdtemp(prefix="faust-benchmark-")
+    # 앱이 등록하는 종료 처리(저장 큐 flush, 추적 파일 닫기)가 끝난 뒤에 지우도록 먼저 등록 (atexit는 역순 실행)
+    atexit.register(shutil.rmtree, work_dir, True)
+    services = FakeServices(latency)
+    runner = BenchmarkRunner(services, work_dir, args.repeat)
+    with install_fake_services(services):
+        for suite in suites:
+            print(f"[{suite}]", flush=True)
+            SUITES[suite](runner, args.quick)
+    write_results(args.output, runner.results, latency, args)
+    if args.compare:
+        compare_results(args.compare, runner.results)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,378 @@
+"""
+오프라인 벤치마크/개발용 가짜 외부 서비스 (Gemini, Firestore, Cloudinary).
+
+실제 API를 호출하지 않고 지연 시간(첫 청크까지의 시간, 청크 간격, 호출/왕복 시간)만 흉내 내며,
+호출 횟수와 토큰 수, Firestore 읽기/쓰기 수를 FakeServices.stats에 집계합니다.
+install_fake_services()는 FausT.py가 사용하는 google.genai.Client, Firebase Admin의 Firestore 클라이언트,
+Cloudinary 업로드/삭제 함수를 이 가짜 서비스로 교체합니다 (같은 프로세스에서 AppTest로 앱을 실행할 때 사용).
+"""
+import json
+import time
+import uuid
+import itertools
+import threading
+from collections import Counter
+from contextlib import contextmanager, ExitStack
+from dataclasses import dataclass
+from unittest import mock
+
+from google.genai import types
+
+from pdf_pipeline import estimate_text_tokens
+
+@dataclass
+class FakeLatency:
+    """가짜 서비스의 지연 시간 설정 (초). 실행 중에 바꾸면 다음 호출부터 반영됩니다."""
+    gemini_call_seconds: float = 0.05 # generate_content / count_tokens 1회
+    first_chunk_seconds: float = 0.2 # send_message_stream의 첫 청크까지
+    chunk_interval_seconds: float = 0.01 # 이후 청크 사이 간격
+    response_chunks: int = 30 # 답변 하나의 청크 수
+    firestore_read_seconds: float = 0.005 # 문서 get / 컬렉션 stream 1회
+    firestore_write_seconds: float = 0.02 # 배치 commit 또는 단일 set/update/delete 1회
+    cloudinary_upload_seconds: float = 0.2
+    cloudinary_delete_seconds: float = 0.05
+
+RESPONSE_CHUNK_TEXT = "오프라인 벤치마크용 가짜 답변입니다. "
+FAKE_TITLE_TEXT = "벤치마크 대화"
+
+def _contents_text(contents) -> str:
+    """generate_content/send_message에 전달된 contents에서 텍스트만 모읍니다 (토큰 추정과 요청 종류 판별용)."""
+    if contents is None:
+        return ""
+    if isinstance(contents, str):
+        return contents
+    if isinstance(contents, types.Part):
+        return contents.text or ""
+    if isinstance(contents, types.Content):
+        return "".join(part.text or "" for part in contents.parts or [])
+    if isinstance(contents, (list, tuple)):
+        return "".join(_contents_text(item) for item in contents)
+    return ""
+
+def _usage(prompt_text: str, response_text: str) -> types.GenerateContentResponseUsageMetadata:
+    prompt_tokens = estimate_text_tokens(prompt_text)
+    response_tokens = estimate_text_tokens(response_text)
+    return types.GenerateContentResponseUsageMetadata(prompt_token_count=prompt_tokens, candidates_token_count=response_tokens,
+                                                      total_token_count=prompt_tokens + response_tokens)
+
+class FakeResponse:
+    """generate_content 응답 / 스트림 청크 (FausT.py가 사용하는 text, usage_metadata만 제공)."""
+
+    def __init__(self, text: str, usage_metadata=None):
+        self.text = text
+        self.usage_metadata = usage_metadata
+        self.candidates = None
+        self.parsed = None
+
+# --- Gemini ---
+class FakeChat:
+    """client.chats.create()가 반환하는 ChatSession. 스트림이 끝나면 이력에 이번 턴을 추가합니다."""
+
+    def __init__(self, services, model: str, config, history):
+        self.services = services
+        self.model = model
+        self.config = config
+        self._history = list(history or [])
+
+    def get_history(self, curated: bool = False) -> list:
+        return list(self._history)
+
+    def send_message_stream(self, message, config=None):
+        latency = self.services.latency
+        prompt_text = _contents_text(self._history) + _contents_text(message)
+        self.services.count("gemini.stream")
+        time.sleep(latency.first_chunk_seconds)
+        chunks = []
+        for index in range(latency.response_chunks):
+            if index:
+                time.sleep(latency.chunk_interval_seconds)
+            chunks.append(RESPONSE_CHUNK_TEXT)
+            last = index == latency.response_chunks - 1
+            yield FakeResponse(RESPONSE_CHUNK_TEXT, _usage(prompt_text, "".join(chunks)) if last else None)
+        response_text = "".join(chunks)
+        self.services.count_tokens("gemini.stream", prompt_text, response_text)
+        user_parts = message if isinstance(message, list) else [message if isinstance(message, types.Part) else types.Part(text=str(message))]
+        self._history.append(types.Content(role="user", parts=user_parts))
+        self._history.append(types.Content(role="model", parts=[types.Part(text=response_text)]))
+
+    def send_message(self, message, config=None) -> FakeResponse:
+        chunks = list(self.send_message_stream(message, config))
+        return FakeResponse("".join(chunk.text for chunk in chunks), chunks[-1].usage_metadata if chunks else None)
+
+class FakeChats:
+    def __init__(self, services):
+        self.services = services
+
+    def create(self, model: str, config=None, history=None) -> FakeChat:
+        self.services.count("gemini.chats_create")
+        return FakeChat(self.services, model, config, history)
+
+class FakeModels:
+    def __init__(self, services):
+        self.services = services
+
+    def generate_content(self, model: str, contents, config=None) -> FakeResponse:
+        """Supervisor 평가 요청이면 점수를, 그 밖의 요청(제목, 요약)이면 짧은 텍스트를 반환합니다."""
+        time.sleep(self.services.latency.gemini_call_seconds)
+        prompt_text = _contents_text(contents) + _contents_text(getattr(config, "system_instruction", None))
+        if getattr(config, "response_mime_type", None) == "application/json":
+            kind = "supervisor"
+            response_text = json.dumps({"score": self.services.next_score(), "reason": "가짜 평가"})
+        elif "100점" in prompt_text:
+            kind = "supervisor"
+            response_text = str(self.services.next_score())
+        else:
+            kind = "generate"
+            response_text = FAKE_TITLE_TEXT
+        self.services.count(f"gemini.{kind}")
+        self.services.count_tokens(f"gemini.{kind}", prompt_text, response_text)
+        return FakeResponse(response_text, _usage(prompt_text, response_text))
+
+    def count_tokens(self, model: str, contents, config=None):
+        time.sleep(self.services.latency.gemini_call_seconds)
+        self.services.count("gemini.count_tokens")
+        return types.CountTokensResponse(total_tokens=estimate_text_tokens(_contents_text(contents)))
+
+class FakeGeminiClient:
+    """google.genai.Client 대신 사용하는 클라이언트 (models, chats). 컨텍스트 캐시는 FausT의 local 백엔드를 사용합니다."""
+
+    def __init__(self, services):
+        self.models = FakeModels(services)
+        self.chats = FakeChats(services)
+
+# --- Firestore ---
+class FakeDocumentSnapshot:
+    def __init__(self, reference, data: dict | None):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self) -> dict | None:
+        return dict(self._data) if self._data is not None else None
+
+class FakeDocumentReference:
+    def __init__(self, client, collection_path: str, document_id: str):
+        self._client = client
+        self._collection_path = collection_path
+        self.id = document_id
+        self.path = f"{collection_path}/{document_id}"
+
+    def collection(self, name: str):
+        return FakeCollectionReference(self._client, f"{self.path}/{name}")
+
+    def get(self, transaction=None) -> FakeDocumentSnapshot:
+        self._client._round_trip(reads=1)
+        return FakeDocumentSnapshot(self, self._client._get(self))
+
+    def set(self, data: dict, merge=False):
+        self._client._round_trip(writes=1)
+        self._client._set(self, data, merge)
+
+    def update(self, data: dict):
+        self._client._round_trip(writes=1)
+        self._client._update(self, data)
+
+    def delete(self):
+        self._client._round_trip(writes=1)
+        self._client._delete(self)
+
+class FakeCollectionReference:
+    def __init__(self, client, path: str, order_field: str | None = None, fields: list | None = None):
+        self._client = client
+        self.path = path
+        self._order_field = order_field
+        self._fields = fields
+
+    def document(self, document_id: str | None = None) -> FakeDocumentReference:
+        return FakeDocumentReference(self._client, self.path, document_id or uuid.uuid4().hex[:20])
+
+    def order_by(self, field: str, **kwargs):
+        return FakeCollectionReference(self._client, self.path, field, self._fields)
+
+    def select(self, fields):
+        return FakeCollectionReference(self._client, self.path, self._order_field, list(fields))
+
+    def stream(self):
+        documents = self._client._list(self.path)
+        self._client._round_trip(reads=max(1, len(documents)))
+        if self._order_field is not None:
+            documents.sort(key=lambda item: item[1].get(self._order_field))
+        for document_id, data in documents:
+            if self._fields is not None:
+                data = {key: data[key] for key in self._fields if key in data}
+            yield FakeDocumentSnapshot(self.document(document_id), data)
+
+    def get(self) -> list:
+        return list(self.stream())
+
+class FakeWriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._operations = []
+
+    def set(self, reference, data: dict, merge=False):
+        self._operations.append(lambda: self._client._set(reference, data, merge))
+
+    def update(self, reference, data: dict):
+        self._operations.append(lambda: self._client._update(reference, data))
+
+    def delete(self, reference):
+        self._operations.append(lambda: self._client._delete(reference))
+
+    def commit(self):
+        self._client._round_trip(writes=len(self._operations))
+        for operation in self._operations:
+            operation()
+
+class FakeTransaction(FakeWriteBatch):
+    """쓰기를 모았다가 commit에서 한 번에 기록합니다. 동시 수정 충돌(재시도)은 흉내 내지 않습니다."""
+
+def wrap_transactional(real_transactional):
+    """
+    firestore.transactional 대체를 만듭니다. FakeTransaction이면 func(transaction)을 실행한 뒤 모은 쓰기를 commit하고,
+    아니면 실제 transactional로 실행합니다.
+    """
+    def transactional(func):
+        def run_in_transaction(transaction, *args, **kwargs):
+            if not isinstance(transaction, FakeTransaction):
+                return real_transactional(func)(transaction, *args, **kwargs)
+            result = func(transaction, *args, **kwargs)
+            transaction.commit()
+            return result
+        return run_in_transaction
+    transactional.handles_fake_transactions = True
+    return transactional
+
+class FakeFirestoreClient:
+    """메모리 내 Firestore 클라이언트. 컬렉션 경로마다 {문서 ID: 데이터}를 보관합니다."""
+
+    def __init__(self, services):
+        self.services = services
+        self._collections = {} # 컬렉션 경로 -> {문서 ID: dict}
+        self._lock = threading.Lock()
+
+    def collection(self, name: str) -> FakeCollectionReference:
+        return FakeCollectionReference(self, name)
+
+    def batch(self) -> FakeWriteBatch:
+        return FakeWriteBatch(self)
+
+    def transaction(self) -> FakeTransaction:
+        return FakeTransaction(self)
+
+    def seed(self, document_path: str, data: dict):
+        """지연 시간과 통계 없이 문서를 바로 기록합니다 (벤치마크 데이터 준비용)."""
+        collection_path, document_id = document_path.rsplit("/", 1)
+        with self._lock:
+            self._collections.setdefault(collection_path, {})[document_id] = dict(data)
+
+    def _round_trip(self, reads: int = 0, writes: int = 0):
+        latency = self.services.latency
+        time.sleep(latency.firestore_write_seconds if writes else latency.firestore_read_seconds)
+        self.services.count("firestore.round_trips")
+        self.services.count("firestore.reads", reads)
+        self.services.count("firestore.writes", writes)
+
+    def _get(self, reference) -> dict | None:
+        with self._lock:
+            data = self._collections.get(reference._collection_path, {}).get(reference.id)
+            return dict(data) if data is not None else None
+
+    def _list(self, collection_path: str) -> list:
+        with self._lock:
+            return [(document_id, dict(data)) for document_id, data in self._collections.get(collection_path, {}).items()]
+
+    def _set(self, reference, data: dict, merge):
+        with self._lock:
+            documents = self._collections.setdefault(reference._collection_path, {})
+            if merge and reference.id in documents:
+                documents[reference.id].update(data)
+            else:
+                documents[reference.id] = dict(data)
+
+    def _update(self, reference, data: dict):
+        from google.cloud.firestore import DELETE_FIELD
+        with self._lock:
+            document = self._collections.setdefault(reference._collection_path, {}).setdefault(reference.id, {})
+            for key, value in data.items():
+                if value is DELETE_FIELD:
+                    document.pop(key, None)
+                else:
+                    document[key] = value
+
+    def _delete(self, reference):
+        with self._lock:
+            self._collections.get(reference._collection_path, {}).pop(reference.id, None)
+
+# --- Cloudinary ---
+class FakeCloudinary:
+    """cloudinary.uploader.upload / cloudinary.api.delete_resources 대체 함수."""
+
+    def __init__(self, services):
+        self.services = services
+
+    def upload(self, file, public_id: str | None = None, resource_type: str = "image", **options) -> dict:
+        time.sleep(self.services.latency.cloudinary_upload_seconds)
+        self.services.count("cloudinary.uploads")
+        public_id = public_id or uuid.uuid4().hex
+        return {"secure_url": f"https://res.cloudinary.invalid/fake/{public_id}", "public_id": public_id}
+
+    def delete_resources(self, public_ids, resource_type: str = "image", **options) -> dict:
+        time.sleep(self.services.latency.cloudinary_delete_seconds)
+        self.services.count("cloudinary.delete_requests")
+        self.services.count("cloudinary.deleted", len(public_ids))
+        return {"deleted": {public_id: "deleted" for public_id in public_ids}}
+
+class FakeServices:
+    """가짜 Gemini/Firestore/Cloudinary와 공유 설정(지연 시간, Supervisor 점수), 호출 통계."""
+
+    def __init__(self, latency: FakeLatency | None = None, supervisor_scores=(80,)):
+        self.latency = latency or FakeLatency()
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self.set_supervisor_scores(supervisor_scores)
+        self.gemini = FakeGeminiClient(self)
+        self.firestore = FakeFirestoreClient(self)
+        self.cloudinary = FakeCloudinary(self)
+
+    def set_supervisor_scores(self, scores):
+        """Supervisor 평가 요청에 차례로(반복) 돌려줄 점수들."""
+        with self._lock:
+            self._scores = itertools.cycle(scores)
+
+    def next_score(self) -> int:
+        with self._lock:
+            return next(self._scores)
+
+    def count(self, key: str, amount: int = 1):
+        with self._lock:
+            self.stats[key] += amount
+
+    def count_tokens(self, kind: str, prompt_text: str, response_text: str):
+        with self._lock:
+            self.stats[f"{kind}.prompt_tokens"] += estimate_text_tokens(prompt_text)
+            self.stats[f"{kind}.response_tokens"] += estimate_text_tokens(response_text)
+
+    def snapshot(self) -> Counter:
+        with self._lock:
+            return Counter(self.stats)
+
+@contextmanager
+def install_fake_services(services: FakeServices):
+    """with 블록 동안 FausT.py가 사용하는 외부 서비스 진입점을 services로 교체합니다."""
+    import firebase_admin
+    import firebase_admin.firestore
+    import cloudinary.uploader
+    import cloudinary.api
+    # 저장 큐는 프로세스 종료 시(atexit) 마지막으로 flush하므로, with 블록이 끝난 뒤에도 가짜 클라이언트의 트랜잭션을 처리하도록
+    # transactional은 되돌리지 않음 (FakeTransaction이 아니면 실제 transactional로 넘김)
+    if not getattr(firebase_admin.firestore.transactional, "handles_fake_transactions", False):
+        firebase_admin.firestore.transactional = wrap_transactional(firebase_admin.firestore.transactional)
+    with ExitStack() as stack:
+        stack.enter_context(mock.patch("google.genai.Client", lambda *args, **kwargs: services.gemini))
+        stack.enter_context(mock.patch.dict(firebase_admin._apps, {"[DEFAULT]": None})) # 초기화된 것으로 보이게 함
+        stack.enter_context(mock.patch.object(firebase_admin.firestore, "client", lambda *args, **kwargs: services.firestore))
+        stack.enter_context(mock.patch.object(cloudinary.uploader, "upload", services.cloudinary.upload))
+        stack.enter_context(mock.patch.object(cloudinary.api, "delete_resources", services.cloudinary.delete_resources))
+        yield services
@@ -0,0 +1,163 @@
+"""
+이미지 축소(썸네일) 엔진.
+
+큰 JPEG는 draft()로 DCT 단계에서 1/2, 1/4, 1/8 크기로 디코딩하고, 그 밖의 포맷은 reduce()로 정수배 축소한 뒤
+남은 배율만 필터로 리샘플링합니다. EXIF 회전 정보를 반영하며, 축소가 필요 없고 회전도 없으면 원본 바이트를 그대로 돌려줍니다.
+
+`python image_thumbnails.py`로 실행하면 기존 방식(전체 디코딩 + LANCZOS)과 비교하는 벤치마크를 수행합니다.
+"""
+import io
+import math
+import time
+import statistics
+
+from PIL import Image, ImageOps
+
+FAST_PATH_MIN_SCALE = 2.0 # 원본이 목표보다 이 배율 이상 크면 draft()/reduce()로 먼저 줄인 뒤 리샘플링
+REDUCING_GAP = 2.0 # draft()/reduce()로 줄인 뒤에도 목표 크기의 이 배율 이상은 남겨 마지막 필터가 품질을 보장하도록 함
+# (최대 배율, 필터): 조금만 줄일 때는 LANCZOS, 많이 줄일수록 draft/reduce가 대부분을 처리하므로 더 가벼운 필터
+RESAMPLE_FILTERS_BY_SCALE = (
+    (FAST_PATH_MIN_SCALE, Image.LANCZOS),
+    (8.0, Image.BICUBIC),
+    (math.inf, Image.BILINEAR),
+)
+OUTPUT_FORMATS = ("JPEG", "PNG", "WEBP") # 이 밖의 포맷은 PNG로 저장
+# reduce()가 지원하지 않는 모드. 팔레트/1비트 이미지는 resize()도 NEAREST로만 처리되므로 축소 전에 변환하고,
+# 16비트 정수 모드는 변환하면 값 범위가 잘리므로 reduce() 없이 resize()만 사용
+SCALING_CONVERT_MODES = {"1": "L", "P": "RGB", "PA": "RGBA"}
+REDUCE_UNSUPPORTED_MODES = ("I;16", "I;16L", "I;16B", "I;16N")
+EXIF_ORIENTATION_TAG = 0x0112
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8) # 90도 회전이 포함되어 가로/세로가 바뀌는 EXIF 방향 값
+
+def choose_resample_filter(scale: float):
+    """축소 배율(원본/목표)에 맞는 리샘플링 필터를 고릅니다."""
+    for max_scale, resample_filter in RESAMPLE_FILTERS_BY_SCALE:
+        if scale < max_scale:
+            return resample_filter
+    return RESAMPLE_FILTERS_BY_SCALE[-1][1]
+
+def _convert_for_scaling(img: Image.Image) -> Image.Image:
+    """팔레트/1비트 이미지를 필터 리샘플링과 reduce()가 가능한 모드(L/RGB/RGBA)로 변환합니다. 투명도는 유지합니다."""
+    target_mode = SCALING_CONVERT_MODES.get(img.mode)
+    if target_mode is None:
+        return img
+    if img.mode == "P" and "transparency" in img.info:
+        target_mode = "RGBA"
+    return img.convert(target_mode)
+
+def load_scaled_image(image_bytes: bytes, max_width: int, max_height: int | None = None) -> tuple[Image.Image, bool]:
+    """
+    이미지를 (EXIF 회전을 반영한 방향 기준으로) max_width × max_height 안에 들어오도록 축소해서 불러옵니다.
+    반환값: (PIL 이미지, 원본에서 바뀌었는지 여부). 바뀌지 않았다면 호출한 쪽은 원본 바이트를 그대로 써도 됩니다.
+    """
+    img = Image.open(io.BytesIO(image_bytes))
+    source_format = img.format
+    orientation = img.getexif().get(EXIF_ORIENTATION_TAG, 1)
+    transposed = orientation in TRANSPOSED_ORIENTATIONS
+
+    # 화면에 보이는 방향 기준의 크기와 제한
+    width, height = (img.height, img.width) if transposed else img.size
+    max_height = max_height or height
+    scale = max(width / max_width, height / max_height)
+    if scale <= 1.0 and orientation == 1:
+        return img, False
+
+    if scale > 1.0:
+        # 저장된(회전 전) 방향 기준의 목표 크기
+        target_width = max(1, round(width / scale))
+        target_height = max(1, round(height / scale))
+        if transposed:
+            target_width, target_height = target_height, target_width
+        resample_filter = choose_resample_filter(scale)
+        img = _convert_for_scaling(img)
+        if scale >= FAST_PATH_MIN_SCALE:
+            if source_format == "JPEG": # DCT 단계 축소: 디코딩 자체를 1/2~1/8 크기로 수행
+                img.draft(img.mode, (math.ceil(target_width * REDUCING_GAP), math.ceil(target_height * REDUCING_GAP)))
+            # 남은 배율 중 정수배는 reduce()(박스 평균)로 처리하고, 나머지만 필터로 리샘플링
+            reduce_factor = int(min(img.width / target_width, img.height / target_height) / REDUCING_GAP)
+            if reduce_factor >= 2 and img.mode not in REDUCE_UNSUPPORTED_MODES:
+                img = img.reduce(reduce_factor)
+        img = img.resize((target_width, target_height), resample_filter)
+
+    if orientation != 1:
+        img = ImageOps.exif_transpose(img)
+    img.format = source_format
+    return img, True
+
+def make_display_thumbnail(image_bytes: bytes, display_width: int) -> bytes:
+    """표시용으로 너비가 display_width 이하인 이미지를 원본 포맷(JPEG/PNG/WebP, 그 밖은 PNG)으로 인코딩해 반환합니다."""
+    img, changed = load_scaled_image(image_bytes, display_width)
+    if not changed:
+        return image_bytes
+    output_format = img.format if img.format in OUTPUT_FORMATS else "PNG"
+    if output_format == "JPEG" and img.mode not in ("RGB", "L", "CMYK"):
+        img = img.convert("RGB")
+    byte_arr = io.BytesIO()
+    img.save(byte_arr, format=output_format)
+    return byte_arr.getvalue()
+
+# --- 벤치마크 ---
+def legacy_resize_image_for_display(image_bytes: bytes, display_width: int) -> bytes:
+    """비교 기준: 기존 FausT.resize_image_for_display와 같은 방식 (전체 디코딩 후 LANCZOS 리사이즈)."""
+    img = Image.open(io.BytesIO(image_bytes))
+    width, height = img.size
+    if width > display_width:
+        img = img.resize((display_width, int(height * display_width / width)), Image.LANCZOS)
+    byte_arr = io.BytesIO()
+    img.save(byte_arr, format=img.format if img.format else "PNG")
+    return byte_arr.getvalue()
+
+def _synthetic_image(width: int, height: int) -> Image.Image:
+    """사진과 비슷하게 압축되도록 그라디언트와 노이즈를 섞은 테스트 이미지를 만듭니다."""
+    gradient = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 40)
+    return Image.merge("RGB", (gradient, noise, gradient.transpose(Image.FLIP_LEFT_RIGHT)))
+
+def build_benchmark_corpus():
+    """(이름, 바이트) 목록: 여러 크기 × 포맷, 그리고 EXIF 회전이 있는 JPEG."""
+    corpus = []
+    for width, height in ((800, 600), (1920, 1080), (4032, 3024), (6000, 4000)):
+        image = _synthetic_image(width, height)
+        for image_format in ("JPEG", "PNG", "WEBP"):
+            if image_format != "JPEG" and width * height > 13_000_000:
+                continue # 큰 PNG/WebP 인코딩은 코퍼스 생성만 오래 걸리므로 제외
+            byte_arr = io.BytesIO()
+            image.save(byte_arr, format=image_format)
+            corpus.append((f"{width}x{height} {image_format}", byte_arr.getvalue()))
+    rotated = io.BytesIO()
+    exif = Image.Exif()
+    exif[EXIF_ORIENTATION_TAG] = 6
+    _synthetic_image(4032, 3024).save(rotated, format="JPEG", exif=exif)
+    corpus.append(("4032x3024 JPEG (EXIF 90°)", rotated.getvalue()))
+    return corpus
+
+def _median_seconds(func, image_bytes: bytes, display_width: int, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        func(image_bytes, display_width)
+        timings.append(time.perf_counter() - start_time)
+    return statistics.median(timings)
+
+def run_benchmark(display_width: int = 500, repeat: int = 5):
+    print(f"표시 너비 {display_width}px, 반복 {repeat}회 (중앙값)")
+    print(f"{'이미지':<28}{'원본':>10}{'기존 ms':>10}{'새 ms':>10}{'배속':>8}{'기존 출력':>12}{'새 출력':>12}")
+    total_legacy = total_new = 0.0
+    for name, image_bytes in build_benchmark_corpus():
+        legacy_seconds = _median_seconds(legacy_resize_image_for_display, image_bytes, display_width, repeat)
+        new_seconds = _median_seconds(make_display_thumbnail, image_bytes, display_width, repeat)
+        total_legacy += legacy_seconds
+        total_new += new_seconds
+        legacy_output = Image.open(io.BytesIO(legacy_resize_image_for_display(image_bytes, display_width)))
+        new_output = Image.open(io.BytesIO(make_display_thumbnail(image_bytes, display_width)))
+        print(f"{name:<28}{len(image_bytes) / 1024:>8.0f}KB{legacy_seconds * 1000:>10.1f}{new_seconds * 1000:>10.1f}"
+              f"{legacy_seconds / new_seconds:>7.1f}x{'%dx%d' % legacy_output.size:>12}{'%dx%d' % new_output.size:>12}")
+    print(f"합계: 기존 {total_legacy * 1000:.0f}ms, 새 엔진 {total_new * 1000:.0f}ms ({total_legacy / total_new:.1f}x)")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="썸네일 엔진과 기존 리사이즈 방식 비교 벤치마크")
+    parser.add_argument("--width", type=int, default=500, help="표시 너비 (FausT.LOCAL_DISPLAY_WIDTH)")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    run_benchmark(args.width, args.repeat)
@@ -0,0 +1,48 @@
+"""
+무거운 모듈과 서비스 핸들을 처음 사용할 때 불러오는 지연 로딩 도우미.
+
+Streamlit은 새 프로세스의 첫 실행에서 FausT.py 전체를 실행하므로, 모듈 최상위에서 import/초기화하면
+첫 화면이 그려지기 전에 모든 비용(google.genai, Firebase, fitz 등)을 치르게 됩니다.
+LazyProxy는 모듈 최상위의 이름은 그대로 두고, 실제 로딩은 첫 속성 접근 시점으로 미룹니다.
+"""
+import time
+import importlib
+import threading
+
+class LazyProxy:
+    """
+    loader()의 결과를 처음 속성에 접근할 때 만들어 두고, 이후 모든 속성 접근을 그 객체로 넘기는 대리 객체입니다.
+    여러 스레드에서 동시에 처음 접근해도 loader는 한 번만 호출됩니다. 실패하면 다음 접근에서 다시 시도합니다.
+    """
+
+    def __init__(self, name: str, loader):
+        self._name = name
+        self._loader = loader
+        self._target = None
+        self._lock = threading.Lock()
+        self.load_seconds = None # 로딩에 걸린 시간 (아직 로딩되지 않았으면 None)
+
+    def _load(self):
+        if self._target is None:
+            with self._lock:
+                if self._target is None:
+                    start_time = time.perf_counter()
+                    target = self._loader()
+                    self.load_seconds = time.perf_counter() - start_time
+                    self._target = target
+        return self._target
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._target is not None
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __repr__(self) -> str:
+        state = f"{self.load_seconds * 1000:.0f}ms" if self.is_loaded else "not loaded"
+        return f"<LazyProxy {self._name} ({state})>"
+
+def lazy_module(module_name: str) -> LazyProxy:
+    """module_name을 처음 사용할 때 import하는 LazyProxy를 반환합니다."""
+    return LazyProxy(module_name, lambda: importlib.import_module(module_name))
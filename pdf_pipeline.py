@@ -0,0 +1,376 @@
+"""
+PDF 페이지 래스터화 파이프라인.
+
+ProcessPoolExecutor의 작업 함수는 자식 프로세스에서 import 가능한 최상위 함수여야 하므로,
+Streamlit 스크립트(FausT.py)와 분리된 모듈에 둡니다. (FausT.py를 import하면 앱 전체가 실행됨)
+프로세스 풀은 create_render_pool()로 한 번 만들어 모든 업로드가 함께 사용하고,
+작업 프로세스는 PDF를 임시 파일 경로로 받아 프로세스 안에서만 열어 둡니다.
+"""
+import os
+import math
+import time
+import hashlib
+import tempfile
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+
+from lazy_imports import lazy_module
+
+fitz = lazy_module("fitz") # PyMuPDF for PDF processing (PDF가 실제로 업로드될 때 처음 로드)
+
+DEFAULT_RENDER_DPI = 300
+DEFAULT_MEMORY_BUDGET_BYTES = 64 * 1024 * 1024 # 렌더링되었지만 아직 소비되지 않은 페이지가 차지할 수 있는 최대 바이트
+WORKER_DOCUMENT_CACHE_SIZE = 2 # 작업 프로세스 하나가 열어 두는 PDF 수 (동시에 처리 중인 업로드가 번갈아 와도 다시 열지 않도록)
+DEFAULT_MAX_WORKERS = max(1, min(4, os.cpu_count() or 1))
+MIN_PAGES_FOR_PROCESS_POOL = 3 # 이보다 페이지가 적으면 프로세스 풀을 띄우지 않고 현재 프로세스에서 렌더링
+ESTIMATED_PAGE_BYTES = 1024 * 1024 # 첫 페이지가 렌더링되기 전 사용하는 페이지당 예상 바이트
+
+# --- 페이지 전달 방식 ---
+INGESTION_MODE_RASTER = "raster" # 모든 페이지를 이미지로 전달 (기존 방식)
+INGESTION_MODE_TEXT_FIRST = "text_first" # 텍스트 레이어가 있는 페이지는 텍스트로, 나머지만 래스터화
+
+# --- 텍스트 우선(text_first) 모드 설정 ---
+MIN_TEXT_CHARS_FOR_TEXT_PAGE = 80 # 이보다 텍스트가 적으면 스캔/이미지 페이지로 보고 래스터화
+IMAGE_HEAVY_COVERAGE = 0.3 # 이미지가 페이지 면적의 이 비율 이상을 차지하면 래스터화
+MIN_ADAPTIVE_DPI = 72
+TARGET_LONG_SIDE_PIXELS = 1536 # 일반 페이지: 긴 변이 Gemini 이미지 타일(768px) 2개 분량이 되도록
+DENSE_TARGET_LONG_SIDE_PIXELS = 2304 # 작은 글씨가 빽빽한 페이지 / 텍스트 레이어가 없는 스캔 페이지
+DENSE_TEXT_CHARS_PER_SQUARE_INCH = 40
+
+# --- 바이트/토큰 추정 ---
+GEMINI_IMAGE_TILE_PIXELS = 768
+GEMINI_TOKENS_PER_IMAGE_TILE = 258
+PNG_BYTES_PER_PIXEL_ESTIMATE = 0.1 # 래스터화한 페이지가 없을 때 사용하는 PNG의 픽셀당 예상 바이트
+
+# 작업 프로세스 안에서만 사용하는, 열어 둔 PDF 문서 캐시 (document_key -> fitz.Document, _init_render_worker에서 설정)
+_worker_documents = None
+
+
+def estimate_image_tokens(width: int, height: int) -> int:
+    """Gemini가 이미지 하나에 사용하는 토큰 수를 추정합니다 (384px 이하는 타일 1개, 그 외 768px 타일 단위)."""
+    if width <= GEMINI_IMAGE_TILE_PIXELS // 2 and height <= GEMINI_IMAGE_TILE_PIXELS // 2:
+        return GEMINI_TOKENS_PER_IMAGE_TILE
+    tiles = math.ceil(width / GEMINI_IMAGE_TILE_PIXELS) * math.ceil(height / GEMINI_IMAGE_TILE_PIXELS)
+    return tiles * GEMINI_TOKENS_PER_IMAGE_TILE
+
+
+def estimate_text_tokens(text: str) -> int:
+    """텍스트의 토큰 수를 대략 추정합니다 (ASCII는 4글자당 1토큰, 한글 등 그 외 문자는 1글자당 1토큰)."""
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return math.ceil(ascii_chars / 4) + (len(text) - ascii_chars)
+
+
+@dataclass
+class RenderedPage:
+    """처리된 PDF 페이지 하나. 텍스트로 전달할 페이지는 png_bytes가 None이고 text가 채워집니다."""
+    page_num: int
+    png_bytes: bytes | None
+    render_seconds: float
+    text: str | None = None
+    dpi: int = 0
+    pixels: int = 0
+    estimated_tokens: int = 0
+    baseline_pixels: int = 0 # 300 DPI로 래스터화했다면 생성되었을 픽셀 수
+    baseline_tokens: int = 0 # 300 DPI로 래스터화했다면 사용되었을 예상 토큰 수
+
+
+@dataclass
+class PdfRenderStats:
+    """PDF 렌더링 파이프라인의 실행 통계 (페이지별 소요 시간, 절감량 추정 포함)."""
+    total_pages: int = 0
+    rendered_pages: int = 0
+    rendered_bytes: int = 0
+    page_timings: list = field(default_factory=list) # [(page_num, render_seconds), ...]
+    peak_buffered_bytes: int = 0
+    wall_seconds: float = 0.0
+    worker_count: int = 1
+    text_pages: int = 0
+    image_pages: int = 0
+    sent_bytes: int = 0 # Gemini에 전달되는 바이트 (PNG + 텍스트)
+    sent_tokens_estimate: int = 0
+    budget_truncated_pages: int = 0 # 전체 출력 예산을 넘어 내보내지 않은 페이지 수
+    image_pixels: int = 0
+    baseline_pixels: int = 0
+    baseline_tokens_estimate: int = 0
+
+    def record(self, rendered_page: RenderedPage):
+        """페이지 하나의 처리 결과를 통계에 반영합니다."""
+        self.page_timings.append((rendered_page.page_num, rendered_page.render_seconds))
+        if rendered_page.png_bytes is not None:
+            self.image_pages += 1
+            self.image_pixels += rendered_page.pixels
+            self.sent_bytes += len(rendered_page.png_bytes)
+        else:
+            self.text_pages += 1
+            self.sent_bytes += len(rendered_page.text.encode("utf-8"))
+        self.sent_tokens_estimate += rendered_page.estimated_tokens
+        self.baseline_pixels += rendered_page.baseline_pixels
+        self.baseline_tokens_estimate += rendered_page.baseline_tokens
+
+    def baseline_bytes_estimate(self) -> int:
+        """모든 페이지를 300 DPI PNG로 보냈을 때의 예상 바이트 (이 문서에서 래스터화한 페이지의 픽셀당 바이트로 추정)."""
+        if self.image_pixels:
+            bytes_per_pixel = self.rendered_bytes / self.image_pixels
+        else:
+            bytes_per_pixel = PNG_BYTES_PER_PIXEL_ESTIMATE
+        return int(self.baseline_pixels * bytes_per_pixel)
+
+    def bytes_saved_estimate(self) -> int:
+        return max(0, self.baseline_bytes_estimate() - self.sent_bytes)
+
+    def tokens_saved_estimate(self) -> int:
+        return max(0, self.baseline_tokens_estimate - self.sent_tokens_estimate)
+
+    def summary(self) -> str:
+        """사람이 읽을 수 있는 한 줄 요약을 반환합니다."""
+        if not self.page_timings:
+            return "처리된 페이지 없음"
+        timings = [seconds for _, seconds in self.page_timings]
+        summary = (f"{len(self.page_timings)}/{self.total_pages}페이지 처리, 총 {self.wall_seconds:.2f}초 "
+                   f"(프로세스 {self.worker_count}개, 페이지당 평균 {sum(timings) / len(timings):.2f}초, 최대 {max(timings):.2f}초, "
+                   f"최대 버퍼 {self.peak_buffered_bytes / (1024 * 1024):.1f}MB)")
+        if self.budget_truncated_pages:
+            summary += f" · 메모리 예산 초과로 {self.budget_truncated_pages}페이지 생략"
+        if self.text_pages:
+            summary += (f" · 텍스트 {self.text_pages}페이지 / 이미지 {self.image_pages}페이지, "
+                        f"약 {self.bytes_saved_estimate() / (1024 * 1024):.1f}MB · {self.tokens_saved_estimate():,}토큰 절감 (추정)")
+        return summary
+
+
+def _init_render_worker():
+    """작업 프로세스 초기화: 이 프로세스에서 열어 둘 PDF 문서 캐시를 만듭니다."""
+    global _worker_documents
+    _worker_documents = OrderedDict()
+
+
+def _render_page_in_worker(document_key: str, pdf_path: str, page_num: int, dpi: int, mode: str) -> RenderedPage:
+    """
+    작업 프로세스에서 실행되는 작업 단위. 같은 PDF의 페이지가 이어서 오면 열어 둔 문서를 재사용하고,
+    오래 사용하지 않은 문서는 닫습니다.
+    """
+    document = _worker_documents.get(document_key)
+    if document is None:
+        document = _worker_documents[document_key] = fitz.open(pdf_path, filetype="pdf")
+        while len(_worker_documents) > WORKER_DOCUMENT_CACHE_SIZE:
+            _worker_documents.popitem(last=False)[1].close()
+    else:
+        _worker_documents.move_to_end(document_key)
+    return _render_page(document, page_num, dpi, mode)
+
+
+def _image_coverage(page) -> float:
+    """페이지 면적 중 이미지가 차지하는 비율 (0.0 ~ 1.0, 겹침은 무시하고 합산 후 1.0으로 제한)."""
+    page_area = abs(page.rect)
+    if not page_area:
+        return 0.0
+    image_area = sum(abs(fitz.Rect(info["bbox"]) & page.rect) for info in page.get_image_info())
+    return min(1.0, image_area / page_area)
+
+
+def choose_adaptive_dpi(page_rect, text_chars: int, max_dpi: int) -> int:
+    """
+    페이지 크기와 내용 밀도로 래스터화 DPI를 고릅니다.
+    긴 변이 목표 픽셀 수가 되도록 하며, 글씨가 빽빽하거나 텍스트 레이어가 없는 페이지는 더 높은 해상도를 사용합니다.
+    """
+    width_inch, height_inch = page_rect.width / 72, page_rect.height / 72
+    long_side_inch = max(width_inch, height_inch, 1e-6)
+    chars_per_square_inch = text_chars / max(width_inch * height_inch, 1e-6)
+    if text_chars == 0 or chars_per_square_inch >= DENSE_TEXT_CHARS_PER_SQUARE_INCH:
+        target_pixels = DENSE_TARGET_LONG_SIDE_PIXELS
+    else:
+        target_pixels = TARGET_LONG_SIDE_PIXELS
+    return int(max(MIN_ADAPTIVE_DPI, min(max_dpi, target_pixels / long_side_inch)))
+
+
+def _rasterize(page, page_num: int, dpi: int, start_time: float, baseline_pixels: int, baseline_tokens: int) -> RenderedPage:
+    """페이지를 dpi로 PNG 렌더링해 RenderedPage로 반환합니다."""
+    pix = page.get_pixmap(matrix=fitz.Matrix(dpi / 72, dpi / 72))
+    png_bytes = pix.tobytes("png") # 키워드 인자는 output= (format= 은 TypeError)
+    return RenderedPage(page_num, png_bytes, time.perf_counter() - start_time,
+                        dpi=dpi,
+                        pixels=pix.width * pix.height,
+                        estimated_tokens=estimate_image_tokens(pix.width, pix.height),
+                        baseline_pixels=baseline_pixels,
+                        baseline_tokens=baseline_tokens)
+
+
+def _render_page(document, page_num: int, dpi: int, mode: str = INGESTION_MODE_RASTER) -> RenderedPage:
+    """
+    열린 document의 한 페이지를 처리합니다.
+    raster 모드는 dpi로 래스터화하고, text_first 모드는 텍스트 레이어를 우선 사용하며
+    이미지 위주이거나 텍스트가 없는 페이지만 적응형 DPI(최대 dpi)로 래스터화합니다.
+    """
+    start_time = time.perf_counter()
+    page = document.load_page(page_num)
+    baseline_width = math.ceil(page.rect.width / 72 * DEFAULT_RENDER_DPI)
+    baseline_height = math.ceil(page.rect.height / 72 * DEFAULT_RENDER_DPI)
+    baseline_pixels = baseline_width * baseline_height
+    baseline_tokens = estimate_image_tokens(baseline_width, baseline_height)
+
+    if mode != INGESTION_MODE_TEXT_FIRST:
+        return _rasterize(page, page_num, dpi, start_time, baseline_pixels, baseline_tokens)
+
+    text = page.get_text("text").strip()
+    if len(text) < MIN_TEXT_CHARS_FOR_TEXT_PAGE or _image_coverage(page) >= IMAGE_HEAVY_COVERAGE:
+        adaptive_dpi = choose_adaptive_dpi(page.rect, len(text), dpi)
+        return _rasterize(page, page_num, adaptive_dpi, start_time, baseline_pixels, baseline_tokens)
+
+    return RenderedPage(page_num, None, time.perf_counter() - start_time,
+                        text=text,
+                        estimated_tokens=estimate_text_tokens(text),
+                        baseline_pixels=baseline_pixels,
+                        baseline_tokens=baseline_tokens)
+
+
+def render_pdf_page_preview(pdf_bytes: bytes, page_num: int = 0, dpi: int = 100) -> bytes | None:
+    """미리보기/대화 기록용으로 한 페이지를 낮은 DPI의 PNG로 렌더링합니다. 페이지가 없으면 None."""
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as pdf_document:
+        if page_num >= len(pdf_document):
+            return None
+        pix = pdf_document.load_page(page_num).get_pixmap(matrix=fitz.Matrix(dpi / 72, dpi / 72))
+        return pix.tobytes("png")
+
+
+def _get_process_context():
+    """
+    프로세스 풀에 사용할 multiprocessing 컨텍스트를 반환합니다.
+    Streamlit 서버는 여러 스레드와 gRPC/HTTP 클라이언트를 가진 프로세스이므로 fork하지 않고,
+    forkserver(없으면 spawn)로 깨끗한 프로세스에서 작업 프로세스를 만듭니다.
+    (Streamlit 실행 중 __main__은 streamlit 실행 스크립트이므로 자식 프로세스가 FausT.py를 실행하지 않음)
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload([__name__])
+        return context
+    return multiprocessing.get_context("spawn")
+
+
+def create_render_pool(max_workers: int = DEFAULT_MAX_WORKERS) -> ProcessPoolExecutor | None:
+    """
+    여러 업로드가 함께 사용할 렌더링 프로세스 풀을 만듭니다. max_workers가 1 이하이면 None (현재 프로세스에서 렌더링).
+    작업 프로세스는 처음 작업을 제출할 때 시작되어 이후 업로드에서 재사용됩니다.
+    """
+    if max_workers <= 1:
+        return None
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=_get_process_context(), initializer=_init_render_worker)
+
+
+def _page_size(rendered_page: RenderedPage) -> int:
+    """메모리 예산 계산에 사용하는 페이지 크기 (바이트)."""
+    if rendered_page.png_bytes is not None:
+        return len(rendered_page.png_bytes)
+    return len(rendered_page.text)
+
+
+def _iter_pages_in_process(pdf_bytes: bytes, page_count: int, dpi: int, mode: str, stats: PdfRenderStats):
+    """프로세스 풀 없이 현재 프로세스에서 순서대로 렌더링합니다 (문서는 이 호출에서만 사용)."""
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as document:
+        for page_num in range(page_count):
+            rendered_page = _render_page(document, page_num, dpi, mode)
+            stats.rendered_pages += 1
+            stats.rendered_bytes += len(rendered_page.png_bytes or b"")
+            stats.peak_buffered_bytes = max(stats.peak_buffered_bytes, _page_size(rendered_page))
+            yield rendered_page
+
+
+def _iter_pages_with_pool(pdf_bytes: bytes, page_count: int, dpi: int, mode: str, max_workers: int,
+                          memory_budget_bytes: int, executor: ProcessPoolExecutor, stats: PdfRenderStats):
+    """
+    공유 프로세스 풀에서 페이지를 병렬로 렌더링하되, 결과는 페이지 순서대로 내보냅니다.
+    이 호출의 진행 중인 작업은 max_workers개까지이며, 완료되었지만 아직 소비되지 않은 페이지 + 진행 중인 페이지의
+    예상 크기가 memory_budget_bytes를 넘지 않도록 새 작업 제출을 조절합니다. (항상 최소 1개 작업은 진행하여 멈추지 않도록 함)
+    PDF는 임시 파일로 한 번만 써서 작업 프로세스에 경로만 넘깁니다 (작업마다 PDF 바이트를 복사하지 않음).
+    """
+    document_key = hashlib.sha1(pdf_bytes).hexdigest()
+    pdf_fd, pdf_path = tempfile.mkstemp(prefix="faust_pdf_", suffix=".pdf")
+    with os.fdopen(pdf_fd, "wb") as pdf_file:
+        pdf_file.write(pdf_bytes)
+    in_flight = {} # future -> page_num
+    completed = {} # page_num -> RenderedPage (순서 대기 중)
+    buffered_bytes = 0
+    finished_pages = 0
+    finished_bytes = 0
+    next_to_submit = 0
+    next_to_yield = 0
+    try:
+        while next_to_yield < page_count:
+            average_page_bytes = (finished_bytes / finished_pages) if finished_pages else ESTIMATED_PAGE_BYTES
+            while next_to_submit < page_count and len(in_flight) < max_workers:
+                projected_bytes = buffered_bytes + (len(in_flight) + 1) * average_page_bytes
+                if (in_flight or completed) and projected_bytes > memory_budget_bytes:
+                    break
+                in_flight[executor.submit(_render_page_in_worker, document_key, pdf_path, next_to_submit, dpi, mode)] = next_to_submit
+                next_to_submit += 1
+
+            if next_to_yield not in completed:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    in_flight.pop(future)
+                    rendered_page = future.result()
+                    completed[rendered_page.page_num] = rendered_page
+                    buffered_bytes += _page_size(rendered_page)
+                    finished_pages += 1
+                    finished_bytes += _page_size(rendered_page)
+                    stats.rendered_pages += 1
+                    stats.rendered_bytes += len(rendered_page.png_bytes or b"")
+                stats.peak_buffered_bytes = max(stats.peak_buffered_bytes, buffered_bytes)
+
+            while next_to_yield in completed:
+                rendered_page = completed.pop(next_to_yield)
+                buffered_bytes -= _page_size(rendered_page)
+                next_to_yield += 1
+                yield rendered_page
+    finally:
+        for future in in_flight:
+            future.cancel() # 공유 풀이므로 이 호출의 남은 작업만 취소
+        wait(in_flight) # 실행 중인 작업이 임시 파일을 다 읽은 뒤 삭제
+        try:
+            os.remove(pdf_path)
+        except OSError as e:
+            print(f"PDF 임시 파일 삭제 실패: {e}")
+
+
+def iter_rendered_pdf_pages(pdf_bytes: bytes, max_pages: int, dpi: int = DEFAULT_RENDER_DPI,
+                            max_workers: int = DEFAULT_MAX_WORKERS,
+                            memory_budget_bytes: int = DEFAULT_MEMORY_BUDGET_BYTES,
+                            mode: str = INGESTION_MODE_RASTER,
+                            stats: PdfRenderStats | None = None,
+                            executor: ProcessPoolExecutor | None = None,
+                            output_budget_bytes: int | None = None):
+    """
+    PDF의 처음 max_pages 페이지를 처리해 RenderedPage를 페이지 순서대로 하나씩 내보내는 제너레이터입니다.
+    mode가 text_first이면 텍스트 레이어가 있는 페이지는 텍스트로 내보내고, dpi는 래스터화 DPI의 상한이 됩니다.
+    소비하는 쪽이 다음 페이지를 요청할 때까지 memory_budget_bytes 이상 앞서 렌더링하지 않습니다.
+    executor(create_render_pool()의 공유 풀)를 전달하면 페이지를 병렬로 렌더링하고, 없으면 현재 프로세스에서 렌더링합니다.
+    output_budget_bytes를 주면 내보낸 페이지의 합계가 이를 넘기 전에 멈춥니다 (소비하는 쪽이 모든 페이지를 보관하는 경우,
+    첫 페이지는 항상 내보냄). 생략한 페이지 수는 stats.budget_truncated_pages에 기록됩니다.
+    stats를 전달하면 전체 페이지 수, 페이지별 소요 시간, 절감량 추정 등이 기록됩니다.
+    """
+    if stats is None:
+        stats = PdfRenderStats()
+    start_time = time.perf_counter()
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as pdf_document:
+        stats.total_pages = len(pdf_document)
+    page_count = min(stats.total_pages, max_pages)
+
+    if executor is None or max_workers <= 1 or page_count < MIN_PAGES_FOR_PROCESS_POOL:
+        stats.worker_count = 1
+        pages = _iter_pages_in_process(pdf_bytes, page_count, dpi, mode, stats)
+    else:
+        stats.worker_count = min(max_workers, page_count)
+        pages = _iter_pages_with_pool(pdf_bytes, page_count, dpi, mode, stats.worker_count, memory_budget_bytes, executor, stats)
+
+    output_bytes = 0
+    try:
+        for rendered_page in pages:
+            output_bytes += _page_size(rendered_page)
+            if output_budget_bytes is not None and rendered_page.page_num > 0 and output_bytes > output_budget_bytes:
+                stats.budget_truncated_pages = page_count - rendered_page.page_num
+                break
+            stats.record(rendered_page)
+            yield rendered_page
+    finally:
+        pages.close()
+        stats.wall_seconds = time.perf_counter() - start_time
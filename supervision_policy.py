@@ -0,0 +1,171 @@
+"""
+적응형 Supervision 정책.
+
+지금까지 기록된 Supervisor 평균 점수를 (모델, 시스템 명령어, 프롬프트 분류)별로 최근 window개씩 보관하고,
+현재 통과 점수 기준으로 본 통과율의 Wilson 하한으로 이번 턴에 부를 Supervisor 수를 정합니다.
+- 표본이 부족하거나 통과율이 낮으면 전체 패널로 평가합니다.
+- 통과율이 충분히 높으면 Supervisor 수를 줄이고, 거의 항상 통과하면 평가를 생략합니다.
+- 생략 대상인 턴도 audit_rate 비율로 전체 패널 평가(감사)를 하며, 감사에서 기준을 넘지 못하면
+  그 조합은 한동안 전체 패널로 평가합니다 (품질 저하를 놓치지 않기 위함).
+생략/축소로 절약한 시간과 비용은 최근 패널의 소요 시간과 Supervisor 1회 비용으로 추정합니다.
+"""
+import math
+import random
+import hashlib
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+
+PROMPT_CLASSES = ("attachment", "code", "trivial", "long", "general")
+TRIVIAL_PROMPT_MAX_CHARS = 20 # 질문 부호 없이 이보다 짧은 입력 (인사, 감사 등)
+LONG_PROMPT_MIN_CHARS = 1000
+CODE_MARKERS = ("```", "def ", "class ", "import ", "function ", "SELECT ", "#include", "=>", "};")
+
+def classify_prompt(user_text: str, has_attachment: bool) -> str:
+    """사용자 입력을 정책 통계를 나누는 분류 하나로 나눕니다 (가벼운 휴리스틱)."""
+    if has_attachment:
+        return "attachment"
+    text = (user_text or "").strip()
+    if any(marker in text for marker in CODE_MARKERS):
+        return "code"
+    if len(text) <= TRIVIAL_PROMPT_MAX_CHARS and "?" not in text:
+        return "trivial"
+    if len(text) >= LONG_PROMPT_MIN_CHARS:
+        return "long"
+    return "general"
+
+def wilson_lower_bound(successes: int, total: int, z: float) -> float:
+    """성공 비율의 Wilson 점수 구간 하한 (표본이 적을수록 낮게 잡힘)."""
+    if total == 0:
+        return 0.0
+    p = successes / total
+    denominator = 1 + z * z / total
+    centre = p + z * z / (2 * total)
+    margin = z * math.sqrt(p * (1 - p) / total + z * z / (4 * total * total))
+    return (centre - margin) / denominator
+
+@dataclass
+class SupervisionDecision:
+    """이번 턴에 부를 Supervisor 수와 그렇게 정한 근거."""
+    mode: str # "off", "learning"(표본 부족), "full", "reduced", "skip", "audit"(생략 대상의 감사 평가), "forced"(감사 실패 후)
+    supervisor_count: int # 0이면 평가 생략
+    samples: int = 0
+    pass_rate_lower_bound: float | None = None
+    expected_saved_seconds: float = 0.0
+    expected_saved_cost_usd: float = 0.0
+
+    @property
+    def skip(self) -> bool:
+        return self.supervisor_count == 0
+
+    def summary(self) -> str:
+        labels = {"off": "적응형 정책 꺼짐", "learning": "표본 수집 중", "full": "전체 평가", "reduced": "축소 평가",
+                  "skip": "평가 생략", "audit": "생략 대상 감사 평가", "forced": "감사 실패 후 전체 평가"}
+        summary = f"{labels.get(self.mode, self.mode)} (Supervisor {self.supervisor_count}명, 표본 {self.samples}개"
+        if self.pass_rate_lower_bound is not None:
+            summary += f", 통과율 하한 {self.pass_rate_lower_bound * 100:.0f}%"
+        summary += ")"
+        if self.expected_saved_seconds or self.expected_saved_cost_usd:
+            summary += f", 예상 절감 {self.expected_saved_seconds:.1f}초 / ${self.expected_saved_cost_usd:.4f}"
+        return summary
+
+@dataclass
+class PolicyStats:
+    """(모델, 시스템 명령어, 프롬프트 분류) 하나의 최근 점수."""
+    scores: deque
+    forced_full_turns: int = 0 # 감사 실패 후 남은 전체 평가 턴 수
+
+@dataclass
+class PolicyCounters:
+    decisions: dict = field(default_factory=dict) # mode -> 횟수
+    audit_failures: int = 0
+    saved_seconds: float = 0.0
+    saved_cost_usd: float = 0.0
+
+class AdaptiveSupervisionPolicy:
+    """
+    기록된 점수로 Supervisor 수를 정하는 정책. 모든 세션이 함께 사용하며 (프로세스 메모리에만 보관), 스레드에 안전합니다.
+    """
+
+    def __init__(self, window: int = 30, min_samples: int = 5, confidence_z: float = 1.28,
+                 reduce_pass_rate: float = 0.75, skip_pass_rate: float = 0.9, skip_min_margin: float = 10.0,
+                 reduced_supervisors: int = 1, audit_rate: float = 0.1, audit_failure_full_turns: int = 5,
+                 smoothing: float = 0.2, rng: random.Random | None = None):
+        self.window = window
+        self.min_samples = min_samples
+        self.confidence_z = confidence_z
+        self.reduce_pass_rate = reduce_pass_rate
+        self.skip_pass_rate = skip_pass_rate
+        self.skip_min_margin = skip_min_margin # 생략하려면 최근 평균 점수가 기준보다 이만큼 높아야 함
+        self.reduced_supervisors = reduced_supervisors
+        self.audit_rate = audit_rate
+        self.audit_failure_full_turns = audit_failure_full_turns
+        self.smoothing = smoothing # 패널 시간/비용 지수 이동 평균의 가중치
+        self.panel_seconds = None # 최근 패널 소요 시간 (지수 이동 평균)
+        self.supervisor_cost_usd = None # Supervisor 1회 비용 (지수 이동 평균)
+        self.counters = PolicyCounters()
+        self._stats = {} # key -> PolicyStats
+        self._lock = threading.Lock()
+        self._random = rng or random.Random()
+
+    @staticmethod
+    def key(model_name: str, system_instruction: str, prompt_class: str) -> tuple:
+        instruction_hash = hashlib.sha1((system_instruction or "").encode("utf-8")).hexdigest()[:12]
+        return (model_name, instruction_hash, prompt_class)
+
+    def decide(self, key: tuple, threshold: float, max_supervisors: int) -> SupervisionDecision:
+        """key 조합의 최근 점수로 이번 턴의 평가 방식을 정합니다."""
+        with self._lock:
+            stats = self._stats.get(key)
+            scores = list(stats.scores) if stats is not None else []
+            pass_rate = wilson_lower_bound(sum(score >= threshold for score in scores), len(scores), self.confidence_z) if scores else None
+            if stats is not None and stats.forced_full_turns > 0:
+                stats.forced_full_turns -= 1
+                decision = SupervisionDecision("forced", max_supervisors, len(scores), pass_rate)
+            elif len(scores) < self.min_samples:
+                decision = SupervisionDecision("learning", max_supervisors, len(scores), pass_rate)
+            elif pass_rate >= self.skip_pass_rate and sum(scores) / len(scores) >= threshold + self.skip_min_margin:
+                if self._random.random() < self.audit_rate:
+                    decision = SupervisionDecision("audit", max_supervisors, len(scores), pass_rate)
+                else:
+                    decision = SupervisionDecision("skip", 0, len(scores), pass_rate, self.panel_seconds or 0.0,
+                                                   (self.supervisor_cost_usd or 0.0) * max_supervisors)
+            elif pass_rate >= self.reduce_pass_rate and self.reduced_supervisors < max_supervisors:
+                decision = SupervisionDecision("reduced", self.reduced_supervisors, len(scores), pass_rate, 0.0,
+                                               (self.supervisor_cost_usd or 0.0) * (max_supervisors - self.reduced_supervisors))
+            else:
+                decision = SupervisionDecision("full", max_supervisors, len(scores), pass_rate)
+            self.counters.decisions[decision.mode] = self.counters.decisions.get(decision.mode, 0) + 1
+            self.counters.saved_seconds += decision.expected_saved_seconds
+            self.counters.saved_cost_usd += decision.expected_saved_cost_usd
+            return decision
+
+    def record(self, key: tuple, avg_score: float, threshold: float, verdicts: list, audited: bool = False):
+        """
+        패널 평가 결과를 기록합니다. verdicts는 SupervisorVerdict 리스트 (latency_seconds, cost_usd 사용).
+        audited=True(감사 평가)인데 기준을 넘지 못하면 이 조합은 audit_failure_full_turns 턴 동안 전체 패널로 평가합니다.
+        """
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = PolicyStats(deque(maxlen=self.window))
+            stats.scores.append(avg_score)
+            if audited and avg_score < threshold:
+                stats.forced_full_turns = self.audit_failure_full_turns
+                self.counters.audit_failures += 1
+            if verdicts:
+                panel_seconds = max(verdict.latency_seconds for verdict in verdicts)
+                supervisor_cost = sum(verdict.cost_usd for verdict in verdicts) / len(verdicts)
+                self.panel_seconds = self._smooth(self.panel_seconds, panel_seconds)
+                self.supervisor_cost_usd = self._smooth(self.supervisor_cost_usd, supervisor_cost)
+
+    def _smooth(self, previous: float | None, value: float) -> float:
+        return value if previous is None else previous + self.smoothing * (value - previous)
+
+    def summary(self) -> str:
+        with self._lock:
+            decisions = self.counters.decisions
+            return (f"조합 {len(self._stats)}개, 생략 {decisions.get('skip', 0)}회 / 감사 {decisions.get('audit', 0)}회 "
+                    f"(실패 {self.counters.audit_failures}회) / 축소 {decisions.get('reduced', 0)}회 / "
+                    f"전체 {decisions.get('full', 0) + decisions.get('learning', 0) + decisions.get('forced', 0)}회, "
+                    f"예상 절감 {self.counters.saved_seconds:.1f}초 / ${self.counters.saved_cost_usd:.4f}")
@@ -0,0 +1,184 @@
+"""
+Gemini 호출의 토큰 사용량과 비용 집계.
+
+응답의 usage_metadata(입력/캐시/출력/사고 토큰)를 (용도, 모델)별로 모으고, 모델별 단가로 비용을 추정합니다.
+현재 UsageMeter는 contextvars로 전달되므로 Tracer.bind()로 스레드 풀에 넘긴 작업(Supervisor, 후보 생성)의 호출도
+제출한 쪽의 턴에 기록됩니다. 자식 meter(parent 지정)는 자기 몫을 따로 세면서 부모에도 함께 기록합니다.
+집계 결과는 JSON으로 저장할 수 있는 dict 리스트(records)로 주고받습니다.
+"""
+import time
+import threading
+import contextvars
+
+_current_meter = contextvars.ContextVar("faust_usage_meter", default=None)
+
+USAGE_FIELDS = ("calls", "prompt_tokens", "cached_tokens", "output_tokens", "cost_usd")
+
+def _empty_totals() -> dict:
+    return {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "output_tokens": 0, "cost_usd": 0.0}
+
+def estimate_cost_usd(pricing: dict, model: str, prompt_tokens: int, cached_tokens: int, output_tokens: int) -> float:
+    """pricing(모델 -> 100만 토큰당 (입력, 캐시된 입력, 출력) 달러)로 호출 비용을 추정합니다. 단가를 모르는 모델은 0."""
+    price = pricing.get(model)
+    if price is None:
+        return 0.0
+    input_price, cached_input_price, output_price = price
+    return ((prompt_tokens - cached_tokens) * input_price + cached_tokens * cached_input_price + output_tokens * output_price) / 1e6
+
+def merge_records(*record_lists) -> list:
+    """여러 records를 (category, model)별로 합칩니다."""
+    merged = {}
+    for records in record_lists:
+        for record in records or ():
+            totals = merged.setdefault((record["category"], record["model"]), _empty_totals())
+            for field in USAGE_FIELDS:
+                totals[field] += record.get(field) or 0
+    return [{"category": category, "model": model, **totals} for (category, model), totals in sorted(merged.items())]
+
+def total_usage(records, category: str | None = None) -> dict:
+    """records의 합계 (category를 주면 그 용도만). total_tokens = 입력 + 출력."""
+    totals = _empty_totals()
+    for record in records or ():
+        if category is None or record["category"] == category:
+            for field in USAGE_FIELDS:
+                totals[field] += record.get(field) or 0
+    totals["total_tokens"] = totals["prompt_tokens"] + totals["output_tokens"]
+    return totals
+
+def format_usage(records, category_labels: dict | None = None) -> str:
+    """'입력 N(캐시 M) / 출력 K 토큰, $X (용도별 토큰)' 형식의 한 줄 요약."""
+    totals = total_usage(records)
+    summary = (f"입력 {totals['prompt_tokens']:,}(캐시 {totals['cached_tokens']:,}) / 출력 {totals['output_tokens']:,} 토큰, "
+               f"${totals['cost_usd']:.4f}, 호출 {totals['calls']}회")
+    if category_labels:
+        by_category = [f"{label} {total_usage(records, category)['total_tokens']:,}"
+                       for category, label in category_labels.items() if any(record["category"] == category for record in records or ())]
+        if by_category:
+            summary += f" ({', '.join(by_category)})"
+    return summary
+
+class UsageMeter:
+    """
+    (category, model)별 사용량 누적기. 여러 스레드에서 함께 기록합니다.
+    parent가 있으면 기록할 때마다 부모에도 같은 사용량을 기록합니다 (예: Supervisor 한 명 -> 턴 전체).
+    """
+
+    def __init__(self, pricing: dict | None = None, parent=None):
+        self.pricing = pricing if pricing is not None else (parent.pricing if parent is not None else {})
+        self.parent = parent
+        self._totals = {} # (category, model) -> totals
+        self._lock = threading.Lock()
+
+    def record(self, category: str, model: str, usage_metadata):
+        """usage_metadata(GenerateContentResponseUsageMetadata)를 기록합니다. None이면 호출 횟수만 셉니다."""
+        prompt_tokens = getattr(usage_metadata, "prompt_token_count", None) or 0
+        prompt_tokens += getattr(usage_metadata, "tool_use_prompt_token_count", None) or 0
+        cached_tokens = getattr(usage_metadata, "cached_content_token_count", None) or 0
+        # 사고(thinking) 토큰은 출력 토큰 단가로 과금됨
+        output_tokens = (getattr(usage_metadata, "candidates_token_count", None) or 0) + \
+            (getattr(usage_metadata, "thoughts_token_count", None) or 0)
+        self._add(category, model, prompt_tokens, cached_tokens, output_tokens,
+                  estimate_cost_usd(self.pricing, model, prompt_tokens, cached_tokens, output_tokens))
+
+    def add_records(self, records):
+        """다른 meter에서 센 records를 더합니다 (턴이 끝난 뒤에 끝나는 백그라운드 작업의 사용량을 다음 턴에 반영할 때 사용)."""
+        for record in records or ():
+            self._add(record["category"], record["model"], record["prompt_tokens"], record["cached_tokens"],
+                      record["output_tokens"], record["cost_usd"], calls=record["calls"])
+
+    def _add(self, category: str, model: str, prompt_tokens: int, cached_tokens: int, output_tokens: int, cost_usd: float,
+             calls: int = 1):
+        with self._lock:
+            totals = self._totals.setdefault((category, model), _empty_totals())
+            totals["calls"] += calls
+            totals["prompt_tokens"] += prompt_tokens
+            totals["cached_tokens"] += cached_tokens
+            totals["output_tokens"] += output_tokens
+            totals["cost_usd"] += cost_usd
+        if self.parent is not None:
+            self.parent._add(category, model, prompt_tokens, cached_tokens, output_tokens, cost_usd, calls=calls)
+
+    def records(self) -> list:
+        with self._lock:
+            return [{"category": category, "model": model, **totals} for (category, model), totals in sorted(self._totals.items())]
+
+    def total(self, category: str | None = None) -> dict:
+        return total_usage(self.records(), category)
+
+    def run(self, func, *args, **kwargs):
+        """이 meter를 현재 meter로 지정한 채 func를 실행합니다 (스레드 풀 작업을 별도 meter로 셀 때 사용)."""
+        token = _current_meter.set(self)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current_meter.reset(token)
+
+def activate_meter(meter: UsageMeter | None) -> contextvars.Token:
+    """meter를 현재 meter로 지정합니다 (여러 번의 스크립트 실행에 걸친 턴 meter용)."""
+    return _current_meter.set(meter)
+
+def current_meter() -> UsageMeter | None:
+    return _current_meter.get()
+
+def record_usage(category: str, model: str, usage_metadata):
+    """현재 meter에 사용량을 기록합니다. 현재 meter가 없으면 아무것도 하지 않습니다."""
+    meter = _current_meter.get()
+    if meter is not None:
+        meter.record(category, model, usage_metadata)
+
+class UsageLedger:
+    """
+    사용자 한 명의 누적 사용량. 예산은 이번 달(period) 사용량에 적용하고, lifetime은 전체 누적입니다.
+    저장소에는 to_dict()의 결과를 사용자 정보와 함께 저장합니다. 같은 사용자의 여러 세션이 함께 저장할 수 있으므로
+    저장소에는 전체 값 대신 아직 저장하지 않은 사용량(take_unsaved)만 넘기고, 저장소가 기존 값에 더합니다(merged).
+    """
+
+    def __init__(self, period: str | None = None, current: list | None = None, lifetime: list | None = None):
+        self.period = period or self.current_period()
+        self.current = current or []
+        self.lifetime = lifetime or []
+        self.unsaved = [] # 저장소에 아직 더하지 않은 사용량
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def current_period() -> str:
+        return time.strftime("%Y-%m")
+
+    def roll_over(self) -> bool:
+        """달이 바뀌었으면 이번 달 사용량을 비웁니다. 바뀌었으면 True."""
+        period = self.current_period()
+        if period == self.period:
+            return False
+        self.period = period
+        self.current = []
+        return True
+
+    def add(self, records: list):
+        with self._lock:
+            self.roll_over()
+            self.current = merge_records(self.current, records)
+            self.lifetime = merge_records(self.lifetime, records)
+            self.unsaved = merge_records(self.unsaved, records)
+
+    def take_unsaved(self) -> list:
+        """저장소에 아직 더하지 않은 사용량을 꺼냅니다 (저장 작업에 넘긴 뒤에는 다시 보내지 않음)."""
+        with self._lock:
+            records, self.unsaved = self.unsaved, []
+            return records
+
+    def to_dict(self) -> dict:
+        return {"period": self.period, "current": self.current, "lifetime": self.lifetime}
+
+    @staticmethod
+    def from_dict(data: dict | None):
+        data = data or {}
+        ledger = UsageLedger(data.get("period"), data.get("current"), data.get("lifetime"))
+        ledger.roll_over()
+        return ledger
+
+    @staticmethod
+    def merged(stored: dict | None, records: list) -> dict:
+        """저장소의 값(stored)에 records를 더한 to_dict() 결과. 저장소가 읽고-더하고-쓰는 트랜잭션 안에서 사용합니다."""
+        ledger = UsageLedger.from_dict(stored)
+        ledger.add(records)
+        return ledger.to_dict()
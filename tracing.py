@@ -0,0 +1,242 @@
+"""
+요청 경로의 단계별 소요 시간을 기록하는 가벼운 추적(tracing) 계층.
+
+span은 이름, 시작/종료 시각, 속성(attributes), 부모 span을 가지며 같은 trace_id로 한 턴의 단계들을 묶습니다.
+현재 span은 contextvars로 전달되므로 중첩된 함수 호출은 자동으로 부모-자식 관계가 되고,
+스레드 풀에 넘기는 작업은 Tracer.bind()로 감싸면 제출한 쪽의 span 아래에 기록됩니다.
+끝난 span은 메모리의 최근 trace 버퍼(앱 내 waterfall 패널용)와, 설정된 경우 JSONL 파일(OTLP/JSON 필드 이름)로 내보냅니다.
+"""
+import json
+import time
+import random
+import functools
+import threading
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+
+_current_span = contextvars.ContextVar("faust_current_span", default=None)
+
+class Span:
+    """추적 단계 하나. end()를 호출하면 Tracer에 기록됩니다."""
+    __slots__ = ("tracer", "name", "trace_id", "span_id", "parent_id", "start_time_ns", "end_time_ns",
+                 "attributes", "events", "status", "thread_name")
+
+    def __init__(self, tracer, name: str, trace_id: str, parent_id: str | None, attributes: dict):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.start_time_ns = time.time_ns()
+        self.end_time_ns = None
+        self.attributes = dict(attributes)
+        self.events = [] # (이름, 시각 ns, 속성)
+        self.status = "ok"
+        self.thread_name = threading.current_thread().name
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def set_attributes(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add_event(self, name: str, **attributes):
+        self.events.append((name, time.time_ns(), attributes))
+
+    def record_exception(self, error: BaseException):
+        self.status = "error"
+        self.add_event("exception", type=type(error).__name__, message=str(error))
+
+    def end(self):
+        if self.end_time_ns is None:
+            self.end_time_ns = time.time_ns()
+            self.tracer._on_end(self)
+
+    @property
+    def is_ended(self) -> bool:
+        return self.end_time_ns is not None
+
+    @property
+    def duration_ms(self) -> float:
+        end_time_ns = self.end_time_ns if self.end_time_ns is not None else time.time_ns()
+        return (end_time_ns - self.start_time_ns) / 1e6
+
+    def to_otlp_dict(self) -> dict:
+        """OTLP/JSON의 span 필드 이름을 따르는 dict (속성 값은 JSON으로 표현 가능한 값으로 변환)."""
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id or "",
+            "name": self.name,
+            "startTimeUnixNano": self.start_time_ns,
+            "endTimeUnixNano": self.end_time_ns,
+            "attributes": {key: _json_value(value) for key, value in self.attributes.items()},
+            "events": [{"name": name, "timeUnixNano": time_ns, "attributes": {key: _json_value(value) for key, value in attributes.items()}}
+                       for name, time_ns, attributes in self.events],
+            "status": {"code": "STATUS_CODE_ERROR" if self.status == "error" else "STATUS_CODE_OK"},
+            "thread": self.thread_name,
+        }
+
+class _NoopSpan:
+    """현재 span이 없을 때 current_span()이 돌려주는 객체. 모든 기록을 무시합니다."""
+    def set_attribute(self, key, value): pass
+    def set_attributes(self, **attributes): pass
+    def add_event(self, name, **attributes): pass
+    def record_exception(self, error): pass
+
+NOOP_SPAN = _NoopSpan()
+
+def _json_value(value):
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return str(value)
+
+class JsonlSpanExporter:
+    """끝난 span을 한 줄에 하나씩 JSONL 파일에 추가합니다."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8")
+
+    def export(self, span: Span):
+        line = json.dumps(span.to_otlp_dict(), ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+class Tracer:
+    """
+    span을 만들고, 끝난 span을 최근 max_traces개 trace 버퍼와 exporter로 보냅니다.
+    여러 스레드와 세션이 함께 사용합니다.
+    control_flow_exceptions는 오류가 아니라 실행 흐름을 바꾸는 예외(예: Streamlit의 st.rerun()/st.stop())로,
+    span을 오류로 표시하지 않고 중단된 사실만 이벤트로 남긴 뒤 그대로 다시 던집니다.
+    """
+
+    def __init__(self, exporter=None, max_traces: int = 50, control_flow_exceptions: tuple = ()):
+        self.exporter = exporter
+        self.max_traces = max_traces
+        self.control_flow_exceptions = tuple(control_flow_exceptions)
+        self._traces = OrderedDict() # trace_id -> [Span] (끝난 순서)
+        self._lock = threading.Lock()
+        self.export_error_count = 0
+
+    def start_span(self, name: str, parent: Span | None = None, root: bool = False, **attributes) -> Span:
+        """span을 시작합니다. parent가 없으면 현재 span의 자식이 되고, root=True이면 새 trace를 시작합니다."""
+        if parent is None and not root:
+            parent = _current_span.get()
+        if parent is None:
+            return Span(self, name, f"{random.getrandbits(128):032x}", None, attributes)
+        return Span(self, name, parent.trace_id, parent.span_id, attributes)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """with 블록을 span으로 기록합니다. 블록 안에서는 이 span이 현재 span이 됩니다."""
+        span = self.start_span(name, **attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except self.control_flow_exceptions as error:
+            span.add_event("interrupted", type=type(error).__name__)
+            raise
+        except BaseException as error:
+            span.record_exception(error)
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end()
+
+    def traced(self, name: str):
+        """함수 호출 전체를 name span으로 기록하는 데코레이터."""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def activate(self, span: Span | None) -> contextvars.Token:
+        """span을 끝내지 않고 현재 span으로 지정합니다 (여러 번의 스크립트 실행에 걸친 턴 span용). deactivate()로 되돌립니다."""
+        return _current_span.set(span)
+
+    def deactivate(self, token: contextvars.Token):
+        _current_span.reset(token)
+
+    def active_span(self) -> Span | None:
+        """현재 span (없으면 None). 나중에 다른 스레드에서 시작할 span의 부모로 넘길 때 사용합니다."""
+        return _current_span.get()
+
+    def current_span(self):
+        """현재 span (없으면 아무것도 기록하지 않는 NOOP_SPAN). 속성을 기록할 때 사용합니다."""
+        return _current_span.get() or NOOP_SPAN
+
+    def bind(self, func):
+        """func를 지금의 컨텍스트(현재 span)에서 실행하도록 감쌉니다. 스레드 풀에 제출하는 작업에 사용합니다."""
+        context = contextvars.copy_context()
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return context.copy().run(func, *args, **kwargs)
+        return wrapper
+
+    def get_trace(self, trace_id: str) -> list:
+        """trace_id의 끝난 span 목록 (시작 시각 순)."""
+        with self._lock:
+            spans = list(self._traces.get(trace_id, ()))
+        return sorted(spans, key=lambda span: span.start_time_ns)
+
+    def _on_end(self, span: Span):
+        with self._lock:
+            spans = self._traces.get(span.trace_id)
+            if spans is None:
+                spans = self._traces[span.trace_id] = []
+                while len(self._traces) > self.max_traces:
+                    self._traces.popitem(last=False)
+            spans.append(span)
+        if self.exporter is not None:
+            try:
+                self.exporter.export(span)
+            except Exception as e: # 추적 실패가 요청을 실패시키지 않도록 함
+                self.export_error_count += 1
+                print(f"span 내보내기 실패: {e}")
+
+def waterfall_rows(spans: list) -> list:
+    """
+    span 목록을 waterfall 표시용 행으로 변환합니다. 부모 바로 아래에 자식이 오도록(깊이 우선) 정렬합니다.
+    각 행: {order, depth, name, start_ms, end_ms, duration_ms, thread, status, attributes}
+    """
+    if not spans:
+        return []
+    by_id = {span.span_id: span for span in spans}
+    children = {}
+    roots = []
+    for span in sorted(spans, key=lambda span: span.start_time_ns):
+        if span.parent_id in by_id:
+            children.setdefault(span.parent_id, []).append(span)
+        else:
+            roots.append(span)
+    origin_ns = min(span.start_time_ns for span in spans)
+
+    rows = []
+    def visit(span, depth):
+        rows.append({
+            "order": len(rows),
+            "depth": depth,
+            "name": span.name,
+            "start_ms": round((span.start_time_ns - origin_ns) / 1e6, 1),
+            "end_ms": round((span.start_time_ns - origin_ns) / 1e6 + span.duration_ms, 1),
+            "duration_ms": round(span.duration_ms, 1),
+            "thread": span.thread_name,
+            "status": span.status,
+            "attributes": ", ".join(f"{key}={value}" for key, value in span.attributes.items()),
+        })
+        for child in children.get(span.span_id, ()):
+            visit(child, depth + 1)
+    for root in roots:
+        visit(root, 0)
+    return rows